@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+import contextvars
+import logging
+import traceback
+import time
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                TimeoutError, as_completed, wait)
+
+from .executor import ComputationAborted
+
+
+def _submit(pool, func, *args):
+    # run in a copy of the caller's context, so the request's timing spans
+    # (see timing.py) include the pool's work
+    return pool.submit(contextvars.copy_context().run, func, *args)
+
+
+def _cancel(gamma, cards):
+    """Stop the computations of ``cards``, if ``gamma`` supports it."""
+    cancel = getattr(gamma, 'cancel', None)
+    if cancel is not None:
+        for eval_id in set(card.get('eval_id') for card in cards):
+            cancel(eval_id)
+
+
+def evaluate_card(gamma, card, expression):
+    """Evaluate one card of an ``eval`` result, catching its errors."""
+    try:
+        return gamma.eval_card(card['card'], expression, card['var'], {},
+                               eval_id=card.get('eval_id'))
+    except (ValueError, ComputationAborted) as e:
+        return {'error': str(e)}
+    except Exception as e:
+        logging.exception(f"Exception:\n{e}\n")
+        return {'error': ('There was an error in Gamma. For reference '
+                          'the last five traceback entries are: ' +
+                          traceback.format_exc(5))}
+
+
+def evaluate_cards(gamma, expression, cards, budget, concurrency=None):
+    """Evaluate the cards of an ``eval`` result concurrently, for at most
+    ``budget`` seconds altogether.
+
+    Returns the results of the cards that finished in time, keyed by card
+    name. Cards still running are cancelled: the ``/card/`` request that
+    replaces them computes them again, as each worker process has its own
+    card cache.
+    """
+    return {card['card']: output for card, output
+            in iter_cards(gamma, expression, cards, budget, concurrency)
+            if output is not None}
+
+
+def iter_cards(gamma, expression, cards, budget, concurrency=None):
+    """Like :func:`evaluate_cards`, but yield ``(card, result)`` pairs as the
+    cards finish, followed by ``(card, None)`` for each card that missed
+    the budget. Those are cancelled, like the cards still running when the
+    generator is closed early.
+    """
+    cards = [card for card in cards if 'card' in card]
+    if not cards:
+        return
+    pool = ThreadPoolExecutor(max_workers=concurrency or len(cards))
+    futures = {_submit(pool, evaluate_card, gamma, card, expression): card
+               for card in cards}
+    pending = set(futures)
+    try:
+        for future in as_completed(futures, timeout=budget):
+            pending.discard(future)
+            yield futures[future], future.result()
+    except TimeoutError:
+        pass
+    finally:
+        for future in pending:
+            future.cancel()
+        _cancel(gamma, [futures[future] for future in pending])
+        pool.shutdown(wait=False)
+    for card in cards:
+        if any(futures[future] is card for future in pending):
+            yield card, None
+
+
+def card_events(gamma, expression, cards, budget, heartbeat,
+                concurrency=None):
+    """Evaluate cards concurrently, yielding an event dict for each of them.
+
+    ``card`` events carry the result of a card as it finishes. Every
+    ``heartbeat`` seconds a ``progress`` event gives the elapsed time of each
+    card still running, and once ``budget`` seconds have passed the
+    remaining cards are cancelled and get a ``timeout`` event. A final
+    ``done`` event ends the stream. Closing the generator early cancels the
+    cards that haven't finished too. Cancelling kills their computations if
+    ``gamma`` supports ``cancel``.
+    """
+    cards = [card for card in cards if 'card' in card]
+    pool = ThreadPoolExecutor(max_workers=concurrency or len(cards) or 1)
+    futures = {_submit(pool, evaluate_card, gamma, card, expression): card
+               for card in cards}
+    pending = set(futures)
+    start = time.monotonic()
+    try:
+        while pending:
+            elapsed = time.monotonic() - start
+            if elapsed >= budget:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED,
+                                 timeout=min(heartbeat, budget - elapsed))
+            for future in done:
+                yield {'event': 'card', 'card': futures[future]['card'],
+                       'result': future.result()}
+            elapsed = time.monotonic() - start
+            if not done and elapsed < budget:
+                elapsed = round(elapsed, 1)
+                for future in pending:
+                    yield {'event': 'progress',
+                           'card': futures[future]['card'],
+                           'elapsed': elapsed}
+        # the client loads these from /card/, which computes them again
+        timed_out, pending = pending, set()
+        for future in timed_out:
+            future.cancel()
+        _cancel(gamma, [futures[future] for future in timed_out])
+        for future in timed_out:
+            yield {'event': 'timeout', 'card': futures[future]['card']}
+        yield {'event': 'done'}
+    except GeneratorExit:
+        # the client went away: stop the cards still running too
+        _cancel(gamma, [futures[future] for future in pending])
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+def evaluate(gamma, expression, cards=False):
+    """Evaluate an input like ``/input`` does, plus the requested cards.
+
+    ``cards`` is True for every card of the result, a list of card names, or
+    False for none. ``gamma`` is a SymPyGamma or an EvaluationExecutor.
+    """
+    result = gamma.eval(expression)
+    if not result:
+        result = [{
+            "title": "Input",
+            "input": expression,
+            "output": "Can't handle the input."
+        }]
+
+    output = {'input': expression, 'result': result}
+    if cards:
+        output['cards'] = {}
+        for card in result:
+            if 'card' in card and (cards is True or card['card'] in cards):
+                output['cards'][card['card']] = evaluate_card(
+                    gamma, card, expression)
+    return output
+
+
+def run_batch(gamma, inputs, cards=False, concurrency=1):
+    """Evaluate many inputs concurrently, yielding each as it finishes.
+
+    Every result carries the ``index`` of its input. Closing the generator
+    cancels the inputs that haven't started yet.
+    """
+    pool = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+    futures = {_submit(pool, evaluate, gamma, expression, cards): index
+               for index, expression in enumerate(inputs)}
+    try:
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                output = future.result()
+            except Exception as e:
+                logging.exception(f"Exception:\n{e}\n")
+                output = {'input': inputs[index], 'error': str(e)}
+            output['index'] = index
+            yield output
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
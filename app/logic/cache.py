@@ -0,0 +1,147 @@
+from __future__ import absolute_import
+import collections
+import hashlib
+import json
+import threading
+
+import sympy
+
+CARD_CACHE_SIZE = 1024
+# Seconds a card result lives in a shared cache
+SHARED_CACHE_TTL = 24 * 60 * 60
+
+# Query parameters the card endpoints always send; they are already part of
+# the key as the expression and variable
+RESERVED_PARAMETERS = ('variable', 'expression')
+
+
+def canonical(obj):
+    """Serialize an evaluated input so equal inputs give equal strings."""
+    if isinstance(obj, sympy.Basic):
+        return sympy.srepr(obj)
+    elif isinstance(obj, dict):
+        return '{%s}' % ', '.join(sorted(
+            '%s: %s' % (canonical(key), canonical(val))
+            for key, val in obj.items()))
+    elif isinstance(obj, (list, tuple)):
+        return '%s(%s)' % (type(obj).__name__,
+                           ', '.join(canonical(item) for item in obj))
+    elif callable(obj) and hasattr(obj, '__qualname__'):
+        # functions (e.g. help(integrate)) otherwise repr with their address
+        return '%s.%s' % (getattr(obj, '__module__', None), obj.__qualname__)
+    return repr(obj)
+
+
+def card_key(card_name, evaluated, components, variable, parameters):
+    """Content-addressed key of one card evaluation."""
+    parameters = sorted((key, val) for key, val in (parameters or {}).items()
+                        if key not in RESERVED_PARAMETERS)
+    parts = [
+        sympy.__version__,
+        card_name,
+        str(variable),
+        canonical(evaluated),
+        canonical({key: val for key, val in components.items()
+                   if key != 'variable'}),
+        json.dumps(parameters),
+    ]
+    digest = hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+    return 'card:' + digest
+
+
+class MemoryBackend(object):
+    """Per-process LRU backend."""
+
+    def __init__(self, maxsize=CARD_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedBackend(object):
+    """Backend for a cache shared between processes and instances.
+
+    ``client`` needs ``get(key)`` and ``set(key, value, ttl)``, which
+    memcache and redis clients provide. Values are stored as JSON. The
+    server does its own eviction, so ``evictions`` stays at 0.
+    """
+
+    def __init__(self, client, ttl=SHARED_CACHE_TTL):
+        self.client = client
+        self.ttl = ttl
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.client.get(key)
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(key, json.dumps(value), self.ttl)
+
+
+class LocalClient(object):
+    """Dictionary stand-in for a memcache/redis client."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ttl=0):
+        self.data[key] = value
+
+
+class CardCache(object):
+    """Cache of formatted card results with hit/miss accounting."""
+
+    def __init__(self, backend=None):
+        self.backend = MemoryBackend() if backend is None else backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+        }
+
+
+card_cache = CardCache()
@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+import collections
+import threading
+import time
+import uuid
+
+# Number of evaluations kept per process, and how long (in seconds) a result
+# page may keep using its evaluation id before cards fall back to re-parsing.
+EVALUATION_STORE_SIZE = 512
+EVALUATION_TTL = 10 * 60
+
+
+class Evaluation(object):
+    """Everything the card endpoints need to skip parsing an input again.
+
+    ``namespace`` is a snapshot of the evaluation's own layer of the
+    namespace (user variables, ``input_evaluated``, ...), without the shared
+    base namespace below it.
+    """
+
+    def __init__(self, expression, namespace, evaluated, components, cards):
+        self.expression = expression
+        self.namespace = namespace
+        self.evaluated = evaluated
+        self.components = components
+        self.cards = cards
+
+
+class EvaluationStore(object):
+    """Bounded in-process store of evaluations with LRU and TTL eviction.
+
+    Evaluations are immutable once stored, so callers must copy anything
+    (components, namespace) they intend to modify.
+    """
+
+    def __init__(self, maxsize=EVALUATION_STORE_SIZE, ttl=EVALUATION_TTL,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, evaluation):
+        """Store an evaluation and return its opaque id."""
+        eval_id = uuid.uuid4().hex
+        now = self._clock()
+        with self._lock:
+            self._entries[eval_id] = (now + self.ttl, evaluation)
+            self._evict(now)
+        return eval_id
+
+    def get(self, eval_id):
+        """Return the evaluation stored under ``eval_id``, or None."""
+        with self._lock:
+            entry = self._entries.get(eval_id)
+            if entry is None:
+                return None
+            expires, evaluation = entry
+            if expires <= self._clock():
+                del self._entries[eval_id]
+                return None
+            self._entries.move_to_end(eval_id)
+            return evaluation
+
+    def _evict(self, now):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        # least recently used entries are the most likely to have expired
+        while self._entries:
+            eval_id, (expires, _) = next(iter(self._entries.items()))
+            if expires > now:
+                break
+            del self._entries[eval_id]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+evaluations = EvaluationStore()
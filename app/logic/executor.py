@@ -0,0 +1,514 @@
+from __future__ import absolute_import
+import collections
+import logging
+import multiprocessing
+import os
+import pickle
+import resource
+import signal
+import threading
+import traceback
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+
+from . import memory, timing
+
+# Remember which worker created an evaluation so its cards can be sent to
+# the worker holding it in its EvaluationStore
+AFFINITY_SIZE = 1024
+
+
+class ComputationAborted(Exception):
+    """A computation was stopped before it finished."""
+
+
+class ComputationTimeout(ComputationAborted):
+    def __init__(self, deadline):
+        super(ComputationTimeout, self).__init__(
+            "Computation timed out after {} seconds.".format(deadline))
+        self.deadline = deadline
+
+    def __reduce__(self):
+        return (ComputationTimeout, (self.deadline,))
+
+
+class ComputationOutOfMemory(ComputationAborted):
+    def __init__(self, message="Computation ran out of memory."):
+        super(ComputationOutOfMemory, self).__init__(message)
+
+
+class ComputationCancelled(ComputationAborted):
+    def __init__(self, message="Computation was cancelled."):
+        super(ComputationCancelled, self).__init__(message)
+
+
+class WorkerError(Exception):
+    """An unexpected exception raised inside a worker process."""
+
+
+# Whether the task running in this worker ran out of memory, even if it
+# handled the MemoryError (see :func:`report_out_of_memory`)
+_out_of_memory = False
+
+
+def report_out_of_memory():
+    """Note that the current task ran out of memory, so its worker is
+    recycled though the task handled the MemoryError."""
+    global _out_of_memory
+    _out_of_memory = True
+
+
+def _status(*fields):
+    """Sizes from /proc/self/status, in bytes."""
+    with open('/proc/self/status') as f:
+        status = dict(line.split(':', 1) for line in f if ':' in line)
+    return tuple(int(status[field].split()[0]) * 1024 for field in fields)
+
+
+def address_space():
+    """Return the size of this process's address space in bytes, 0 where
+    it isn't known."""
+    try:
+        return _status('VmSize')[0]
+    except (OSError, KeyError, ValueError):
+        return 0
+
+
+def memory_usage():
+    """Return the current and peak resident memory of this process in bytes.
+
+    The peak is since the last :func:`reset_peak_memory` where Linux
+    supports it, otherwise over the lifetime of the process.
+    """
+    try:
+        return _status('VmRSS', 'VmHWM')
+    except (OSError, KeyError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return peak, peak
+
+
+def reset_peak_memory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _worker_main(conn, memory_limit=None, max_tasks=None, recycle_rss=None,
+                 trace_memory=False):
+    global _out_of_memory
+    from .logic import SymPyGamma, base_namespace
+
+    if memory_limit:
+        # on top of what the worker inherited: the stacks and malloc arenas
+        # of the threads of the process it descends from count too
+        limit = address_space() + memory_limit
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if trace_memory:
+        memory.start()
+
+    base_namespace()
+    gamma = SymPyGamma()
+    tasks = 0
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        method, args, kwargs = task
+        reset_peak_memory()
+        spans, token = timing.collect()
+        _out_of_memory = False
+        try:
+            response = ('ok', getattr(gamma, method)(*args, **kwargs))
+        except (ValueError, KeyError, SyntaxError) as e:
+            response = ('error', e)
+        except MemoryError:
+            report_out_of_memory()
+            response = ('error', ComputationOutOfMemory())
+        except Exception as e:
+            response = ('error', WorkerError(traceback.format_exc()))
+        finally:
+            timing.stop(token)
+
+        tasks += 1
+        rss, peak_rss = memory_usage()
+        stats = {
+            'rss': rss,
+            'peak_rss': peak_rss,
+            'tasks': tasks,
+            # shipped back so the request's Server-Timing covers the worker
+            'spans': spans.as_dict(),
+            'labels': spans.labels,
+            # retire once SymPy's caches have grown too large to keep
+            'recycle': bool(_out_of_memory or
+                            (max_tasks and tasks >= max_tasks) or
+                            (recycle_rss and rss >= recycle_rss)),
+        }
+        try:
+            conn.send(response + (stats,))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            conn.send(('error', WorkerError(traceback.format_exc()), stats))
+        if stats['recycle']:
+            break
+
+
+def _spawner_main(control, limits):
+    """Fork a worker for each ``'start'`` request on ``control``, and kill
+    or reap them. A ``'warm'`` request runs :func:`warmup.warmup` here
+    first, so the workers forked afterwards start with warm caches.
+
+    This process runs no other thread, so the workers it forks can't
+    inherit a lock some other thread held at the time of the fork, as
+    they could forking from the web process (request threads, the query
+    log writer, the slow-query profiler...).
+    """
+    workers = set()
+    while True:
+        if control.poll(1):
+            try:
+                request = control.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+            command, argument = request
+            if command == 'warm':
+                from .logic import SymPyGamma
+                from .warmup import warmup
+                try:
+                    report = warmup(SymPyGamma(), *argument)
+                except Exception:
+                    logging.exception("Could not warm up the spawner")
+                    report = None
+                control.send(report)
+            elif command == 'start':
+                conn, child_conn = multiprocessing.Pipe()
+                pid = os.fork()
+                if pid == 0:
+                    status = 0
+                    try:
+                        control.close()
+                        conn.close()
+                        _worker_main(child_conn, **limits)
+                    except BaseException:
+                        traceback.print_exc()
+                        status = 1
+                    finally:
+                        os._exit(status)
+                child_conn.close()
+                workers.add(pid)
+                control.send(pid)
+                reduction.send_handle(control, conn.fileno(), None)
+                conn.close()
+            elif command == 'kill' and argument in workers:
+                # not reaped yet, so the pid can't have been reused
+                os.kill(argument, signal.SIGKILL)
+        while workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            workers.discard(pid)
+    for pid in workers:
+        os.kill(pid, signal.SIGKILL)
+
+
+class Spawner(object):
+    """The process that forks workers; see :func:`_spawner_main`.
+
+    It is forked from the process creating it, whose address space it and
+    its workers inherit: create it early, before that process starts other
+    threads. Workers get an address space ceiling of ``memory_limit`` bytes
+    beyond their size when they start, retire after ``max_tasks`` tasks or
+    once their resident memory exceeds ``recycle_rss`` bytes, and with
+    ``trace_memory`` account the memory of each card (see
+    :class:`EvaluationExecutor`). Several pools can share a spawner.
+    """
+
+    def __init__(self, memory_limit=None, max_tasks=None, recycle_rss=None,
+                 trace_memory=False, start_method='fork'):
+        # 'fork' because app/__init__.py replaces the subprocess module,
+        # which the spawn and forkserver start methods need
+        context = multiprocessing.get_context(start_method)
+        limits = {
+            'memory_limit': memory_limit,
+            'max_tasks': max_tasks,
+            'recycle_rss': recycle_rss,
+            'trace_memory': trace_memory,
+        }
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_spawner_main,
+                                       args=(child_conn, limits),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self._lock = threading.Lock()
+
+    def warm(self, corpus, budget):
+        """Warm up the spawner with :func:`warmup.warmup`; return its
+        report, None if it failed."""
+        with self._lock:
+            self.conn.send(('warm', (corpus, budget)))
+            return self.conn.recv()
+
+    def start(self):
+        with self._lock:
+            self.conn.send(('start', None))
+            pid = self.conn.recv()
+            fd = reduction.recv_handle(self.conn)
+        return Worker(pid, Connection(fd), self)
+
+    def kill(self, pid):
+        with self._lock:
+            try:
+                self.conn.send(('kill', pid))
+            except OSError:
+                # the spawner is gone, and its workers with it
+                pass
+
+    def stop(self):
+        with self._lock:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class Worker(object):
+    """A worker process and the pipe used to send it tasks."""
+
+    def __init__(self, pid, conn, spawner):
+        self.pid = pid
+        self.conn = conn
+        self.spawner = spawner
+        self.cancelled = False
+
+    def run(self, task, deadline):
+        self.conn.send(task)
+        if not self.conn.poll(deadline):
+            raise ComputationTimeout(deadline)
+        return self.conn.recv()
+
+    def kill(self):
+        self.spawner.kill(self.pid)
+        self.conn.close()
+
+    def cancel(self):
+        """Kill the process but leave cleaning up to the thread waiting on
+        its task, which then sees the pipe closed."""
+        self.cancelled = True
+        self.spawner.kill(self.pid)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+            # the pipe reads as closed once the worker has exited, unless
+            # it is still busy with a task
+            if self.conn.poll(1):
+                self.conn.recv()
+        except (OSError, EOFError):
+            self.conn.close()
+            return
+        self.kill()
+
+
+class EvaluationExecutor(object):
+    """Runs SymPyGamma computations in a pool of pre-started processes.
+
+    ``deadlines`` maps each kind of task (``'eval'``, ``'eval_card'``, ...)
+    to its wall-clock deadline in seconds, as in the ``EVALUATION_DEADLINES``
+    setting. A task that exceeds the deadline of its kind raises
+    :class:`ComputationTimeout`; its worker is killed and replaced, so a
+    runaway ``integrate`` or ``factorint`` can't pin the server. The
+    executor has the same ``eval``/``eval_card``/``get_card_info``
+    interface as :class:`SymPyGamma`.
+
+    Workers can be given an address space ceiling (``memory_limit`` bytes
+    beyond their size when they start), beyond which computations fail with
+    :class:`ComputationOutOfMemory`. They retire after ``max_tasks`` tasks or
+    once their resident memory exceeds ``recycle_rss`` bytes, so memory
+    held by SymPy's caches after a huge computation is given back. With
+    ``trace_memory``, workers trace their allocations with tracemalloc to
+    account the memory of each card (see :func:`memory.measure`).
+
+    The workers are forked from a :class:`Spawner` made with these limits,
+    or from ``spawner``, whose limits then apply; it is left running on
+    :meth:`shutdown`.
+
+    Tasks for an evaluation id can be cancelled with :meth:`cancel`, which
+    kills the workers running them; they raise
+    :class:`ComputationCancelled`.
+    """
+
+    def __init__(self, workers, deadlines, start_method='fork',
+                 memory_limit=None, max_tasks=None, recycle_rss=None,
+                 trace_memory=False, spawner=None):
+        self.deadlines = dict(deadlines)
+        # the workers are forked from the spawner, not from this process
+        self._own_spawner = spawner is None
+        if spawner is None:
+            spawner = Spawner(memory_limit, max_tasks, recycle_rss,
+                              trace_memory, start_method)
+        self._spawner = spawner
+        self._idle = [self._spawner.start() for _ in range(workers)]
+        self._workers = list(self._idle)
+        self._available = threading.Condition()
+        self._closed = False
+        self._affinity = collections.OrderedDict()
+        # eval_id of the task each busy worker is running
+        self._running = {}
+
+    def _acquire(self, preferred=None):
+        with self._available:
+            while not self._idle:
+                if self._closed:
+                    raise WorkerError("The evaluation workers were shut "
+                                      "down.")
+                self._available.wait()
+            for worker in self._idle:
+                if worker.pid == preferred:
+                    break
+            else:
+                worker = self._idle[0]
+            self._idle.remove(worker)
+            return worker
+
+    def _release(self, worker):
+        if worker is None:
+            return
+        with self._available:
+            self._idle.append(worker)
+            self._available.notify()
+
+    def _replace(self, worker, retiring=False):
+        """Stop ``worker`` and start another in its place; return it, or
+        None once the executor is shut down."""
+        if retiring:
+            worker.stop()
+        else:
+            worker.kill()
+        with self._available:
+            if self._closed:
+                return None
+            try:
+                replacement = self._spawner.start()
+            except (OSError, EOFError) as e:
+                logging.error(f"Could not start a worker: {e}")
+                self._workers.remove(worker)
+                return None
+            self._workers[self._workers.index(worker)] = replacement
+        return replacement
+
+    def run(self, method, *args, **kwargs):
+        """Run ``SymPyGamma().method(*args, **kwargs)`` in a worker."""
+        return self._run(method, args, kwargs)[0]
+
+    def _run(self, method, args, kwargs):
+        deadline = self.deadlines.get(method)
+        eval_id = kwargs.get('eval_id')
+        with timing.span('worker_wait'):
+            worker = busy = self._acquire(self._affinity.get(eval_id))
+        pid = worker.pid
+        with self._available:
+            self._running[busy] = eval_id
+        try:
+            status, value, stats = worker.run((method, args, kwargs), deadline)
+            timing.record(stats.get('spans'), stats.get('labels'))
+            logging.info(f"{method} in worker {pid}: peak memory "
+                         f"{stats['peak_rss'] / 2 ** 20:.1f}MB")
+            if stats['recycle']:
+                logging.info(f"Recycling worker {pid} after {stats['tasks']} "
+                             f"tasks, {stats['rss'] / 2 ** 20:.1f}MB resident")
+                worker = self._replace(worker, retiring=True)
+        except ComputationTimeout:
+            logging.warning(f"Killing worker {pid}: {method} exceeded "
+                            f"its {deadline}s deadline")
+            worker = self._replace(worker)
+            raise
+        except (EOFError, OSError) as e:
+            if worker.cancelled:
+                logging.info(f"Cancelled {method} in worker {pid}")
+                worker = self._replace(worker)
+                raise ComputationCancelled()
+            logging.error(f"Worker {pid} died running {method}: {e}")
+            worker = self._replace(worker)
+            raise WorkerError("The evaluation worker exited unexpectedly.")
+        finally:
+            with self._available:
+                self._running.pop(busy, None)
+            if worker is not None and worker.cancelled:
+                # cancelled after its task had already finished
+                worker = self._replace(worker)
+            self._release(worker)
+
+        if status == 'error':
+            raise value
+        return value, pid
+
+    def eval(self, s):
+        from .logic import SymPyGamma
+
+        try:
+            cards, pid = self._run('eval', (s,), {})
+        except (ComputationAborted, WorkerError) as e:
+            return SymPyGamma().handle_error(s, e)
+
+        eval_ids = set(card['eval_id'] for card in cards or []
+                       if card.get('eval_id'))
+        with self._available:
+            for eval_id in eval_ids:
+                self._affinity[eval_id] = pid
+            while len(self._affinity) > AFFINITY_SIZE:
+                self._affinity.popitem(last=False)
+        return cards
+
+    def eval_card(self, card_name, expression, variable, parameters,
+                  eval_id=None):
+        return self.run('eval_card', card_name, expression, variable,
+                        parameters, eval_id=eval_id)
+
+    def get_card_info(self, card_name, expression, variable, eval_id=None):
+        return self.run('get_card_info', card_name, expression, variable,
+                        eval_id=eval_id)
+
+    def profile(self, method, args, kwargs, limit=None):
+        return self.run('profile', method, args, kwargs, limit=limit)
+
+    def memory_sites(self, method, args, kwargs, group='lineno'):
+        return self.run('memory_sites', method, args, kwargs, group=group)
+
+    def cancel(self, eval_id):
+        """Stop every task running for ``eval_id``; return how many."""
+        if not eval_id:
+            return 0
+        with self._available:
+            workers = [worker for worker, running in self._running.items()
+                       if running == eval_id and not worker.cancelled]
+            for worker in workers:
+                worker.cancel()
+        return len(workers)
+
+    def shutdown(self):
+        with self._available:
+            if self._closed:
+                return
+            self._closed = True
+            workers, self._workers, self._idle = self._workers, [], []
+            self._available.notify_all()
+        for worker in workers:
+            worker.stop()
+        if self._own_spawner:
+            self._spawner.stop()
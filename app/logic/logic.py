@@ -2,12 +2,20 @@ from __future__ import absolute_import
 import traceback
 
 import logging
+from types import MappingProxyType
 
-from .utils import Eval, latexify, arguments, removeSymPy, \
+from .utils import Eval, Namespace, latexify, arguments, removeSymPy, \
     custom_implicit_transformation, synonyms, OTHER_SYMPY_FUNCTIONS, \
     close_matches
 from .resultsets import find_result_set, get_card, format_by_type, \
     is_function_handled, find_learn_more_set
+from .evaluations import Evaluation, evaluations
+from .cache import CardCache, MemoryBackend, card_cache, card_key
+from .executor import ComputationAborted, ComputationOutOfMemory, \
+    report_out_of_memory
+from .profiling import profile
+from . import memory
+from .timing import label, span
 from sympy import latex
 import sympy
 from sympy.core.function import FunctionClass
@@ -22,6 +30,51 @@ from sympy.solvers.diophantine import diophantine
 """
 
 
+def plot(f=None, **kwargs):
+    """Plot functions. Not the same as SymPy's plot.
+
+    This plot function is specific to Gamma. It has the following syntax::
+
+        plot([x^2, x^3, ...])
+
+    or::
+
+        plot(y=x,y1=x^2,r=sin(theta),r1=cos(theta))
+
+    ``plot`` accepts either a list of single-variable expressions to
+    plot or keyword arguments indicating expressions to plot. If
+    keyword arguments are used, the plot will be polar if the keyword
+    argument starts with ``r`` and will be an xy graph otherwise.
+
+    Note that Gamma will cut off plot values above and below a
+    certain value, and that it will **not** warn the user if so.
+
+    """
+    pass
+
+
+_base_namespace = None
+
+
+def base_namespace():
+    """Return the read-only namespace every evaluation is layered over.
+
+    ``PREEXEC`` is executed once per process; evaluations then get a
+    :class:`Namespace` on top of the frozen result instead of re-running
+    ``from sympy import *`` for every request.
+    """
+    global _base_namespace
+    if _base_namespace is None:
+        namespace = {}
+        exec(PREEXEC, {}, namespace)
+        namespace.update({
+            'plot': plot,  # prevent textplot from printing stuff
+            'help': lambda f: f
+        })
+        _base_namespace = MappingProxyType(namespace)
+    return _base_namespace
+
+
 def mathjax_latex(*args):
     tex_code = []
     for obj in args:
@@ -38,9 +91,11 @@ def mathjax_latex(*args):
             not obj.is_Float and
             obj.is_finite is not False and
             hasattr(obj, 'evalf')):
+            with span('evalf'):
+                approximation = latex(obj.evalf(15))
             tag = '<script type="math/tex; mode=display" data-numeric="true" ' \
                   'data-output-repr="{}" data-approximation="{}">'.format(
-                      repr(obj), latex(obj.evalf(15)))
+                      repr(obj), approximation)
 
     tex_code = ''.join(tex_code)
 
@@ -49,6 +104,10 @@ def mathjax_latex(*args):
 
 class SymPyGamma(object):
 
+    def __init__(self, store=None, cache=None):
+        self.store = evaluations if store is None else store
+        self.cache = card_cache if cache is None else cache
+
     def eval(self, s):
         result = None
 
@@ -65,10 +124,17 @@ class SymPyGamma(object):
 
         if result:
             parsed, arguments, evaluator, evaluated = result
+            # functions like integrate, not constructors like Integer; only
+            # names Gamma defines, so inputs can't invent new labels
+            function = arguments.function
+            label('function', function if function and
+                  function[0].islower() and function in base_namespace()
+                  else 'none')
 
             cards = []
 
-            close_match = close_matches(s, sympy.__dict__)
+            with span('close_matches'):
+                close_match = close_matches(s, sympy.__dict__)
             if close_match:
                 cards.append({
                     "ambiguity": close_match,
@@ -76,7 +142,8 @@ class SymPyGamma(object):
                 })
 
             try:
-                cards.extend(self.prepare_cards(parsed, arguments, evaluator, evaluated))
+                cards.extend(self.prepare_cards(parsed, arguments, evaluator,
+                                                evaluated, expression=s))
             except ValueError as e:
                 logging.exception(f"Exception:\n{e}\n")
                 return self.handle_error(s, e)
@@ -84,6 +151,10 @@ class SymPyGamma(object):
             return cards
 
     def handle_error(self, s, e):
+        if isinstance(e, MemoryError):
+            report_out_of_memory()
+            e = ComputationOutOfMemory()
+
         if isinstance(e, SyntaxError):
             error = {
                 "msg": str(e),
@@ -96,11 +167,12 @@ class SymPyGamma(object):
                 {"title": "Input", "input": s},
                 {"title": "Error", "input": s, "exception_info": error}
             ]
-        elif isinstance(e, ValueError):
+        elif isinstance(e, (ValueError, ComputationAborted)):
             return [
                 {"title": "Input", "input": s},
                 {"title": "Error", "input": s, "error": str(e)}
             ]
+
         else:
             trace = traceback.format_exc()
             trace = ("There was an error in Gamma.\n"
@@ -117,52 +189,35 @@ class SymPyGamma(object):
                         "<var>factor</var> factors polynomials, while <var>factorint</var> factors integers.")
         return None
 
-    def eval_input(self, s):
-        namespace = {}
-        exec(PREEXEC, {}, namespace)
-
-        def plot(f=None, **kwargs):
-            """Plot functions. Not the same as SymPy's plot.
-
-            This plot function is specific to Gamma. It has the following syntax::
-
-                plot([x^2, x^3, ...])
-
-            or::
-
-                plot(y=x,y1=x^2,r=sin(theta),r1=cos(theta))
-
-            ``plot`` accepts either a list of single-variable expressions to
-            plot or keyword arguments indicating expressions to plot. If
-            keyword arguments are used, the plot will be polar if the keyword
-            argument starts with ``r`` and will be an xy graph otherwise.
-
-            Note that Gamma will cut off plot values above and below a
-            certain value, and that it will **not** warn the user if so.
-
-            """
-            pass
-        namespace.update({
-            'plot': plot,  # prevent textplot from printing stuff
-            'help': lambda f: f
-        })
-
-        evaluator = Eval(namespace)
-        # change to True to spare the user from exceptions:
-        if not len(s):
-            return None
+    def parse_input(self, s):
+        """Return a fresh namespace and the Python code ``s`` parses to."""
+        namespace = Namespace(base_namespace())
 
         transformations = []
         transformations.append(synonyms)
         transformations.extend(standard_transformations)
         transformations.extend((convert_xor, custom_implicit_transformation))
-        parsed = stringify_expr(s, {}, namespace, transformations)
+        with span('parse'):
+            parsed = stringify_expr(s, {}, namespace, transformations)
         logging.info(f"Parsed as: {parsed}")
+        return namespace, parsed
+
+    def eval_input(self, s):
+        # change to True to spare the user from exceptions:
+        if not len(s):
+            return None
+
+        namespace, parsed = self.parse_input(s)
+        evaluator = Eval(namespace)
         try:
-            evaluated = eval_expr(parsed, {}, namespace)
+            # the namespace is passed as locals too so lookups reach the base
+            with span('evaluate'):
+                evaluated = eval_expr(parsed, namespace, namespace)
         except SyntaxError as e:
             logging.exception(e)
             raise
+        except MemoryError:
+            raise
         except Exception as e:
             raise ValueError(str(e))
         input_repr = repr(evaluated)
@@ -186,12 +241,13 @@ class SymPyGamma(object):
             first_func_name and first_func_name[0].islower() and
             not first_func_name in OTHER_SYMPY_FUNCTIONS)
 
-        if is_applied:
-            convert_input, cards = find_result_set(arguments[0], evaluated)
-        else:
-            convert_input, cards = find_result_set(None, evaluated)
+        with span('find_result_set'):
+            if is_applied:
+                convert_input, cards = find_result_set(arguments[0], evaluated)
+            else:
+                convert_input, cards = find_result_set(None, evaluated)
 
-        components = convert_input(arguments, evaluated)
+            components = convert_input(arguments, evaluated)
         if 'input_evaluated' in components:
             evaluated = components['input_evaluated']
 
@@ -199,15 +255,25 @@ class SymPyGamma(object):
 
         return components, cards, evaluated, (is_function and is_applied)
 
-    def prepare_cards(self, parsed, arguments, evaluator, evaluated):
+    def prepare_cards(self, parsed, arguments, evaluator, evaluated,
+                      expression=None):
         components, cards, evaluated, is_function = self.get_cards(arguments, evaluator, evaluated)
 
-        if is_function:
-            latex_input = ''.join(['<script type="math/tex; mode=display">',
-                                   latexify(parsed, evaluator),
-                                   '</script>'])
-        else:
-            latex_input = mathjax_latex(evaluated)
+        # Remember the evaluation so the card endpoints don't have to parse
+        # and evaluate the input again
+        eval_id = None
+        if expression is not None and cards:
+            eval_id = self.store.put(Evaluation(
+                expression, dict(evaluator.namespace), evaluated,
+                dict(components), list(cards)))
+
+        with span('latex'):
+            if is_function:
+                latex_input = ''.join(['<script type="math/tex; mode=display">',
+                                       latexify(parsed, evaluator),
+                                       '</script>'])
+            else:
+                latex_input = mathjax_latex(evaluated)
 
         result = []
 
@@ -251,9 +317,10 @@ class SymPyGamma(object):
                      "output": format_by_type(evaluated, arguments, mathjax_latex)})
 
             line = "simplify(input_evaluated)"
-            simplified = evaluator.eval(line,
-                                        use_none_for_exceptions=True,
-                                        repr_expression=False)
+            with span('simplify'):
+                simplified = evaluator.eval(line,
+                                            use_none_for_exceptions=True,
+                                            repr_expression=False)
             if (simplified != None and
                 simplified != evaluated and
                 arguments.args and
@@ -281,7 +348,8 @@ class SymPyGamma(object):
                         'input': card.format_input(repr(evaluated), components),
                         'pre_output': latex(
                             card.pre_output_function(evaluated, var)),
-                        'parameters': card.card_info.get('parameters', [])
+                        'parameters': card.card_info.get('parameters', []),
+                        'eval_id': eval_id
                     })
                 except (SyntaxError, ValueError) as e:
                     logging.error(e)
@@ -297,15 +365,34 @@ class SymPyGamma(object):
                     })
         return result
 
-    def get_card_info(self, card_name, expression, variable):
+    def load_evaluation(self, expression, eval_id=None):
+        """Return the evaluator, components and evaluated input for a card.
+
+        If ``eval_id`` names a stored evaluation of ``expression`` it is
+        reused, otherwise the expression is parsed and evaluated again.
+        """
+        with span('load_evaluation'):
+            evaluation = self.store.get(eval_id) if eval_id else None
+        reused = (evaluation is not None and
+                  evaluation.expression == expression)
+        if eval_id:
+            label('evaluation_store', 'hit' if reused else 'miss')
+        if reused:
+            evaluator = Eval(Namespace(base_namespace(), evaluation.namespace))
+            return evaluator, dict(evaluation.components), evaluation.evaluated
+
+        _, arguments, evaluator, evaluated = self.eval_input(expression)
+        components, cards, evaluated, _ = self.get_cards(arguments, evaluator, evaluated)
+        return evaluator, components, evaluated
+
+    def get_card_info(self, card_name, expression, variable, eval_id=None):
         card = get_card(card_name)
 
         if not card:
             raise KeyError
 
-        _, arguments, evaluator, evaluated = self.eval_input(expression)
+        evaluator, components, evaluated = self.load_evaluation(expression, eval_id)
         variable = sympy.Symbol(variable)
-        components, cards, evaluated, _ = self.get_cards(arguments, evaluator, evaluated)
         components['variable'] = variable
 
         return {
@@ -315,20 +402,58 @@ class SymPyGamma(object):
             'pre_output': latex(card.pre_output_function(evaluated, variable))
         }
 
-    def eval_card(self, card_name, expression, variable, parameters):
+    def eval_card(self, card_name, expression, variable, parameters,
+                  eval_id=None):
         card = get_card(card_name)
 
         if not card:
             raise KeyError
 
-        _, arguments, evaluator, evaluated = self.eval_input(expression)
+        evaluator, components, evaluated = self.load_evaluation(expression, eval_id)
         variable = sympy.Symbol(variable)
-        components, cards, evaluated, _ = self.get_cards(arguments, evaluator, evaluated)
         components['variable'] = variable
-        evaluator.set(str(variable), variable)
-        result = card.eval(evaluator, components, parameters)
 
-        return {
-            'value': repr(result),
-            'output': card.format_output(result, mathjax_latex)
-        }
+        with span('card_cache'):
+            key = card_key(card_name, evaluated, components, variable,
+                           parameters)
+            cached = self.cache.get(key)
+        label('card_cache', 'miss' if cached is None else 'hit')
+        if cached is not None:
+            return dict(cached)
+
+        evaluator.set(str(variable), variable)
+        with memory.measure() as usage:
+            with span('card_eval'):
+                result = card.eval(evaluator, components, parameters)
+
+            with span('format_output'):
+                result = {
+                    'value': repr(result),
+                    'output': card.format_output(result, mathjax_latex)
+                }
+        if usage:
+            label('memory_peak', usage['peak'])
+            label('memory_retained', usage['retained'])
+        self.cache.set(key, result)
+        return dict(result)
+
+    def profile(self, method, args, kwargs, limit=None):
+        """Profile ``method`` (e.g. ``'eval_card'``) called with ``args`` and
+        ``kwargs``, stopping it after ``limit`` seconds.
+
+        The card cache is bypassed so a cached card is computed again.
+        Returns the result of :func:`profiling.profile`.
+        """
+        return profile(getattr(self._uncached(), method), args, kwargs, limit)
+
+    def memory_sites(self, method, args, kwargs, group='lineno'):
+        """Trace the allocations of ``method`` called with ``args`` and
+        ``kwargs``, bypassing the card cache like :meth:`profile`.
+
+        Returns the result of :func:`memory.top_sites`.
+        """
+        return memory.top_sites(getattr(self._uncached(), method), args,
+                                kwargs, group)
+
+    def _uncached(self):
+        return SymPyGamma(self.store, CardCache(MemoryBackend(maxsize=0)))
@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+import contextlib
+import linecache
+import threading
+import tracemalloc
+
+# Frames kept per traced allocation while accounting every card: more
+# frames place allocations better but slow tracing down
+TRACE_FRAMES = 1
+
+# Frames kept per allocation, and allocation sites listed, by
+# :func:`top_sites`
+SITE_FRAMES = 10
+TOP_SITES = 20
+
+# Whether a measurement is under way: resetting the peak for another would
+# spoil it
+_measuring = threading.Lock()
+
+
+def start(frames=TRACE_FRAMES):
+    """Trace allocations of this process from now on."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def _reset():
+    """Start measuring from the current traced size; return it."""
+    if hasattr(tracemalloc, 'reset_peak'):
+        # Python 3.9+
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+    # the only way to reset the peak before 3.9: forget the allocations so
+    # far, so only those made from now on count
+    tracemalloc.clear_traces()
+    return 0
+
+
+@contextlib.contextmanager
+def measure():
+    """Measure the memory allocated by the enclosed block.
+
+    Yields a dict that gets the ``peak`` traced size above the start of the
+    block and the size ``retained`` when it ends (negative if it freed more
+    than it allocated), both in bytes. It stays empty unless :func:`start`
+    was called, and inside another measurement. Allocations are traced
+    process-wide, so these are only accurate while nothing runs
+    concurrently, as in an evaluation worker.
+    """
+    usage = {}
+    if not tracemalloc.is_tracing() or not _measuring.acquire(False):
+        yield usage
+        return
+    try:
+        start = _reset()
+        yield usage
+        current, peak = tracemalloc.get_traced_memory()
+        usage['peak'] = max(peak - start, 0)
+        usage['retained'] = current - start
+    finally:
+        _measuring.release()
+
+
+def _site(statistic):
+    frames = []
+    for frame in statistic.traceback:
+        line = linecache.getline(frame.filename, frame.lineno).strip()
+        frames.append(f'{frame.filename}:{frame.lineno}' +
+                      (f' {line}' if line else ''))
+    return {
+        'size': statistic.size_diff,
+        'count': statistic.count_diff,
+        'traceback': frames,
+    }
+
+
+def top_sites(func, args=(), kwargs=None, group='lineno', top=TOP_SITES):
+    """Run ``func`` with allocations traced, and list where the memory it
+    still holds when it returns was allocated.
+
+    Allocations are grouped by ``group`` (``'lineno'``, ``'filename'`` or
+    ``'traceback'``). Returns a dict with the ``outcome`` of the call, its
+    ``peak`` and ``retained`` memory as in :func:`measure`, and the ``top``
+    largest allocation ``sites``, each with the ``size`` and ``count`` of
+    the blocks allocated there and the ``traceback`` leading to it.
+
+    Tracing is restarted with ``SITE_FRAMES`` frames for the call. While
+    another measurement is under way, that would spoil it: the call is then
+    traced as it already is, and ``peak`` and ``retained`` are left out.
+    """
+    exclusive = _measuring.acquire(False)
+    tracing = tracemalloc.is_tracing()
+    frames = tracemalloc.get_traceback_limit() if tracing else 0
+    # no measurement can start while this holds _measuring
+    restart = frames < SITE_FRAMES and (exclusive or not tracing)
+    usage = {}
+    outcome = 'ok'
+    try:
+        if restart:
+            tracemalloc.stop()
+            tracemalloc.start(SITE_FRAMES)
+        before = tracemalloc.take_snapshot()
+        if exclusive:
+            start = _reset()
+        try:
+            # held until the snapshot, which should include the result
+            result = func(*args, **(kwargs or {}))
+        except Exception as e:
+            result = None
+            outcome = f"{type(e).__name__}: {e}"
+        after = tracemalloc.take_snapshot()
+        if exclusive:
+            current, peak = tracemalloc.get_traced_memory()
+            usage['peak'] = max(peak - start, 0)
+            usage['retained'] = current - start
+        # leave out tracemalloc's own bookkeeping
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        statistics = after.filter_traces(ignore).compare_to(
+            before.filter_traces(ignore), group)
+        del result
+    finally:
+        if restart:
+            tracemalloc.stop()
+            if frames:
+                tracemalloc.start(frames)
+        if exclusive:
+            _measuring.release()
+    statistics = [statistic for statistic in statistics
+                  if statistic.size_diff > 0]
+    return dict(usage, outcome=outcome,
+                sites=[_site(statistic) for statistic in statistics[:top]])
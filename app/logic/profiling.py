@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+import collections
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import signal
+import sys
+import threading
+
+# Functions listed in a profile summary, and its sort order
+SUMMARY_ROWS = 40
+SUMMARY_SORT = 'cumulative'
+
+# Seconds between stack samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+# Seconds between alarms once a profiled call is over its limit: Eval.eval
+# catches everything, so a single alarm can be swallowed
+ALARM_INTERVAL = 0.1
+
+
+class ProfileLimitReached(BaseException):
+    # not an Exception, so SymPy's own ``except Exception`` can't swallow it
+    pass
+
+
+def _alarm(signum, frame):
+    raise ProfileLimitReached()
+
+
+def summarize(stats, sort=SUMMARY_SORT, rows=SUMMARY_ROWS):
+    """Format the top ``rows`` functions of a profile like pstats does."""
+    output = io.StringIO()
+    pstats.Stats(stats, stream=output).sort_stats(sort).print_stats(rows)
+    return output.getvalue()
+
+
+def profile(func, args=(), kwargs=None, limit=None):
+    """Run ``func`` under cProfile and return what it spent its time on.
+
+    With a ``limit`` (in seconds, honoured in the main thread only) the call
+    is stopped once it runs that long, and the profile covers the part that
+    ran: what a computation that times out is stuck in. Returns a dict with
+    the ``outcome`` of the call (``'ok'``, or why it stopped), a pstats
+    ``summary`` and the ``profile`` in the format of
+    :meth:`pstats.Stats.dump_stats`.
+    """
+    profiler = cProfile.Profile()
+    alarm = bool(limit) and \
+        threading.current_thread() is threading.main_thread()
+    if alarm:
+        previous = signal.signal(signal.SIGALRM, _alarm)
+        signal.setitimer(signal.ITIMER_REAL, limit, ALARM_INTERVAL)
+    outcome = 'ok'
+    try:
+        profiler.enable()
+        try:
+            func(*args, **(kwargs or {}))
+        finally:
+            profiler.disable()
+    except ProfileLimitReached:
+        outcome = f"stopped after {limit} seconds"
+    except Exception as e:
+        outcome = f"{type(e).__name__}: {e}"
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    profiler.create_stats()
+    # dump first: pstats.Stats takes the stats out of the profiler
+    dump = marshal.dumps(profiler.stats)
+    return {
+        'outcome': outcome,
+        'summary': summarize(profiler),
+        'profile': dump,
+    }
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return (f'{code.co_name} '
+            f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+
+
+def sample(func, args=(), kwargs=None, interval=SAMPLE_INTERVAL):
+    """Run ``func`` while sampling its stack every ``interval`` seconds.
+
+    Cheaper than :func:`profile` on call-heavy code, and shows where time
+    goes in wall-clock terms. Returns a dict with the ``outcome`` of the
+    call, the number of ``samples`` and the ``stacks`` collapsed into one
+    ``outer;...;inner count`` line per distinct stack, the input format of
+    flamegraph.pl and speedscope.
+    """
+    thread = threading.get_ident()
+    caller = sys._getframe()
+    stacks = collections.Counter()
+    done = threading.Event()
+    # plain assignments around the call, so setting it adds no frames
+    running = [False]
+
+    def sampler():
+        while not done.wait(interval):
+            before = running[0]
+            frame = sys._current_frames().get(thread)
+            if not (before and running[0]):
+                # starting or stopping the sampler, not running func
+                continue
+            stack = []
+            # only the frames below this function's
+            while frame is not None and frame is not caller:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                stacks[';'.join(reversed(stack))] += 1
+
+    sampling = threading.Thread(target=sampler, name='sampling-profiler',
+                                daemon=True)
+    outcome = 'ok'
+    sampling.start()
+    try:
+        running[0] = True
+        func(*args, **(kwargs or {}))
+    except Exception as e:
+        outcome = f"{type(e).__name__}: {e}"
+    finally:
+        running[0] = False
+        done.set()
+        sampling.join()
+    return {
+        'outcome': outcome,
+        'samples': sum(stacks.values()),
+        'stacks': ''.join(f'{stack} {count}\n'
+                          for stack, count in stacks.most_common()),
+    }
@@ -4,9 +4,6 @@ import json
 import itertools
 import sympy
 from sympy.core.symbol import Symbol
-import docutils.core
-from . import diffsteps
-from . import intsteps
 import six
 from six.moves import map
 from six.moves import zip
@@ -640,12 +637,15 @@ def eval_integral_manual(evaluator, components, parameters=None):
                                            components['variable'])
 
 def eval_diffsteps(evaluator, components, parameters=None):
+    from . import diffsteps
     function = components.get('function', evaluator.get('input_evaluated'))
 
     return diffsteps.print_html_steps(function,
                                       components['variable'])
 
 def eval_intsteps(evaluator, components, parameters=None):
+    # imports sympy.integrals.manualintegrate, so only load it when needed
+    from . import intsteps
     integrand = components.get('integrand', evaluator.get('input_evaluated'))
 
     return intsteps.print_html_steps(integrand, components['variable'])
@@ -677,6 +677,7 @@ def trim(docstring):
     return '\n'.join(trimmed)
 
 def eval_function_docs(evaluator, components, parameters=None):
+    import docutils.core
     docstring = trim(evaluator.get("input_evaluated").__doc__)
     return docutils.core.publish_parts(docstring, writer_name='html4css1',
                                        settings_overrides={'_disable_config': True})['html_body']
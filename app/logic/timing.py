@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+import collections
+import contextlib
+import contextvars
+import threading
+import time
+
+# The Spans of the request being served, None outside of requests
+_current = contextvars.ContextVar('spans', default=None)
+
+
+class Spans(object):
+    """Time spent in each named stage of one request, in milliseconds.
+
+    A stage entered several times (e.g. ``evalf`` for every numeric output)
+    accumulates its durations. Spans may be added from several threads.
+    ``labels`` hold facts about the request found along the way, like the
+    top-level function of the input.
+    """
+
+    def __init__(self):
+        self.durations = collections.OrderedDict()
+        self.labels = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0) + duration
+
+    def update(self, durations):
+        for name, duration in durations.items():
+            self.add(name, duration)
+
+    def as_dict(self):
+        with self._lock:
+            return {name: round(duration, 2)
+                    for name, duration in self.durations.items()}
+
+    def header(self):
+        """Format the spans as a ``Server-Timing`` header value."""
+        with self._lock:
+            return ', '.join(f'{name};dur={duration:.1f}'
+                             for name, duration in self.durations.items())
+
+
+def collect():
+    """Start collecting spans in the current context.
+
+    Returns the new :class:`Spans` and a token to pass to :func:`stop`.
+    """
+    spans = Spans()
+    return spans, activate(spans)
+
+
+def activate(spans):
+    """Collect into existing ``spans`` again, e.g. while a streaming
+    response is generated; returns a token to pass to :func:`stop`."""
+    return _current.set(spans)
+
+
+def stop(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time the enclosed block as stage ``name`` of the current request.
+
+    Outside of :func:`collect` this only costs a context variable lookup.
+    """
+    spans = _current.get()
+    if spans is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.add(name, (time.perf_counter() - start) * 1000)
+
+
+def label(name, value):
+    """Label the current request, e.g. with the function it calls."""
+    spans = _current.get()
+    if spans is not None:
+        spans.labels[name] = value
+
+
+def record(durations, labels=None):
+    """Add spans and labels from elsewhere, e.g. a worker process."""
+    spans = _current.get()
+    if spans is not None:
+        if durations:
+            spans.update(durations)
+        if labels:
+            spans.labels.update(labels)
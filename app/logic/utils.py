@@ -25,10 +25,42 @@ OTHER_SYMPY_FUNCTIONS = ('sqrt',)
 Arguments = collections.namedtuple('Arguments', 'function args kwargs')
 
 
+class Namespace(dict):
+    """Namespace layered over a shared, read-only base namespace.
+
+    Lookups that miss the namespace itself fall through to ``base``, while
+    assignments only ever touch the layer, so many evaluations can share one
+    base without seeing each other's variables.
+
+    Note that Python only consults ``__missing__`` for a dict subclass when
+    it is used as the *locals* mapping, so code must be executed with the
+    namespace as both globals and locals.
+    """
+
+    def __init__(self, base, *args, **kwargs):
+        super(Namespace, self).__init__(*args, **kwargs)
+        self.base = base
+
+    def __missing__(self, key):
+        return self.base[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.base
+
+    def get(self, key, default=None):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self.base.get(key, default)
+
+
 class Eval(object):
     def __init__(self, namespace={}):
         self._namespace = namespace
 
+    @property
+    def namespace(self):
+        return self._namespace
+
     def get(self, name):
         return self._namespace.get(name)
 
@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+import logging
+import time
+
+from .batch import evaluate_card
+
+# Seconds a warmup may spend evaluating its corpus. A card that is running
+# when the budget runs out is finished, so warmup can overrun by one card.
+WARMUP_BUDGET = 20
+
+# Modules the cards import on first use (see resultsets.py)
+CARD_MODULES = [
+    'docutils.core',
+    'app.logic.diffsteps',
+    'app.logic.intsteps',
+]
+
+
+def example_inputs(examples):
+    """Flatten the categories of ``EXAMPLES`` into a list of inputs."""
+    inputs = []
+    for category in examples:
+        for subcategory in category[1]:
+            for example in subcategory[1]:
+                if isinstance(example, tuple):
+                    inputs.append(example[1])
+                else:
+                    inputs.append(example)
+    return inputs
+
+
+def import_card_modules():
+    for module in CARD_MODULES:
+        __import__(module)
+
+
+def warmup(gamma, corpus, budget=WARMUP_BUDGET, cards=True,
+           clock=time.monotonic):
+    """Prime the parser, printers and SymPy's caches by evaluating a corpus.
+
+    Each input goes through ``gamma.eval`` and, with ``cards``, through its
+    cards, until ``budget`` seconds have passed. Returns a report of what
+    was evaluated and how long it took.
+    """
+    start = clock()
+    import_card_modules()
+    report = {
+        'inputs': 0,
+        'cards': 0,
+        'errors': 0,
+        'complete': True,
+    }
+
+    def remaining():
+        return budget - (clock() - start)
+
+    for expression in corpus:
+        if remaining() <= 0:
+            report['complete'] = False
+            break
+        result = gamma.eval(expression) or []
+        report['inputs'] += 1
+        report['errors'] += sum(1 for card in result
+                                if 'error' in card or 'exception_info' in card)
+        for card in result:
+            if not cards or 'card' not in card:
+                continue
+            if remaining() <= 0:
+                report['complete'] = False
+                break
+            output = evaluate_card(gamma, card, expression)
+            report['cards'] += 1
+            if 'error' in output:
+                report['errors'] += 1
+
+    report['elapsed'] = round(clock() - start, 3)
+    logging.info(f"Warmed up in {report['elapsed']}s: {report['inputs']} "
+                 f"inputs, {report['cards']} cards, {report['errors']} errors"
+                 f"{'' if report['complete'] else ' (budget exhausted)'}")
+    return report
@@ -0,0 +1,429 @@
+from __future__ import absolute_import
+import atexit
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from app import settings
+from app.logic import timing
+from app.logic.executor import ComputationTimeout
+from app.logic.resultsets import all_cards
+
+# Upper bounds of the histogram buckets: seconds for latencies, bytes for
+# response sizes and memory (64KB to 1GB)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   25)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+MEMORY_BUCKETS = tuple(2 ** power for power in range(16, 32, 2))
+
+# Seconds between snapshots of a process's metrics
+SNAPSHOT_INTERVAL = 15
+
+# Where the snapshots of processes that exited are merged, and the lock file
+# serializing that with reading the snapshots
+COMPACTED = 'metrics.compacted.json'
+LOCK = 'metrics.lock'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        # label values -> count
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        return value if total is None else total + value
+
+    def render(self, values):
+        for key, value in sorted(values.items()):
+            yield (f'{self.name}{_format_labels(self.labels, key)} '
+                   f'{_format_number(value)}')
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # per-bucket counts (the last for +Inf), sum
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            index = 0
+            while index < len(self.buckets) and value > self.buckets[index]:
+                index += 1
+            entry[0][index] += 1
+            entry[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(counts), total]]
+                    for key, (counts, total) in self._values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        if total is None:
+            return [list(value[0]), value[1]]
+        return [[a + b for a, b in zip(total[0], value[0])],
+                total[1] + value[1]]
+
+    def render(self, values):
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key,
+                                        ('le', _format_number(bound)))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, key)
+            yield f'{self.name}_sum{labels} {_format_number(total)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Registry(object):
+    """Metrics of this process, exported in the Prometheus text format.
+
+    Metrics are safe to update from several threads. To cover every process
+    serving the app, give a ``directory`` shared by them: each process
+    saves a snapshot of its metrics there (at most every ``interval``
+    seconds, from :meth:`maybe_save`), and :meth:`render` adds up the
+    snapshots of all of them. Snapshots of processes that exited are merged
+    into a single one as metrics are collected, so their counts aren't lost
+    and the snapshots read stay one per live process, plus one.
+    """
+
+    def __init__(self, directory=None, interval=SNAPSHOT_INTERVAL,
+                 clock=time.monotonic):
+        self.directory = directory
+        self.interval = interval
+        self.metrics = []
+        self._clock = clock
+        self._saved = clock()
+        self._lock = threading.Lock()
+        self._process = None
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def _path(self):
+        # identifies this process even after its pid is reused
+        if self._process is None or self._process[0] != os.getpid():
+            self._process = (os.getpid(), int(time.time() * 1000))
+        return os.path.join(self.directory, 'metrics.{}.{}.json'.format(
+            *self._process))
+
+    def save(self):
+        if not self.directory:
+            return
+        path = self._path()
+        temporary = path + '.tmp'
+        try:
+            with open(temporary, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temporary, path)
+        except OSError as e:
+            logging.error(f"Could not save metrics: {e}")
+
+    def maybe_save(self):
+        """Save a snapshot if the last one is ``interval`` seconds old."""
+        if not self.directory:
+            return
+        with self._lock:
+            now = self._clock()
+            if now - self._saved < self.interval:
+                return
+            self._saved = now
+        self.save()
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        """Hold the lock on the snapshots of :attr:`directory`: shared to
+        read them, exclusive to compact them. Yields False if ``operation``
+        includes ``LOCK_NB`` and the lock is taken."""
+        with open(os.path.join(self.directory, LOCK), 'a') as f:
+            try:
+                fcntl.flock(f, operation)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _exited(path):
+        """Whether the process that saved the snapshot at ``path`` exited."""
+        try:
+            pid = int(os.path.basename(path).split('.')[1])
+        except ValueError:
+            # the compacted snapshot
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            # it exists, but isn't ours to signal
+            pass
+        return False
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _merge(self, snapshots):
+        merged = {}
+        for metric in self.metrics:
+            values = merged[metric.name] = {}
+            for snapshot in snapshots:
+                for key, value in snapshot.get(metric.name, []):
+                    key = tuple(key)
+                    values[key] = metric.merge(values.get(key), value)
+        return merged
+
+    def compact(self):
+        """Merge the snapshots of the processes that exited into one.
+
+        Skipped while another process holds the lock, as it is compacting
+        or reading the snapshots.
+        """
+        with self._locked(fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+            if not locked:
+                return
+            exited = [path for path in glob.glob(
+                os.path.join(self.directory, 'metrics.*.json'))
+                if self._exited(path)]
+            if not exited:
+                return
+            compacted = os.path.join(self.directory, COMPACTED)
+            snapshots = [self._load(path) for path in [compacted] + exited]
+            merged = self._merge([snapshot for snapshot in snapshots
+                                  if snapshot is not None])
+            temporary = compacted + '.tmp'
+            try:
+                with open(temporary, 'w') as f:
+                    json.dump({name: [[list(key), value]
+                                      for key, value in values.items()]
+                               for name, values in merged.items()}, f)
+                os.replace(temporary, compacted)
+                for path in exited:
+                    os.remove(path)
+            except OSError as e:
+                logging.error(f"Could not compact metrics: {e}")
+
+    def collect(self):
+        """Add up the metrics of every process: ``{name: {labels: value}}``."""
+        snapshots = [self.snapshot()]
+        if self.directory:
+            self.compact()
+            own = self._path()
+            with self._locked(fcntl.LOCK_SH):
+                for path in glob.glob(os.path.join(self.directory,
+                                                   'metrics.*.json')):
+                    if path != own:
+                        snapshot = self._load(path)
+                        if snapshot is not None:
+                            snapshots.append(snapshot)
+        return self._merge(snapshots)
+
+    def render(self, merged=None):
+        """Format the metrics of every process (or ``merged``, as returned
+        by :meth:`collect`) in the Prometheus text format."""
+        if merged is None:
+            merged = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render(merged[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+
+def render():
+    """The app's metrics, with the hit ratio of each cache derived from
+    its lookups."""
+    merged = registry.collect()
+    lines = ['# HELP gamma_cache_hit_ratio Share of the lookups in each '
+             'cache that were hits.',
+             '# TYPE gamma_cache_hit_ratio gauge']
+    lookups = {}
+    for (cache, result), count in merged[cache_lookups.name].items():
+        hits, total = lookups.get(cache, (0, 0))
+        lookups[cache] = (hits + (count if result == 'hit' else 0),
+                          total + count)
+    for cache, (hits, total) in sorted(lookups.items()):
+        lines.append(f'gamma_cache_hit_ratio'
+                     f'{_format_labels(["cache"], [cache])} '
+                     f'{_format_number(hits / total)}')
+    return registry.render(merged) + '\n'.join(lines) + '\n'
+
+
+registry = Registry(settings.METRICS_DIR, settings.METRICS_SNAPSHOT_INTERVAL)
+atexit.register(registry.save)
+
+requests = registry.counter(
+    'gamma_requests_total', "HTTP requests served, by view and status.",
+    ['view', 'status'])
+request_duration = registry.histogram(
+    'gamma_request_duration_seconds', "Time taken to serve a request.",
+    ['view'])
+response_size = registry.histogram(
+    'gamma_response_size_bytes', "Size of response bodies.", ['view'],
+    SIZE_BUCKETS)
+evaluation_duration = registry.histogram(
+    'gamma_evaluation_duration_seconds',
+    "Time taken to evaluate an input, by its top-level function.",
+    ['function'])
+card_duration = registry.histogram(
+    'gamma_card_duration_seconds', "Time taken to evaluate a card.",
+    ['card'])
+timeouts = registry.counter(
+    'gamma_timeouts_total',
+    "Computations stopped at their deadline, by function or card.",
+    ['kind', 'name'])
+errors = registry.counter(
+    'gamma_errors_total',
+    "Computations that failed, by function or card.", ['kind', 'name'])
+card_memory_peak = registry.histogram(
+    'gamma_card_memory_peak_bytes',
+    "Peak memory allocated while evaluating a card.", ['card'],
+    MEMORY_BUCKETS)
+card_memory_retained = registry.histogram(
+    'gamma_card_memory_retained_bytes',
+    "Memory a card evaluation left allocated, with SymPy's caches.",
+    ['card'], MEMORY_BUCKETS)
+cache_lookups = registry.counter(
+    'gamma_cache_lookups_total',
+    "Lookups in the card cache and the evaluation store, by result.",
+    ['cache', 'result'])
+
+CACHES = ('card_cache', 'evaluation_store')
+
+
+class MeteredGamma(object):
+    """Wraps a SymPyGamma or EvaluationExecutor, recording the duration,
+    timeouts and errors of its evaluations and cards, their cache lookups
+    and the memory of cards in :data:`registry`."""
+
+    def __init__(self, gamma):
+        self.gamma = gamma
+
+    def __getattr__(self, name):
+        return getattr(self.gamma, name)
+
+    def _call(self, method, *args, **kwargs):
+        """Call ``method`` with its own spans, so concurrent calls don't mix
+        their labels, then add them to the request's. Returns the result
+        and the spans."""
+        spans, token = timing.collect()
+        try:
+            return method(*args, **kwargs), spans
+        finally:
+            timing.stop(token)
+            timing.record(dict(spans.durations), spans.labels)
+            for cache in CACHES:
+                if cache in spans.labels:
+                    cache_lookups.inc(cache=cache,
+                                      result=spans.labels[cache])
+
+    def eval(self, s):
+        start = time.perf_counter()
+        result, spans = self._call(self.gamma.eval, s)
+        function = spans.labels.get('function', 'none')
+        evaluation_duration.observe(time.perf_counter() - start,
+                                    function=function)
+        for card in result or []:
+            error = card.get('error')
+            if error and 'timed out' in error:
+                timeouts.inc(kind='eval', name=function)
+            elif error or card.get('exception_info'):
+                errors.inc(kind='eval', name=function)
+        return result
+
+    def eval_card(self, card_name, *args, **kwargs):
+        name = card_name if card_name in all_cards else 'unknown'
+        start = time.perf_counter()
+        try:
+            result, spans = self._call(self.gamma.eval_card, card_name,
+                                       *args, **kwargs)
+            # with MEMORY_ACCOUNTING, for cards that weren't cached
+            if 'memory_peak' in spans.labels:
+                card_memory_peak.observe(spans.labels['memory_peak'],
+                                         card=name)
+                card_memory_retained.observe(
+                    max(spans.labels['memory_retained'], 0), card=name)
+            return result
+        except ComputationTimeout:
+            timeouts.inc(kind='card', name=name)
+            raise
+        except Exception:
+            errors.inc(kind='card', name=name)
+            raise
+        finally:
+            card_duration.observe(time.perf_counter() - start, card=name)
@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+import json
+import logging
+import time
+
+from app import metrics, settings
+from app.logic import timing
+
+
+class ServerTimingMiddleware(object):
+    """Times the stages of each request (see :mod:`app.logic.timing`).
+
+    The stages are sent in a ``Server-Timing`` header, with the time taken
+    to produce the response as ``total``, and logged as one JSON line per
+    request. Streaming responses are logged once the stream ends, but their
+    header can only hold the stages timed before it started.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.SERVER_TIMING:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        spans, token = timing.collect()
+        try:
+            response = self.get_response(request)
+        finally:
+            timing.stop(token)
+        spans.add('total', (time.perf_counter() - start) * 1000)
+        response['Server-Timing'] = spans.header()
+
+        if response.streaming:
+            response.streaming_content = self._stream(
+                response.streaming_content, spans, request, response, start)
+        else:
+            self.log(spans, request, response, start)
+        return response
+
+    def _stream(self, content, spans, request, response, start):
+        try:
+            while True:
+                token = timing.activate(spans)
+                try:
+                    chunk = next(content)
+                except StopIteration:
+                    return
+                finally:
+                    timing.stop(token)
+                yield chunk
+        finally:
+            self.log(spans, request, response, start)
+
+    def log(self, spans, request, response, start):
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration': round((time.perf_counter() - start) * 1000, 2),
+            'spans': spans.as_dict(),
+        }
+        logging.info(f"Request timing: {json.dumps(record)}")
+
+
+class MetricsMiddleware(object):
+    """Counts requests and records their latency and response size per
+    view (see :mod:`app.metrics`). Streaming responses are measured once
+    the stream ends."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        view = match.func.__name__ if match else 'none'
+        if response.streaming:
+            response.streaming_content = self._stream(
+                response.streaming_content, view, response, start)
+        else:
+            self.record(view, response, len(response.content), start)
+        return response
+
+    def _stream(self, content, view, response, start):
+        size = 0
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.record(view, response, size, start)
+
+    def record(self, view, response, size, start):
+        metrics.requests.inc(view=view, status=response.status_code)
+        metrics.request_duration.observe(time.perf_counter() - start,
+                                         view=view)
+        metrics.response_size.observe(size, view=view)
+        metrics.registry.maybe_save()
@@ -1,10 +1,175 @@
 from __future__ import absolute_import
+import abc
 import six
+import datetime
+import hashlib
 import os
+import sqlite3
+import threading
 # https://github.com/googleapis/python-ndb/issues/249#issuecomment-560957294
 six.moves.reload_module(six)
 
-from google.cloud import datastore
+_datastore_client = None
+_query_store = None
+_query_store_lock = threading.Lock()
 
 
-datastore_client = datastore.Client(project=os.environ['PROJECT_ID'])
+def get_datastore_client():
+    """Return the Datastore client, creating it on first use.
+
+    Importing google.cloud.datastore and building the client are slow, and
+    most requests never touch the Datastore, so they are kept off the
+    import path of a cold start.
+    """
+    global _datastore_client
+    if _datastore_client is None:
+        from google.cloud import datastore
+        _datastore_client = datastore.Client(project=os.environ['PROJECT_ID'])
+    return _datastore_client
+
+
+def __getattr__(name):
+    if name == 'datastore_client':
+        return get_datastore_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def normalize_query(text):
+    """Inputs that only differ in whitespace are the same query."""
+    return ' '.join(text.split())
+
+
+def query_key_name(text):
+    return hashlib.sha256(normalize_query(text).encode('utf-8')).hexdigest()
+
+
+def query_entity(text, date=None, client=None):
+    """Build the ``Query`` entity logging ``text``.
+
+    Its key is derived from the normalized text, so putting it is an
+    idempotent upsert: logging the same input again only updates ``date``.
+    """
+    from google.cloud import datastore
+
+    client = client or get_datastore_client()
+    entity = datastore.Entity(key=client.key('Query', query_key_name(text)))
+    entity.update({
+        "text": text,
+        "user_id": None,
+        "date": date or datetime.datetime.utcnow(),
+    })
+    return entity
+
+
+class QueryStore(abc.ABC):
+    """Where logged queries are kept.
+
+    ``put_queries`` upserts ``(key_name, text, date)`` tuples, keyed by
+    :func:`query_key_name`, in one batch; ``exists`` looks an input up.
+    """
+
+    @abc.abstractmethod
+    def put_queries(self, queries):
+        pass
+
+    @abc.abstractmethod
+    def exists(self, text):
+        pass
+
+
+class DatastoreQueryStore(QueryStore):
+    """``Query`` entities in the Datastore (or a client with its interface)."""
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or get_datastore_client()
+
+    def put_queries(self, queries):
+        client = self.client
+        client.put_multi([query_entity(text, date, client)
+                          for _, text, date in queries])
+
+    def exists(self, text):
+        client = self.client
+        key = client.key('Query', query_key_name(text))
+        return client.get(key) is not None
+
+
+class SQLiteQueryStore(QueryStore):
+    """Queries in a local SQLite database, for development and benchmarks.
+
+    The database is in WAL mode, so the query log's writes don't block
+    lookups, and batches are inserted with a single ``executemany``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS query ('
+                'key TEXT PRIMARY KEY, text TEXT, user_id TEXT, date TEXT)')
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def put_queries(self, queries):
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO query (key, text, user_id, date) '
+                'VALUES (?, ?, NULL, ?)',
+                [(key_name, text, date.isoformat())
+                 for key_name, text, date in queries])
+
+    def exists(self, text):
+        row = self._connection().execute(
+            'SELECT 1 FROM query WHERE key = ?',
+            (query_key_name(text),)).fetchone()
+        return row is not None
+
+
+def get_query_store():
+    """Return the query store ``settings.QUERY_STORE`` selects."""
+    global _query_store
+    from app import settings
+
+    with _query_store_lock:
+        if _query_store is None:
+            if settings.QUERY_STORE == 'sqlite':
+                _query_store = SQLiteQueryStore(settings.QUERY_STORE_PATH)
+            elif settings.QUERY_STORE == 'datastore':
+                _query_store = DatastoreQueryStore()
+            else:
+                raise ValueError(
+                    f"Unknown query store {settings.QUERY_STORE!r}")
+    return _query_store
+
+
+class LocalDatastore(object):
+    """Stand-in for the parts of ``datastore.Client`` the query store uses."""
+
+    def __init__(self, project='local'):
+        self.project = project
+        self.entities = {}
+
+    def key(self, *path):
+        from google.cloud import datastore
+
+        return datastore.Key(*path, project=self.project)
+
+    def put_multi(self, entities):
+        for entity in entities:
+            self.entities[entity.key] = entity
+
+    def get(self, key):
+        return self.entities.get(key)
@@ -0,0 +1,159 @@
+from __future__ import absolute_import
+import collections
+import datetime
+import logging
+import threading
+import time
+
+from . import models
+
+# Distinct inputs waiting to be written, entities per put_multi (the
+# Datastore accepts at most 500), and seconds an input may wait before
+# the batch it is in is written anyway
+QUEUE_SIZE = 5000
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 5
+
+
+class QueryLog(object):
+    """Write-behind logger of queries.
+
+    :meth:`add` only records the input in a buffer; a background thread
+    writes the buffer in batches once it holds ``batch_size`` inputs or its
+    oldest input has waited ``flush_interval`` seconds. An input
+    added again while still buffered is only written once, with its latest
+    date. :meth:`close` writes what is left, and is registered to run at
+    exit.
+
+    With a ``seen`` filter (a :class:`app.sketches.SeenFilter`), inputs
+    already written by this process are skipped without any write, and
+    counted in ``skipped``. Inputs are marked seen once written, so dropped
+    inputs are tried again.
+
+    Drop policy: the query log is best-effort. When ``maxsize`` distinct
+    inputs are already waiting (the store is slow or down), new inputs are
+    dropped rather than blocking requests or growing without bound, and a
+    batch whose write fails is dropped rather than retried. Both are counted
+    in ``dropped``.
+
+    ``store`` is the :class:`app.models.QueryStore` written to; by default
+    ``models.get_query_store()`` on the first write.
+    """
+
+    def __init__(self, store=None, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, seen=None,
+                 clock=time.monotonic):
+        self.store = store
+        self.seen = seen
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.skipped = 0
+        self._clock = clock
+        # key name -> (key name, text, date)
+        self._pending = collections.OrderedDict()
+        self._oldest = None
+        self._changed = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def add(self, text):
+        """Queue ``text`` to be logged; return False if it was dropped."""
+        key_name = models.query_key_name(text)
+        if self.seen is not None and key_name in self.seen:
+            with self._changed:
+                self.skipped += 1
+            return True
+        with self._changed:
+            if self._closed:
+                return False
+            if key_name not in self._pending and \
+                    len(self._pending) >= self.maxsize:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logging.warning(f"Query log full, dropped {self.dropped} "
+                                    f"inputs so far")
+                return False
+            self._pending.pop(key_name, None)
+            self._pending[key_name] = (key_name, text,
+                                       datetime.datetime.utcnow())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='query-log', daemon=True)
+                self._thread.start()
+            if self._oldest is None:
+                # the thread sleeps until there is something to write
+                self._oldest = self._clock()
+                self._changed.notify()
+            elif len(self._pending) >= self.batch_size:
+                self._changed.notify()
+        return True
+
+    def _wait_time(self):
+        """Seconds until the buffer is due to be written, None if empty."""
+        if len(self._pending) >= self.batch_size:
+            return 0
+        if self._oldest is None:
+            return None
+        return max(self._oldest + self.flush_interval - self._clock(), 0)
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._closed:
+                    wait = self._wait_time()
+                    if wait == 0:
+                        break
+                    self._changed.wait(wait)
+                if self._closed:
+                    return
+            self.flush()
+
+    def _take(self):
+        with self._changed:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False)[1])
+            self._oldest = self._clock() if self._pending else None
+            return batch
+
+    def flush(self):
+        """Write everything buffered now, in batches."""
+        batch = self._take()
+        while batch:
+            self._write(batch)
+            batch = self._take()
+
+    def _write(self, batch):
+        try:
+            store = self.store or models.get_query_store()
+            store.put_queries(batch)
+        except Exception as e:
+            logging.error(f"Could not log {len(batch)} queries: {e}")
+            with self._changed:
+                self.dropped += len(batch)
+        else:
+            with self._changed:
+                self.written += len(batch)
+            if self.seen is not None:
+                for key_name, _, _ in batch:
+                    self.seen.add(key_name)
+
+    def close(self, timeout=10):
+        """Stop the background thread and write what is left."""
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        self.flush()
+        logging.info(f"Query log closed: {self.written} written, "
+                     f"{self.skipped} skipped, {self.dropped} dropped")
+        if self.seen is not None:
+            logging.info(f"Seen-query filter: {self.seen.stats()}")
+
+    def __len__(self):
+        return len(self._pending)
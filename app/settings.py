@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import tempfile
 
 from django.core.management.utils import get_random_secret_key
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -47,6 +48,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.middleware.ServerTimingMiddleware',
+    'app.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -155,3 +158,127 @@ LOGGING = {
         },
     },
 }
+
+# Evaluation
+
+# Number of pre-started worker processes that run SymPy computations (0 runs
+# them in the request thread), and the wall-clock deadline in seconds of
+# each kind of task. A worker that misses its deadline is killed. App Engine
+# kills requests after 30 seconds, so these leave time to render the error.
+EVALUATION_WORKERS = int(os.environ.get('GAMMA_EVALUATION_WORKERS', 2))
+EVALUATION_DEADLINES = {
+    'eval': 20,
+    'eval_card': 25,
+    'get_card_info': 10,
+    'profile': 30,
+    'memory_sites': 30,
+}
+
+# Memory ceilings of the evaluation workers, in megabytes. A worker's address
+# space can't grow more than EVALUATION_MEMORY_LIMIT beyond its size when it
+# starts (0 for no limit), and a worker is recycled after EVALUATION_MAX_TASKS
+# tasks or once its resident memory exceeds EVALUATION_RECYCLE_RSS. Workers
+# start at about 80MB resident, mostly pages shared with the process they
+# are forked from. The defaults fit the 384MB of the default F1 instance
+# class: the web process (~90MB) and two workers at their ceiling, so a
+# worker fails or retires before App Engine kills the instance. The batch
+# workers, once started, add to that. Resize them with the instance class.
+EVALUATION_MEMORY_LIMIT = int(os.environ.get('GAMMA_EVALUATION_MEMORY_LIMIT', 96))
+EVALUATION_RECYCLE_RSS = int(os.environ.get('GAMMA_EVALUATION_RECYCLE_RSS', 160))
+EVALUATION_MAX_TASKS = int(os.environ.get('GAMMA_EVALUATION_MAX_TASKS', 500))
+
+# Trace the allocations of the evaluation workers with tracemalloc, to
+# export the peak and retained memory of each card evaluation in /metrics.
+# Tracing slows computations down noticeably.
+MEMORY_ACCOUNTING = os.environ.get('GAMMA_MEMORY_ACCOUNTING', '0') not in ('', '0', 'false')
+
+# Batch API: number of workers in the separate pool that serves /api/batch
+# (0 evaluates batches in the request thread), and the largest batch.
+BATCH_EVALUATION_WORKERS = int(os.environ.get('GAMMA_BATCH_EVALUATION_WORKERS', 2))
+BATCH_MAX_INPUTS = int(os.environ.get('GAMMA_BATCH_MAX_INPUTS', 1000))
+
+# Seconds API clients and intermediate caches may reuse an /api/input result
+# before revalidating it with its ETag.
+API_CACHE_MAX_AGE = int(os.environ.get('GAMMA_API_CACHE_MAX_AGE', 60 * 60))
+
+# Time the stages of every request (parsing, evaluation, each card, template
+# rendering, ...) and report them in a Server-Timing header and a log line.
+SERVER_TIMING = os.environ.get('GAMMA_SERVER_TIMING', '1') not in ('', '0', 'false')
+
+# Directory shared by the processes serving the app, where each saves a
+# snapshot of its metrics every METRICS_SNAPSHOT_INTERVAL seconds so that
+# /metrics covers all of them. Unset, /metrics covers its own process only.
+METRICS_DIR = os.environ.get('GAMMA_METRICS_DIR')
+METRICS_SNAPSHOT_INTERVAL = float(os.environ.get('GAMMA_METRICS_SNAPSHOT_INTERVAL', 15))
+
+# Evaluate the cards of a result while rendering /input (eager=1/0 in the
+# query string overrides this), spending at most EAGER_CARD_BUDGET seconds
+# on them altogether. Cards that miss the budget are cancelled and load from
+# /card/ as usual, computed from scratch, so pages that have such cards wait
+# up to EAGER_CARD_BUDGET seconds longer for nothing. Off by default.
+EAGER_CARDS = os.environ.get('GAMMA_EAGER_CARDS', '0') not in ('', '0', 'false')
+EAGER_CARD_BUDGET = float(os.environ.get('GAMMA_EAGER_CARD_BUDGET', 3))
+
+# Stream the /input page, flushing each card as it is evaluated (stream=1/0
+# in the query string overrides this). Cards that take longer than
+# STREAM_CARD_BUDGET seconds are sent as placeholders that load from /card/.
+# Off by default: App Engine standard buffers whole responses, so there the
+# page arrives all at once, after its slowest card.
+STREAM_RESULTS = os.environ.get('GAMMA_STREAM_RESULTS', '0') not in ('', '0', 'false')
+STREAM_CARD_BUDGET = float(os.environ.get('GAMMA_STREAM_CARD_BUDGET', 15))
+
+# Load the cards of a result page over one Server-Sent Events connection
+# (/card_events) instead of one /card/ request each. Cards still running
+# after STREAM_CARD_BUDGET seconds are cancelled and load from /card/. Off by
+# default: App Engine standard buffers whole responses, so there no event
+# reaches the page before the last card finishes or the budget runs out.
+CARD_EVENTS = os.environ.get('GAMMA_CARD_EVENTS', '0') not in ('', '0', 'false')
+# Seconds between progress events on /card_events while cards are running.
+CARD_EVENTS_HEARTBEAT = float(os.environ.get('GAMMA_CARD_EVENTS_HEARTBEAT', 2))
+
+# Warmup (/_ah/warmup): seconds to spend evaluating the corpus, and a file
+# with one input per line to use instead of the examples.
+WARMUP_BUDGET = float(os.environ.get('GAMMA_WARMUP_BUDGET', 20))
+WARMUP_CORPUS = os.environ.get('GAMMA_WARMUP_CORPUS')
+
+# Query log write-behind queue: distinct inputs buffered at most (more are
+# dropped), inputs per batch write, and seconds before a partial batch is
+# written.
+QUERY_LOG_QUEUE_SIZE = int(os.environ.get('GAMMA_QUERY_LOG_QUEUE_SIZE', 5000))
+QUERY_LOG_BATCH_SIZE = int(os.environ.get('GAMMA_QUERY_LOG_BATCH_SIZE', 200))
+QUERY_LOG_FLUSH_INTERVAL = float(os.environ.get('GAMMA_QUERY_LOG_FLUSH_INTERVAL', 5))
+
+# Seen-query filter in front of the query log: inputs the Bloom filter is
+# sized for (it is cleared once full), its false-positive rate at that size,
+# and recently logged inputs remembered exactly.
+SEEN_FILTER_CAPACITY = int(os.environ.get('GAMMA_SEEN_FILTER_CAPACITY', 100000))
+SEEN_FILTER_ERROR_RATE = float(os.environ.get('GAMMA_SEEN_FILTER_ERROR_RATE', 0.001))
+SEEN_FILTER_LRU_SIZE = int(os.environ.get('GAMMA_SEEN_FILTER_LRU_SIZE', 1000))
+
+# Popularity tracking of inputs and cards: count-min sketch dimensions, keys
+# kept per kind, and seconds between merges into the popularity record,
+# which is saved as JSON to POPULARITY_PATH if set (warmup reads it).
+POPULARITY_WIDTH = int(os.environ.get('GAMMA_POPULARITY_WIDTH', 2048))
+POPULARITY_DEPTH = int(os.environ.get('GAMMA_POPULARITY_DEPTH', 4))
+POPULARITY_TOP_K = int(os.environ.get('GAMMA_POPULARITY_TOP_K', 100))
+POPULARITY_MERGE_INTERVAL = float(os.environ.get('GAMMA_POPULARITY_MERGE_INTERVAL', 5 * 60))
+POPULARITY_PATH = os.environ.get('GAMMA_POPULARITY_PATH')
+
+# Where the query log is stored: 'datastore', or 'sqlite' for a local
+# database at QUERY_STORE_PATH that needs no network services.
+QUERY_STORE = os.environ.get('GAMMA_QUERY_STORE', 'datastore')
+QUERY_STORE_PATH = os.environ.get('GAMMA_QUERY_STORE_PATH', 'queries.sqlite3')
+
+# Token that unlocks the /admin/ endpoints, sent in an X-Gamma-Admin-Token
+# header (a token in the URL is not accepted). Unset, they are disabled.
+ADMIN_TOKEN = os.environ.get('GAMMA_ADMIN_TOKEN')
+
+# Slow-query log: evaluations and cards taking SLOW_QUERY_THRESHOLD seconds
+# or more (0 disables it) are recorded in SLOW_QUERY_DIR, which keeps the
+# last SLOW_QUERY_LOG_SIZE of them, and profiled again in the background (on
+# the batch workers, if there are any) for at most SLOW_QUERY_PROFILE_LIMIT
+# seconds (0 skips profiling). Browse them at /admin/slow_queries.
+SLOW_QUERY_THRESHOLD = float(os.environ.get('GAMMA_SLOW_QUERY_THRESHOLD', 5))
+SLOW_QUERY_DIR = os.environ.get('GAMMA_SLOW_QUERY_DIR', os.path.join(tempfile.gettempdir(), 'gamma-slow-queries'))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('GAMMA_SLOW_QUERY_LOG_SIZE', 100))
+SLOW_QUERY_PROFILE_LIMIT = float(os.environ.get('GAMMA_SLOW_QUERY_PROFILE_LIMIT', 15))
@@ -0,0 +1,331 @@
+from __future__ import absolute_import
+import array
+import collections
+import contextlib
+import fcntl
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+# Defaults of the seen-query filter: inputs the Bloom filter is sized for,
+# its false-positive rate at that size, and inputs remembered exactly
+SEEN_CAPACITY = 100000
+SEEN_ERROR_RATE = 0.001
+SEEN_LRU_SIZE = 1000
+
+# Defaults of the popularity tracker: count-min sketch dimensions, keys
+# kept per kind, seconds between merges into the record, and the weight of
+# the record's previous counts at each merge
+POPULARITY_WIDTH = 2048
+POPULARITY_DEPTH = 4
+POPULARITY_TOP_K = 100
+POPULARITY_MERGE_INTERVAL = 5 * 60
+POPULARITY_DECAY = 0.5
+
+
+def _hashes(key, count, size):
+    # double hashing (Kirsch & Mitzenmacher): two 64-bit halves of one
+    # digest give all ``count`` positions
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % size for i in range(count)]
+
+
+class BloomFilter(object):
+    """Set membership with false positives but no false negatives.
+
+    Sized for ``capacity`` keys at a false-positive rate of ``error_rate``;
+    memory use is fixed at about ``-capacity * ln(error_rate) / ln(2)**2``
+    bits whatever is added.
+    """
+
+    def __init__(self, capacity=SEEN_CAPACITY, error_rate=SEEN_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))),
+                              1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def add(self, key):
+        new = False
+        for position in _hashes(key, self.hash_count, self.size):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                new = True
+                self._bits[byte] |= 1 << bit
+        if new:
+            self.count += 1
+
+    def __contains__(self, key):
+        for position in _hashes(key, self.hash_count, self.size):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def false_positive_rate(self):
+        """Estimate the current false-positive rate from the keys added."""
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) \
+            ** self.hash_count
+
+    def clear(self):
+        self.count = 0
+        self._bits = bytearray(len(self._bits))
+
+
+class SeenFilter(object):
+    """Remembers which keys were already seen, in bounded memory.
+
+    The most recently seen keys are kept exactly in an LRU, all others in a
+    :class:`BloomFilter`, so a key may wrongly be reported as seen (at about
+    the rate :meth:`stats` estimates) but never the other way round. Once the
+    Bloom filter holds its capacity it is cleared, which keeps the rate
+    bounded; the keys in the LRU survive that.
+    """
+
+    def __init__(self, capacity=SEEN_CAPACITY, error_rate=SEEN_ERROR_RATE,
+                 lru_size=SEEN_LRU_SIZE):
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.lru_size = lru_size
+        self.resets = 0
+        self._recent = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                return True
+            return key in self.bloom
+
+    def add(self, key):
+        with self._lock:
+            self._recent[key] = True
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.lru_size:
+                self._recent.popitem(last=False)
+            if self.bloom.count >= self.bloom.capacity:
+                self.bloom.clear()
+                self.resets += 1
+            self.bloom.add(key)
+
+    def stats(self):
+        return {
+            'keys': self.bloom.count,
+            'capacity': self.bloom.capacity,
+            'bits': self.bloom.size,
+            'hashes': self.bloom.hash_count,
+            'false_positive_rate': self.bloom.false_positive_rate(),
+            'resets': self.resets,
+        }
+
+
+class CountMinSketch(object):
+    """Approximate counts of keys in ``width * depth`` counters.
+
+    Estimates never undercount; they overcount by at most ``2 / width`` of
+    the total count with probability ``1 - 2 ** -depth``.
+    """
+
+    def __init__(self, width=POPULARITY_WIDTH, depth=POPULARITY_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._counters = array.array('Q', bytes(8 * width * depth))
+
+    def _cells(self, key):
+        return [row * self.width + column for row, column
+                in enumerate(_hashes(key, self.depth, self.width))]
+
+    def add(self, key, count=1):
+        """Count ``key`` and return its new estimate."""
+        self.total += count
+        estimate = None
+        for cell in self._cells(key):
+            self._counters[cell] += count
+            if estimate is None or self._counters[cell] < estimate:
+                estimate = self._counters[cell]
+        return estimate
+
+    def estimate(self, key):
+        return min(self._counters[cell] for cell in self._cells(key))
+
+
+class TopK(object):
+    """The ``k`` keys with the largest counts, kept in a min-heap."""
+
+    def __init__(self, k=POPULARITY_TOP_K):
+        self.k = k
+        self._counts = {}
+        # [count, key] entries; stale ones are skipped and compacted
+        self._heap = []
+
+    def update(self, key, count):
+        """Offer ``key`` with its (increased) ``count``."""
+        if key not in self._counts:
+            if len(self._counts) >= self.k:
+                if count <= self._min():
+                    return
+                self._counts.pop(heapq.heappop(self._heap)[1])
+        self._counts[key] = count
+        heapq.heappush(self._heap, [count, key])
+        if len(self._heap) > 4 * self.k:
+            self._heap = [[c, k] for k, c in self._counts.items()]
+            heapq.heapify(self._heap)
+
+    def _min(self):
+        while self._heap[0][0] != self._counts.get(self._heap[0][1]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
+
+    def items(self):
+        """``(key, count)`` pairs, most counted first."""
+        return sorted(self._counts.items(), key=lambda item: -item[1])
+
+
+class PopularityTracker(object):
+    """Tracks which inputs and cards are requested most.
+
+    Requests are counted per kind (``'input'``, ``'card'``) in a
+    :class:`CountMinSketch` with a :class:`TopK` of the heaviest keys, so
+    memory is bounded whatever the number of distinct queries. Every
+    ``merge_interval`` seconds the window's top keys are merged into
+    :attr:`record`, where older counts decay by ``decay`` once per interval,
+    and the window starts over. With ``path``, the record is kept there as
+    JSON and shared by the processes using it: each merges its window into
+    the file under a lock, and a new process (e.g. its warmup) can
+    :meth:`load` it. ``clock`` must then be the same for all of them, as
+    the default, the system's monotonic clock, is on one machine.
+    """
+
+    def __init__(self, width=POPULARITY_WIDTH, depth=POPULARITY_DEPTH,
+                 k=POPULARITY_TOP_K, merge_interval=POPULARITY_MERGE_INTERVAL,
+                 decay=POPULARITY_DECAY, path=None, clock=time.monotonic):
+        self.width = width
+        self.depth = depth
+        self.k = k
+        self.merge_interval = merge_interval
+        self.decay = decay
+        self.path = path
+        # kind -> {key: count}, the heaviest keys of previous windows
+        self.record = {}
+        self._clock = clock
+        self._windows = {}
+        self._merged = clock()
+        # when the record's counts were last decayed
+        self._decayed = self._merged
+        self._lock = threading.Lock()
+
+    def add(self, kind, key):
+        with self._lock:
+            if kind not in self._windows:
+                self._windows[kind] = (CountMinSketch(self.width, self.depth),
+                                       TopK(self.k))
+            sketch, top = self._windows[kind]
+            top.update(key, sketch.add(key))
+            now = self._clock()
+            due = now - self._merged >= self.merge_interval
+            if due:
+                # claim this merge so concurrent requests don't repeat it
+                self._merged = now
+        if due:
+            self.merge()
+
+    def _combine(self, record, decayed, windows, now):
+        """Decay ``record`` once per merge interval since ``decayed``, add
+        the top keys of ``windows``; return the new record and decay time."""
+        if self.merge_interval > 0:
+            intervals = int((now - decayed) // self.merge_interval)
+            decayed += intervals * self.merge_interval
+        else:
+            intervals, decayed = 1, now
+        factor = self.decay ** intervals
+        combined = {}
+        for kind in set(record) | set(windows):
+            counts = {key: count * factor for key, count
+                      in record.get(kind, {}).items()}
+            if kind in windows:
+                for key, count in windows[kind][1].items():
+                    counts[key] = counts.get(key, 0) + count
+            combined[kind] = dict(sorted(
+                counts.items(), key=lambda item: -item[1])[:self.k])
+        return combined, decayed
+
+    def merge(self):
+        with self._lock:
+            windows, self._windows = self._windows, {}
+            now = self._clock()
+            if not self.path:
+                self.record, self._decayed = self._combine(
+                    self.record, self._decayed, windows, now)
+                return
+        try:
+            with self._locked():
+                saved = self._read()
+                if saved is None:
+                    saved = {'record': {}, 'decayed': now}
+                record, decayed = self._combine(
+                    saved['record'], saved['decayed'], windows, now)
+                self._write({'record': record, 'decayed': decayed})
+        except OSError as e:
+            logging.error(f"Could not save popularity record: {e}")
+            with self._lock:
+                record, decayed = self._combine(self.record, self._decayed,
+                                                windows, now)
+        with self._lock:
+            self.record, self._decayed = record, decayed
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # serializes the merges of the processes sharing the record
+        with open(f'{self.path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            return {'record': saved['record'], 'decayed': saved['decayed']}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write(self, saved):
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(saved, f)
+        os.replace(temporary, self.path)
+
+    def load(self):
+        """Read back the record saved at ``path``, if there is one."""
+        if not self.path:
+            return
+        saved = self._read()
+        if saved is None:
+            return
+        with self._lock:
+            self.record, self._decayed = saved['record'], saved['decayed']
+
+    def popular(self, kind, n=None):
+        """The most requested keys of ``kind`` in the record, most first."""
+        with self._lock:
+            counts = self.record.get(kind, {})
+            keys = sorted(counts, key=lambda key: -counts[key])
+        return keys[:n]
+
+    def count(self, kind, key):
+        """Recorded (decayed) request count of a key, 0 if not popular."""
+        with self._lock:
+            return self.record.get(kind, {}).get(key, 0)
@@ -0,0 +1,264 @@
+from __future__ import absolute_import
+import contextlib
+import datetime
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from app.logic import timing
+
+# Seconds an evaluation or card may take before it is recorded as slow,
+# entries kept, and seconds a profiling re-run may take
+SLOW_QUERY_THRESHOLD = 5
+SLOW_QUERY_LOG_SIZE = 100
+PROFILE_LIMIT = 15
+
+# Slow queries waiting to be profiled; more are recorded unprofiled
+PROFILE_QUEUE_SIZE = 4
+
+
+class SlowQueryLog(object):
+    """Ring buffer of the last ``size`` slow queries, kept in ``directory``.
+
+    Entry ``n`` is stored in slot ``n % size`` (``entry.<slot>.json``, plus
+    ``profile.<slot>.prof`` once profiled), overwriting entry ``n - size``.
+    Several processes can share the directory; writes are serialized by a
+    lock file.
+    """
+
+    def __init__(self, directory, size=SLOW_QUERY_LOG_SIZE):
+        self.directory = directory
+        self.size = size
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path('lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write(self, name, data, mode='w'):
+        temporary = self._path(f'{name}.{os.getpid()}.tmp')
+        with open(temporary, mode) as f:
+            f.write(data)
+        os.replace(temporary, self._path(name))
+
+    def _read(self, slot):
+        try:
+            with open(self._path(f'entry.{slot}.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def add(self, entry):
+        """Store ``entry`` (a JSON-serializable dict); return its id."""
+        with self._locked():
+            try:
+                with open(self._path('next')) as f:
+                    entry_id = int(f.read())
+            except (OSError, ValueError):
+                entry_id = 0
+            slot = entry_id % self.size
+            entry = dict(entry, id=entry_id)
+            self._write(f'entry.{slot}.json', json.dumps(entry))
+            try:
+                os.remove(self._path(f'profile.{slot}.prof'))
+            except OSError:
+                pass
+            self._write('next', str(entry_id + 1))
+        return entry_id
+
+    def update(self, entry_id, dump=None, **fields):
+        """Add ``fields`` and a profile ``dump`` to an entry, unless it has
+        been overwritten since."""
+        slot = entry_id % self.size
+        with self._locked():
+            entry = self._read(slot)
+            if entry is None or entry['id'] != entry_id:
+                return False
+            if dump is not None:
+                self._write(f'profile.{slot}.prof', dump, 'wb')
+            entry.update(fields)
+            self._write(f'entry.{slot}.json', json.dumps(entry))
+        return True
+
+    def get(self, entry_id):
+        entry = self._read(entry_id % self.size)
+        if entry is None or entry['id'] != entry_id:
+            return None
+        return entry
+
+    def profile_path(self, entry_id):
+        """Path of the entry's profile dump, None if it has none."""
+        path = self._path(f'profile.{entry_id % self.size}.prof')
+        if self.get(entry_id) is None or not os.path.exists(path):
+            return None
+        return path
+
+    def entries(self):
+        """All entries, newest first."""
+        entries = [self._read(slot) for slot in range(self.size)]
+        return sorted((entry for entry in entries if entry is not None),
+                      key=lambda entry: -entry['id'])
+
+
+class SlowQueryRecorder(object):
+    """Records evaluations and cards slower than ``threshold`` seconds in
+    a :class:`SlowQueryLog`, with their stage timings.
+
+    Each recorded query is then computed again under cProfile, in the
+    background and bypassing the card cache, for at most ``profile_limit``
+    seconds (0 disables profiling), and the profile is added to its entry.
+    Re-runs go one at a time through the evaluator ``profiler()`` returns,
+    or the one that ran the query without ``profiler``. Queries that find
+    ``PROFILE_QUEUE_SIZE`` others waiting, or come after :meth:`stop`, are
+    left unprofiled.
+    """
+
+    def __init__(self, log, threshold=SLOW_QUERY_THRESHOLD,
+                 profile_limit=PROFILE_LIMIT, profiler=None):
+        self.log = log
+        self.threshold = threshold
+        self.profile_limit = profile_limit
+        self.profiler = profiler
+        self._queue = queue.Queue(PROFILE_QUEUE_SIZE)
+        self._thread = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def record(self, gamma, method, args, kwargs, details, duration, outcome):
+        """Record a call to ``gamma`` that took ``duration`` seconds, if
+        that is slow. ``details`` describe it (input, card, ...)."""
+        if duration < self.threshold:
+            return None
+        spans = timing.current()
+        entry = dict(details, **{
+            'time': datetime.datetime.utcnow().isoformat() + 'Z',
+            'method': method,
+            'duration': round(duration, 3),
+            'outcome': outcome,
+            'spans': spans.as_dict() if spans is not None else {},
+            'labels': dict(spans.labels) if spans is not None else {},
+            'profile': 'pending' if self.profile_limit else None,
+        })
+        try:
+            entry_id = self.log.add(entry)
+        except OSError as e:
+            logging.error(f"Could not record slow query: {e}")
+            return None
+        logging.warning(f"Slow {method} ({duration:.1f}s): {details}")
+
+        if self.profile_limit:
+            with self._lock:
+                queued = not self._stopped
+                if queued:
+                    try:
+                        self._queue.put_nowait(
+                            (entry_id, gamma, method, args, kwargs))
+                    except queue.Full:
+                        queued = False
+                if queued and self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='slow-query-profiler',
+                        daemon=True)
+                    self._thread.start()
+            if not queued:
+                self.log.update(entry_id, profile='skipped')
+        return entry_id
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            self.profile(*task)
+
+    def stop(self):
+        """Stop profiling, before the evaluation workers are shut down.
+
+        Queries waiting to be profiled are left unprofiled, and the one
+        being profiled gets ``profile_limit`` seconds to finish.
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            thread = self._thread
+        while True:
+            try:
+                task = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.log.update(task[0], profile='skipped')
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(self.profile_limit)
+
+    def profile(self, entry_id, gamma, method, args, kwargs):
+        try:
+            if self.profiler is not None:
+                gamma = self.profiler()
+            result = gamma.profile(method, args, kwargs,
+                                   limit=self.profile_limit)
+        except Exception as e:
+            logging.error(f"Could not profile slow query {entry_id}: {e}")
+            self.log.update(entry_id, profile=f"failed: {e}")
+            return
+        try:
+            self.log.update(entry_id, dump=result['profile'],
+                            profile=result['outcome'],
+                            profile_summary=result['summary'])
+        except OSError as e:
+            logging.error(f"Could not save profile of slow query "
+                          f"{entry_id}: {e}")
+
+
+class RecordingGamma(object):
+    """Wraps a SymPyGamma or EvaluationExecutor, passing its slow
+    evaluations and cards to a :class:`SlowQueryRecorder`."""
+
+    def __init__(self, gamma, recorder):
+        self.gamma = gamma
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.gamma, name)
+
+    def eval(self, s):
+        start = time.perf_counter()
+        result = self.gamma.eval(s)
+        errors = [card.get('error') or 'invalid input' for card in result or []
+                  if card.get('error') or card.get('exception_info')]
+        self.recorder.record(self.gamma, 'eval', (s,), {}, {'input': s},
+                             time.perf_counter() - start,
+                             errors[0] if errors else 'ok')
+        return result
+
+    def eval_card(self, card_name, expression, variable, parameters,
+                  eval_id=None):
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return self.gamma.eval_card(card_name, expression, variable,
+                                        parameters, eval_id=eval_id)
+        except Exception as e:
+            outcome = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.recorder.record(
+                self.gamma, 'eval_card',
+                (card_name, expression, variable, parameters),
+                {'eval_id': eval_id},
+                {'input': expression, 'card': card_name,
+                 'variable': variable, 'parameters': parameters},
+                time.perf_counter() - start, outcome)
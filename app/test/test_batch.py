@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+import time
+
+from app.logic.batch import (card_events, evaluate, evaluate_cards, iter_cards,
+                             run_batch)
+from app.logic.logic import SymPyGamma
+
+
+def test_evaluate_cards():
+    output = evaluate(SymPyGamma(), 'x**2', cards=['diff'])
+    assert output['input'] == 'x**2'
+    assert any(card.get('card') == 'diff' for card in output['result'])
+    assert list(output['cards']) == ['diff']
+    assert output['cards']['diff']['output']
+
+    assert 'cards' not in evaluate(SymPyGamma(), 'x**2')
+
+
+def test_run_batch():
+    inputs = ['x**2', 'sin(x)', 'factorint(12)', 'x +']
+    results = list(run_batch(SymPyGamma(), inputs, concurrency=2))
+    assert sorted(r['index'] for r in results) == list(range(len(inputs)))
+    for r in results:
+        assert r['input'] == inputs[r['index']]
+        assert r['result']
+
+
+def test_run_batch_close():
+    batch = run_batch(SymPyGamma(), ['x'] * 20, concurrency=1)
+    assert next(batch)['input'] == 'x'
+    batch.close()
+
+
+class SlowGamma(object):
+    """Stand-in evaluator whose ``slow`` card takes a while."""
+
+    def __init__(self):
+        self.cancelled = []
+
+    def eval_card(self, card_name, expression, variable, parameters,
+                  eval_id=None):
+        if card_name == 'slow':
+            time.sleep(0.5)
+        return {'output': card_name}
+
+    def cancel(self, eval_id):
+        self.cancelled.append(eval_id)
+        return 1
+
+
+def test_evaluate_cards_budget():
+    g = SymPyGamma()
+    result = g.eval('x**2')
+    names = set(card['card'] for card in result if 'card' in card)
+    outputs = evaluate_cards(g, 'x**2', result, budget=60)
+    assert set(outputs) == names
+    assert all('output' in output for output in outputs.values())
+
+    # cards that miss the budget are left out
+    cards = [{'card': 'fast', 'var': 'x'}, {'card': 'slow', 'var': 'x'},
+             {'title': 'SymPy'}]
+    outputs = evaluate_cards(SlowGamma(), 'x', cards, budget=0.2)
+    assert outputs == {'fast': {'output': 'fast'}}
+
+
+def test_iter_cards_order():
+    cards = [{'card': 'slow', 'var': 'x', 'eval_id': 'abc'},
+             {'card': 'fast', 'var': 'x', 'eval_id': 'abc'}]
+    order = [(card['card'], output)
+             for card, output in iter_cards(SlowGamma(), 'x', cards, 5)]
+    assert order == [('fast', {'output': 'fast'}), ('slow', {'output': 'slow'})]
+
+    gamma = SlowGamma()
+    order = [(card['card'], output)
+             for card, output in iter_cards(gamma, 'x', cards, 0.2)]
+    assert order == [('fast', {'output': 'fast'}), ('slow', None)]
+    # the card that missed the budget is stopped
+    assert gamma.cancelled == ['abc']
+
+
+def test_card_events():
+    cards = [{'card': 'slow', 'var': 'x'}, {'card': 'fast', 'var': 'x'}]
+    events = list(card_events(SlowGamma(), 'x', cards, budget=5,
+                              heartbeat=0.2))
+    assert events[0] == {'event': 'card', 'card': 'fast',
+                         'result': {'output': 'fast'}}
+    assert any(event['event'] == 'progress' and event['card'] == 'slow'
+               for event in events)
+    assert events[-2:] == [
+        {'event': 'card', 'card': 'slow', 'result': {'output': 'slow'}},
+        {'event': 'done'},
+    ]
+
+    gamma = SlowGamma()
+    cards[0]['eval_id'] = 'abc'
+    events = list(card_events(gamma, 'x', cards, budget=0.1, heartbeat=1))
+    assert events[1:] == [{'event': 'timeout', 'card': 'slow'},
+                          {'event': 'done'}]
+    assert gamma.cancelled == ['abc']
@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+from sympy import Symbol, sin, integrate
+
+from app.logic.cache import CardCache, MemoryBackend, SharedBackend, \
+    LocalClient, card_key
+from app.logic.logic import SymPyGamma
+
+x = Symbol('x')
+y = Symbol('y')
+
+
+def test_card_key():
+    components = {'variables': [x], 'variable': x}
+    key = card_key('diff', sin(x), components, x, {})
+    assert key == card_key('diff', sin(x), dict(components), x, {})
+    # the parameters always sent by card.js don't change the key
+    assert key == card_key('diff', sin(x), components, x,
+                           {'variable': 'x', 'expression': 'sin(x)'})
+    assert key != card_key('series', sin(x), components, x, {})
+    assert key != card_key('diff', sin(y), components, y, {})
+    assert key != card_key('diff', sin(x), components, x, {'digits': '20'})
+    assert card_key('function_docs', integrate, {}, x, {}) == \
+        card_key('function_docs', integrate, {}, x, {})
+
+
+def test_memory_backend():
+    cache = CardCache(MemoryBackend(maxsize=2))
+    cache.set('a', {'output': 'a'})
+    cache.set('b', {'output': 'b'})
+    assert cache.get('a') == {'output': 'a'}
+    cache.set('c', {'output': 'c'})
+    assert cache.get('b') is None
+    assert cache.get('c') == {'output': 'c'}
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'evictions': 1}
+
+
+def test_shared_backend():
+    client = LocalClient()
+    cache = CardCache(SharedBackend(client))
+    cache.set('a', {'output': 'a'})
+    other = CardCache(SharedBackend(client))
+    assert other.get('a') == {'output': 'a'}
+    assert other.get('b') is None
+    assert other.stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_eval_card_cached():
+    cache = CardCache()
+    g = SymPyGamma(cache=cache)
+    first = g.eval_card('diff', 'sin(x)', 'x', {})
+    assert cache.stats()['misses'] == 1
+    second = g.eval_card('diff', 'sin(x)', 'x', {})
+    assert cache.stats()['hits'] == 1
+    assert first == second
+    g.eval_card('diff', 'sin(x)*y', 'y', {})
+    assert cache.stats()['misses'] == 2
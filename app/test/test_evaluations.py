@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+from app.logic.cache import CardCache, MemoryBackend
+from app.logic.evaluations import Evaluation, EvaluationStore
+from app.logic.logic import SymPyGamma
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def make_evaluation(expression):
+    return Evaluation(expression, {}, None, {}, [])
+
+
+def test_store_lru():
+    store = EvaluationStore(maxsize=2)
+    a = store.put(make_evaluation('a'))
+    b = store.put(make_evaluation('b'))
+    assert store.get(a).expression == 'a'
+    c = store.put(make_evaluation('c'))
+    assert len(store) == 2
+    assert store.get(b) is None
+    assert store.get(a).expression == 'a'
+    assert store.get(c).expression == 'c'
+    assert store.get('missing') is None
+
+
+def test_store_ttl():
+    clock = FakeClock()
+    store = EvaluationStore(ttl=10, clock=clock)
+    a = store.put(make_evaluation('a'))
+    clock.now = 5
+    b = store.put(make_evaluation('b'))
+    assert store.get(a) is not None
+    clock.now = 10
+    assert store.get(a) is None
+    assert store.get(b) is not None
+    clock.now = 20
+    store.put(make_evaluation('c'))
+    assert len(store) == 1
+
+
+class CountingGamma(SymPyGamma):
+    parses = 0
+
+    def eval_input(self, s):
+        CountingGamma.parses += 1
+        return super(CountingGamma, self).eval_input(s)
+
+
+def test_eval_card_reuses_evaluation():
+    # a cache that keeps nothing, so every card is really evaluated
+    g = CountingGamma(store=EvaluationStore(),
+                      cache=CardCache(MemoryBackend(maxsize=0)))
+    cards = [c for c in g.eval('x**2') if 'card' in c]
+    assert cards
+    eval_id = cards[0]['eval_id']
+    assert all(c['eval_id'] == eval_id for c in cards)
+
+    CountingGamma.parses = 0
+    for card in cards:
+        stored = g.eval_card(card['card'], 'x**2', 'x', {}, eval_id=eval_id)
+        reparsed = g.eval_card(card['card'], 'x**2', 'x', {})
+        # plots are adaptively sampled, so they differ between runs
+        if card['card'] != 'plot':
+            assert stored == reparsed
+    assert CountingGamma.parses == len(cards)
+
+    # an id for a different expression is not used
+    CountingGamma.parses = 0
+    g.get_card_info('diff', 'x**3', 'x', eval_id=eval_id)
+    assert CountingGamma.parses == 1
@@ -0,0 +1,186 @@
+from __future__ import absolute_import
+import mmap
+import threading
+import time
+
+from app import settings
+from app.logic.executor import EvaluationExecutor, ComputationTimeout, \
+    ComputationOutOfMemory, ComputationCancelled, Spawner, WorkerError
+
+
+def test_executor():
+    executor = EvaluationExecutor(
+        workers=1, deadlines=dict(settings.EVALUATION_DEADLINES, eval=2))
+    try:
+        cards = executor.eval('x**2')
+        assert cards[0]['title'] == 'SymPy'
+        card = [c for c in cards if c.get('card') == 'diff'][0]
+        result = executor.eval_card('diff', 'x**2', 'x', {},
+                                    eval_id=card['eval_id'])
+        assert result['value'] == '2*x'
+
+        try:
+            executor.eval_card('nonexistent', 'x', 'x', {})
+        except KeyError:
+            pass
+        else:
+            assert False, "expected KeyError"
+
+        pid = executor._workers[0].pid
+        # factoring this takes far longer than the deadline
+        cards = executor.eval('factorint(2**256 + 1)')
+        assert cards[-1]['error'] == "Computation timed out after 2 seconds."
+        assert executor._workers[0].pid != pid
+
+        assert executor.eval('1 + 1')[0]['title'] == 'SymPy'
+    finally:
+        executor.shutdown()
+
+
+def test_timeout_message():
+    assert str(ComputationTimeout(3)) == "Computation timed out after 3 seconds."
+
+
+def test_recycling():
+    executor = EvaluationExecutor(workers=1,
+                                  deadlines=settings.EVALUATION_DEADLINES,
+                                  max_tasks=2)
+    try:
+        pid = executor._workers[0].pid
+        executor.eval('x')
+        assert executor._workers[0].pid == pid
+        executor.eval('y')
+        assert executor._workers[0].pid != pid
+        assert executor.eval('z')[0]['title'] == 'SymPy'
+    finally:
+        executor.shutdown()
+
+
+def test_memory_limit():
+    executor = EvaluationExecutor(workers=1,
+                                  deadlines=settings.EVALUATION_DEADLINES,
+                                  memory_limit=2 ** 27)
+    try:
+        pid = executor._workers[0].pid
+        cards = executor.eval('Poly(x**(10**9))')
+        assert cards[-1]['error'] == "Computation ran out of memory."
+        # eval handles the MemoryError, but the worker retires all the same
+        assert executor._workers[0].pid != pid
+        pid = executor._workers[0].pid
+        try:
+            executor.eval_card('digits', 'Poly(x**(10**9))', 'x', {})
+        except ComputationOutOfMemory:
+            pass
+        else:
+            assert False, "expected ComputationOutOfMemory"
+        # the worker retires after running out of memory
+        assert executor._workers[0].pid != pid
+    finally:
+        executor.shutdown()
+
+
+def test_memory_limit_inherited():
+    # threads leave their stacks and malloc arenas in the address space,
+    # and so does memory reserved but never used
+    threads = [threading.Thread(target=bytearray, args=(2 ** 20,))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    reserved = mmap.mmap(-1, 2 ** 30)
+    executor = EvaluationExecutor(workers=1,
+                                  deadlines=settings.EVALUATION_DEADLINES,
+                                  memory_limit=2 ** 28)
+    try:
+        cards = executor.eval('integrate(exp(x)*sin(x)**3, x)')
+        assert not any('error' in card for card in cards)
+    finally:
+        executor.shutdown()
+        reserved.close()
+
+
+def test_cancel():
+    executor = EvaluationExecutor(workers=1,
+                                  deadlines=settings.EVALUATION_DEADLINES)
+    errors = []
+
+    def run():
+        try:
+            executor.eval_card('factorization', 'factorint(2**256 + 1)', 'x',
+                               {}, eval_id='abc')
+        except ComputationCancelled as e:
+            errors.append(e)
+
+    try:
+        pid = executor._workers[0].pid
+        thread = threading.Thread(target=run)
+        thread.start()
+        while not executor._running:
+            time.sleep(0.01)
+        assert executor.cancel('other') == 0
+        assert executor.cancel('abc') == 1
+        thread.join(5)
+        assert not thread.is_alive() and len(errors) == 1
+        assert executor._workers[0].pid != pid
+        assert not executor._running
+        assert executor.eval('1 + 1')[0]['title'] == 'SymPy'
+    finally:
+        executor.shutdown()
+
+
+def test_shutdown_while_running():
+    executor = EvaluationExecutor(workers=1,
+                                  deadlines=settings.EVALUATION_DEADLINES)
+    errors = []
+
+    def run():
+        try:
+            executor.eval_card('factorization', 'factorint(2**256 + 1)', 'x',
+                               {})
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    while not executor._running:
+        time.sleep(0.01)
+    executor.shutdown()
+    thread.join(5)
+    # the worker went away with the executor, and isn't replaced
+    assert not thread.is_alive()
+    assert len(errors) == 1 and isinstance(errors[0], WorkerError)
+    assert executor._workers == []
+    try:
+        executor.eval_card('diff', 'x', 'x', {})
+    except WorkerError:
+        pass
+    else:
+        assert False, "expected WorkerError"
+
+
+def test_exceptions_pickle():
+    import pickle
+    e = pickle.loads(pickle.dumps(ComputationTimeout(3)))
+    assert e.deadline == 3 and str(e) == str(ComputationTimeout(3))
+    e = pickle.loads(pickle.dumps(ComputationOutOfMemory()))
+    assert str(e) == "Computation ran out of memory."
+
+
+def test_shared_spawner():
+    spawner = Spawner()
+    try:
+        report = spawner.warm(['x**2'], 10)
+        assert report['inputs'] == 1 and report['complete']
+        for _ in range(2):
+            executor = EvaluationExecutor(
+                workers=1, deadlines=settings.EVALUATION_DEADLINES,
+                spawner=spawner)
+            try:
+                assert executor.eval('x')[0]['title'] == 'SymPy'
+            finally:
+                # leaves the spawner to the next pool
+                executor.shutdown()
+        assert spawner.process.is_alive()
+    finally:
+        spawner.stop()
@@ -0,0 +1,41 @@
+from __future__ import absolute_import
+from app.logic.logic import SymPyGamma, base_namespace
+from app.logic.utils import Eval, Namespace
+
+
+def test_namespace_layering():
+    base = {'a': 1, 'b': 2}
+    namespace = Namespace(base)
+    assert namespace['a'] == 1
+    assert 'b' in namespace
+    assert namespace.get('c') is None
+    namespace['a'] = 3
+    assert namespace['a'] == 3
+    assert base['a'] == 1
+
+    e = Eval(namespace)
+    assert e.eval("a + b") == "5"
+    assert e.eval("""\
+def f(x):
+    return x + b
+f(1)
+"""\
+        ) == "3"
+    assert 'f' not in base
+
+
+def test_base_namespace_shared():
+    assert base_namespace() is base_namespace()
+    assert 'integrate' in base_namespace()
+    assert 'input_evaluated' not in base_namespace()
+
+
+def test_eval_input_isolated():
+    g = SymPyGamma()
+    _, _, evaluator1, evaluated1 = g.eval_input('x**2')
+    _, _, evaluator2, evaluated2 = g.eval_input('sin(x)')
+    assert evaluator1.get('input_evaluated') == evaluated1
+    assert evaluator2.get('input_evaluated') == evaluated2
+    evaluator1.eval('y = 5')
+    assert evaluator2.get('y') != 5
+    assert 'input_evaluated' not in base_namespace()
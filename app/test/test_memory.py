@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+
+import contextlib
+import tracemalloc
+
+from app.logic import memory, timing
+from app.logic.cache import CardCache, MemoryBackend
+from app.logic.logic import SymPyGamma
+
+
+@contextlib.contextmanager
+def tracing():
+    memory.start()
+    try:
+        yield
+    finally:
+        tracemalloc.stop()
+
+
+def test_measure_untraced():
+    with memory.measure() as usage:
+        bytearray(2 ** 20)
+    assert usage == {}
+
+
+def test_measure():
+    with tracing():
+        with memory.measure() as usage:
+            kept = bytearray(2 ** 20)
+            bytearray(4 * 2 ** 20)
+        assert usage['peak'] >= 5 * 2 ** 20
+        assert 2 ** 20 <= usage['retained'] < 2 * 2 ** 20
+
+        with memory.measure() as outer:
+            with memory.measure() as inner:
+                del kept
+        # only the outer measurement counts
+        assert inner == {}
+        if hasattr(tracemalloc, 'reset_peak'):
+            # before 3.9 allocations from before a measurement are forgotten,
+            # so freeing them doesn't count
+            assert outer['retained'] <= -2 ** 20
+
+
+def test_card_memory():
+    with tracing():
+        gamma = SymPyGamma(cache=CardCache(MemoryBackend(maxsize=0)))
+        spans, token = timing.collect()
+        try:
+            gamma.eval_card('diff', 'x**2', 'x', {})
+        finally:
+            timing.stop(token)
+        assert spans.labels['memory_peak'] > 0
+        assert 'memory_retained' in spans.labels
+
+
+def test_top_sites():
+    def allocate():
+        return [bytearray(2 ** 20) for _ in range(4)]
+
+    result = memory.top_sites(allocate)
+    assert result['outcome'] == 'ok'
+    assert result['peak'] >= 4 * 2 ** 20
+    site = result['sites'][0]
+    assert site['size'] >= 4 * 2 ** 20
+    assert site['count'] >= 4
+    assert 'bytearray(2 ** 20)' in site['traceback'][0]
+    # tracing stops again unless it was already on
+    assert not tracemalloc.is_tracing()
+
+    result = memory.top_sites(int, ('x',))
+    assert result['outcome'].startswith('ValueError')
+
+
+def test_top_sites_traced():
+    with tracing():
+        result = memory.top_sites(lambda: bytearray(2 ** 20),
+                                  group='traceback')
+        assert len(result['sites'][0]['traceback']) > 1
+        assert tracemalloc.get_traceback_limit() == memory.TRACE_FRAMES
+
+        # restarting tracing would spoil the measurement under way
+        with memory.measure() as usage:
+            kept = bytearray(2 ** 20)
+            result = memory.top_sites(lambda: bytearray(2 ** 20),
+                                      group='traceback')
+        assert result['outcome'] == 'ok' and 'peak' not in result
+        assert len(result['sites'][0]['traceback']) == memory.TRACE_FRAMES
+        assert usage['retained'] > 2 ** 19
+        del kept
@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_raises
+
+from app import metrics
+from app.logic import timing
+from app.logic.executor import ComputationTimeout
+from app.metrics import MeteredGamma, Registry
+
+
+def test_render():
+    registry = Registry()
+    requests = registry.counter('requests_total', "Requests.", ['view'])
+    latency = registry.histogram('latency_seconds', "Latency.", ['view'],
+                                 buckets=(0.1, 1))
+    requests.inc(view='input')
+    requests.inc(2, view='input')
+    requests.inc(view='say "hi"')
+    latency.observe(0.05, view='input')
+    latency.observe(0.5, view='input')
+    latency.observe(5, view='input')
+
+    lines = registry.render().splitlines()
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total{view="input"} 3' in lines
+    assert r'requests_total{view="say \"hi\""} 1' in lines
+    assert '# TYPE latency_seconds histogram' in lines
+    assert 'latency_seconds_bucket{view="input",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{view="input",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{view="input",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{view="input"} 5.55' in lines
+    assert 'latency_seconds_count{view="input"} 3' in lines
+
+
+_directory = None
+
+
+def setup_module():
+    global _directory
+    _directory = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(_directory, ignore_errors=True)
+
+
+def _registry(directory):
+    registry = Registry(directory, interval=0)
+    registry.counter('requests_total', "Requests.", ['view'])
+    registry.histogram('latency_seconds', "Latency.", buckets=(1,))
+    return registry
+
+
+def test_processes():
+    directory = os.path.join(_directory, 'processes')
+    os.mkdir(directory)
+    first, second = _registry(directory), _registry(directory)
+    # another process, as far as the snapshot files go
+    second._path = lambda: os.path.join(directory, 'metrics.0.0.json')
+    first.metrics[0].inc(view='input')
+    first.metrics[1].observe(0.5)
+    second.metrics[0].inc(view='input')
+    second.metrics[0].inc(view='card')
+    second.metrics[1].observe(2)
+    first.maybe_save()
+    second.maybe_save()
+
+    lines = first.render().splitlines()
+    assert 'requests_total{view="input"} 2' in lines
+    assert 'requests_total{view="card"} 1' in lines
+    assert 'latency_seconds_bucket{le="1"} 1' in lines
+    assert 'latency_seconds_count 2' in lines
+
+
+def test_compact():
+    directory = os.path.join(_directory, 'compact')
+    os.mkdir(directory)
+    live = _registry(directory)
+    live.metrics[0].inc(view='input')
+    live.save()
+    for views in (['input', 'card'], ['input']):
+        # a process that saved its metrics and exited
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        exited = _registry(directory)
+        exited._path = lambda: os.path.join(directory,
+                                            f'metrics.{pid}.0.json')
+        for view in views:
+            exited.metrics[0].inc(view=view)
+        exited.metrics[1].observe(2)
+        exited.save()
+
+    lines = _registry(directory).render().splitlines()
+    assert 'requests_total{view="input"} 3' in lines
+    assert 'requests_total{view="card"} 1' in lines
+    assert 'latency_seconds_count 2' in lines
+    assert sorted(name for name in os.listdir(directory)
+                  if name.endswith('.json')) == \
+        sorted([metrics.COMPACTED, os.path.basename(live._path())])
+
+    # the next scrape reads the compacted snapshot back
+    assert _registry(directory).render().splitlines() == lines
+
+
+class FakeGamma(object):
+
+    def eval(self, s):
+        timing.label('function', 'integrate')
+        return [{'title': 'Input', 'input': s},
+                {'title': 'Error', 'error': "Computation timed out after "
+                                            "20 seconds."}]
+
+    def eval_card(self, card_name, expression, variable, parameters,
+                  eval_id=None):
+        timing.label('card_cache', 'hit')
+        if expression == 'slow':
+            raise ComputationTimeout(25)
+        return {'value': 'x', 'output': 'x'}
+
+    def cancel(self, eval_id):
+        return 1
+
+
+def test_metered_gamma():
+    def value(metric, **labels):
+        return metric._values.get(metric._key(labels), 0)
+
+    gamma = MeteredGamma(FakeGamma())
+    timeouts = value(metrics.timeouts, kind='eval', name='integrate')
+    card_timeouts = value(metrics.timeouts, kind='card', name='diff')
+    hits = value(metrics.cache_lookups, cache='card_cache', result='hit')
+
+    spans, token = timing.collect()
+    try:
+        gamma.eval('integrate(x)')
+        gamma.eval_card('diff', 'x', 'x', {})
+        assert_raises(ComputationTimeout, gamma.eval_card, 'diff', 'slow',
+                      'x', {})
+    finally:
+        timing.stop(token)
+
+    assert spans.labels['function'] == 'integrate'
+    assert value(metrics.timeouts, kind='eval',
+                 name='integrate') == timeouts + 1
+    assert value(metrics.timeouts, kind='card',
+                 name='diff') == card_timeouts + 1
+    assert value(metrics.cache_lookups, cache='card_cache',
+                 result='hit') == hits + 2
+    assert gamma.cancel('id') == 1
+    assert 'gamma_cache_hit_ratio{cache="card_cache"}' in metrics.render()
+
+
+class MemoryGamma(FakeGamma):
+
+    def eval_card(self, card_name, expression, variable, parameters,
+                  eval_id=None):
+        timing.label('memory_peak', 2 ** 20)
+        timing.label('memory_retained', -2 ** 10)
+        return {'value': 'x', 'output': 'x'}
+
+
+def test_card_memory():
+    def count(metric, **labels):
+        return metric._values.get(metric._key(labels), [[0], 0])[0]
+
+    peaks = sum(count(metrics.card_memory_peak, card='roots'))
+    retained = sum(count(metrics.card_memory_retained, card='roots'))
+    MeteredGamma(MemoryGamma()).eval_card('roots', 'x', 'x', {})
+    # without memory accounting, nothing is observed
+    MeteredGamma(FakeGamma()).eval_card('roots', 'x', 'x', {})
+
+    assert sum(count(metrics.card_memory_peak, card='roots')) == peaks + 1
+    assert sum(count(metrics.card_memory_retained,
+                     card='roots')) == retained + 1
+    lines = metrics.render().splitlines()
+    assert 'gamma_card_memory_peak_bytes_bucket{card="roots",le="1048576"} ' \
+        f'{peaks + 1}' in lines
+    assert 'gamma_card_memory_retained_bytes_bucket{card="roots",' \
+        f'le="65536"}} {retained + 1}' in lines
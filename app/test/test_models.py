@@ -0,0 +1,68 @@
+from __future__ import absolute_import
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from app import models
+
+
+def test_query_key_name():
+    assert models.query_key_name('x**2') == models.query_key_name(' x**2 ')
+    assert models.query_key_name('x + 1') == models.query_key_name('x  +\t1')
+    assert models.query_key_name('x**2') != models.query_key_name('x**3')
+
+
+def test_query_entity():
+    client = models.LocalDatastore()
+    entity = models.query_entity('x**2 ', client=client)
+    assert entity.key == models.query_entity('x**2', client=client).key
+    assert entity['text'] == 'x**2 ' and entity['date']
+
+
+def check_store(store):
+    date = datetime.datetime(2020, 1, 1)
+    store.put_queries([(models.query_key_name(text), text, date)
+                       for text in ['x**2', 'sin(x)']])
+    assert store.exists('x**2') and store.exists(' sin(x)')
+    assert not store.exists('cos(x)')
+    # putting again is an upsert
+    store.put_queries([(models.query_key_name('x**2'), 'x**2', date)])
+
+
+def test_datastore_query_store():
+    client = models.LocalDatastore()
+    check_store(models.DatastoreQueryStore(client))
+    assert len(client.entities) == 2
+
+
+def test_query_store_interface():
+    class PartialStore(models.QueryStore):
+        def exists(self, text):
+            return False
+
+    try:
+        PartialStore()
+    except TypeError:
+        pass
+    else:
+        assert False, "a store must implement put_queries"
+
+
+def test_sqlite_query_store():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'queries.sqlite3')
+    try:
+        store = models.SQLiteQueryStore(path)
+        check_store(store)
+        connection = sqlite3.connect(path)
+        try:
+            assert connection.execute(
+                'SELECT COUNT(*) FROM query').fetchone()[0] == 2
+            assert connection.execute(
+                'PRAGMA journal_mode').fetchone()[0] == 'wal'
+        finally:
+            connection.close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+import os
+import pstats
+import shutil
+import tempfile
+import time
+
+from app.logic.profiling import profile, sample
+
+
+def test_profile_limit():
+    def spin():
+        while True:
+            try:
+                sum(range(1000))
+            except Exception:
+                # like Eval.eval, which catches everything
+                pass
+
+    result = profile(spin, limit=0.2)
+    assert result['outcome'] == 'stopped after 0.2 seconds'
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'spin.prof')
+        with open(path, 'wb') as f:
+            f.write(result['profile'])
+        stats = pstats.Stats(path)
+    finally:
+        shutil.rmtree(directory)
+    assert any(name == 'spin' for _, _, name in stats.stats)
+    assert 'spin' in result['summary']
+
+    assert profile(int, ('x',))['outcome'].startswith('ValueError')
+
+
+def test_sample():
+    def busy():
+        start = time.perf_counter()
+        while time.perf_counter() - start < 0.3:
+            sum(range(1000))
+
+    def outer():
+        busy()
+
+    result = sample(outer, interval=0.001)
+    assert result['outcome'] == 'ok'
+    assert result['samples'] > 0
+    lines = result['stacks'].splitlines()
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == \
+        result['samples']
+    # stacks start at the sampled function, outermost first
+    assert all(line.startswith('outer (') for line in lines)
+    assert any(';busy (' in line for line in lines)
+
+    assert sample(int, ('x',))['outcome'].startswith('ValueError')
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+import time
+
+from app.models import DatastoreQueryStore, LocalDatastore
+from app.querylog import QueryLog
+from app.sketches import SeenFilter
+
+
+class FailingStore(object):
+    def put_queries(self, queries):
+        raise IOError("unavailable")
+
+
+def texts(client):
+    return sorted(entity['text'] for entity in client.entities.values())
+
+
+def test_batches_and_dedup():
+    client = LocalDatastore()
+    log = QueryLog(DatastoreQueryStore(client), batch_size=3,
+                   flush_interval=60)
+    for text in ['a', 'b', 'a ', 'a']:
+        assert log.add(text)
+    assert len(log) == 2
+    log.add('c')
+    # the batch is full, so it's written without waiting for the interval
+    for _ in range(100):
+        if client.entities:
+            break
+        time.sleep(0.01)
+    assert texts(client) == ['a', 'b', 'c']
+    assert log.written == 3
+    log.close()
+
+
+def test_flush_interval():
+    client = LocalDatastore()
+    log = QueryLog(DatastoreQueryStore(client), batch_size=100,
+                   flush_interval=0.1)
+    log.add('x')
+    time.sleep(0.5)
+    assert texts(client) == ['x']
+    log.close()
+
+
+def test_close_flushes():
+    client = LocalDatastore()
+    log = QueryLog(DatastoreQueryStore(client), batch_size=2,
+                   flush_interval=60)
+    for text in ['a', 'b', 'c', 'd', 'e']:
+        log.add(text)
+    log.close()
+    assert texts(client) == ['a', 'b', 'c', 'd', 'e']
+    assert not log.add('f')
+
+
+def test_drop_policy():
+    log = QueryLog(DatastoreQueryStore(LocalDatastore()), maxsize=2,
+                   batch_size=100, flush_interval=60)
+    assert log.add('a') and log.add('b')
+    # already buffered inputs are still accepted
+    assert log.add('a')
+    assert not log.add('c')
+    assert log.dropped == 1
+    log.close()
+    assert log.written == 2
+
+    log = QueryLog(FailingStore(), batch_size=100, flush_interval=60)
+    log.add('a')
+    log.close()
+    assert log.dropped == 1 and log.written == 0
+
+
+def test_seen_inputs_are_skipped():
+    client = LocalDatastore()
+    log = QueryLog(DatastoreQueryStore(client), batch_size=100,
+                   flush_interval=60, seen=SeenFilter(capacity=100))
+    log.add('a')
+    log.flush()
+    assert log.add('a') and log.add(' a')
+    assert log.skipped == 2 and len(log) == 0
+    log.add('b')
+    log.close()
+    assert log.written == 2
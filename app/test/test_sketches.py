@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+
+from app.sketches import BloomFilter, CountMinSketch, PopularityTracker, \
+    SeenFilter, TopK
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add('in%d' % i)
+    assert all('in%d' % i in bloom for i in range(1000))
+    false_positives = sum('out%d' % i in bloom for i in range(10000))
+    assert false_positives < 300
+    assert 0.005 < bloom.false_positive_rate() < 0.02
+
+    bloom.clear()
+    assert 'in1' not in bloom and bloom.count == 0
+
+
+def test_seen_filter():
+    seen = SeenFilter(capacity=10, error_rate=0.01, lru_size=2)
+    for i in range(10):
+        seen.add('k%d' % i)
+    assert all('k%d' % i in seen for i in range(10))
+    assert 0 < seen.stats()['keys'] <= 10
+
+    # once the Bloom filter is full it's cleared; the LRU still knows the
+    # latest keys
+    i = 10
+    while not seen.resets:
+        seen.add('k%d' % i)
+        i += 1
+    assert 'k%d' % (i - 1) in seen and 'k%d' % (i - 2) in seen
+    assert seen.stats()['keys'] == 1
+
+
+def test_count_min_sketch():
+    sketch = CountMinSketch(width=64, depth=4)
+    for i in range(100):
+        for _ in range(i % 5):
+            sketch.add('k%d' % i)
+    assert sketch.total == sum(i % 5 for i in range(100))
+    # estimates never undercount
+    assert all(sketch.estimate('k%d' % i) >= i % 5 for i in range(100))
+    assert sketch.add('k4') >= 5
+
+
+def test_top_k():
+    top = TopK(k=2)
+    for key, count in [('a', 1), ('b', 1), ('a', 2), ('c', 1), ('c', 3),
+                       ('b', 2)]:
+        top.update(key, count)
+    assert top.items() == [('c', 3), ('a', 2)]
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_popularity_tracker():
+    clock = FakeClock()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'popularity.json')
+    try:
+        tracker = PopularityTracker(k=2, merge_interval=10, decay=0.5,
+                                    path=path, clock=clock)
+        for key in ['x', 'x', 'x', 'y', 'y', 'z']:
+            tracker.add('input', key)
+        tracker.add('card', 'diff:x')
+        assert tracker.popular('input') == []
+
+        clock.now = 10
+        tracker.add('input', 'z')
+        assert tracker.popular('input') == ['x', 'y']
+        assert tracker.count('input', 'x') == 3
+        assert tracker.popular('card') == ['diff:x']
+
+        # old counts decay at each merge
+        clock.now = 15
+        for _ in range(4):
+            tracker.add('input', 'z')
+        clock.now = 25
+        tracker.add('card', 'diff:x')
+        assert tracker.popular('input') == ['z', 'x']
+        assert tracker.count('input', 'x') == 1.5
+
+        loaded = PopularityTracker(path=path)
+        loaded.load()
+        assert loaded.popular('input') == ['z', 'x']
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_popularity_tracker_shared():
+    clock = FakeClock()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'popularity.json')
+    try:
+        # two processes sharing the record
+        first, second = [PopularityTracker(merge_interval=10, decay=0.5,
+                                           path=path, clock=clock)
+                         for _ in range(2)]
+        for _ in range(3):
+            first.add('input', 'x')
+        second.add('input', 'x')
+        second.add('input', 'y')
+        first.merge()
+        second.merge()
+        assert second.count('input', 'x') == 4
+        assert second.count('input', 'y') == 1
+
+        # counts decay once per interval, whichever process merges
+        clock.now = 15
+        first.merge()
+        assert first.count('input', 'x') == 2
+        clock.now = 18
+        second.merge()
+        assert second.count('input', 'x') == 2
+
+        # an unusable path keeps the record in memory
+        lost = PopularityTracker(path=os.path.join(directory, 'no', 'file'))
+        lost.add('input', 'z')
+        lost.merge()
+        assert lost.popular('input') == ['z']
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+import shutil
+import tempfile
+import time
+
+from app.logic.profiling import profile
+from app.slowlog import RecordingGamma, SlowQueryLog, SlowQueryRecorder
+
+
+_directory = None
+
+
+def setup_module():
+    global _directory
+    _directory = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(_directory, ignore_errors=True)
+
+
+def _log(**kwargs):
+    return SlowQueryLog(tempfile.mkdtemp(dir=_directory), **kwargs)
+
+
+def test_ring_buffer():
+    log = _log(size=2)
+    first = log.add({'input': 'a'})
+    assert log.update(first, dump=b'profile', profile='ok')
+    assert log.get(first)['profile'] == 'ok'
+    assert log.profile_path(first) is not None
+
+    second = log.add({'input': 'b'})
+    third = log.add({'input': 'c'})
+    assert [entry['input'] for entry in log.entries()] == ['c', 'b']
+    # the third entry took the first's slot, and its profile is gone
+    assert log.get(first) is None
+    assert log.profile_path(first) is None
+    assert log.profile_path(third) is None
+    assert not log.update(first, profile='ok')
+    assert log.get(second)['input'] == 'b'
+
+    # the next id survives across instances sharing the directory
+    assert SlowQueryLog(log.directory, size=2).add({'input': 'd'}) == \
+        third + 1
+
+
+class SlowGamma(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.profiled = []
+
+    def eval(self, s):
+        time.sleep(self.delay)
+        return [{'title': 'Input', 'input': s}]
+
+    def eval_card(self, card_name, expression, variable, parameters,
+                  eval_id=None):
+        time.sleep(self.delay)
+        return {'output': expression}
+
+    def profile(self, method, args, kwargs, limit=None):
+        self.profiled.append((method, args))
+        return profile(lambda *args, **kwargs: None, args, kwargs, limit)
+
+
+def _profiled(log, entry_id):
+    for _ in range(100):
+        entry = log.get(entry_id)
+        if entry['profile'] != 'pending':
+            return entry
+        time.sleep(0.05)
+    return entry
+
+
+def test_recorder():
+    log = _log()
+    recorder = SlowQueryRecorder(log, threshold=0.05, profile_limit=1)
+
+    fast = SlowGamma(0)
+    RecordingGamma(fast, recorder).eval_card('roots', 'x', 'x', {})
+    assert log.entries() == []
+
+    slow = SlowGamma(0.1)
+    result = RecordingGamma(slow, recorder).eval_card(
+        'roots', 'x**2', 'x', {'digits': '15'}, eval_id='abc')
+    assert result == {'output': 'x**2'}
+    entry, = log.entries()
+    assert entry['method'] == 'eval_card'
+    assert entry['card'] == 'roots'
+    assert entry['input'] == 'x**2'
+    assert entry['parameters'] == {'digits': '15'}
+    assert entry['duration'] >= 0.1
+
+    entry = _profiled(log, entry['id'])
+    assert entry['profile'] == 'ok'
+    assert 'function calls' in entry['profile_summary']
+    assert slow.profiled == [('eval_card',
+                              ('roots', 'x**2', 'x', {'digits': '15'}))]
+    assert log.profile_path(entry['id']) is not None
+    recorder.stop()
+
+
+def test_recorder_profiler():
+    log = _log()
+    profiler = SlowGamma(0)
+    recorder = SlowQueryRecorder(log, threshold=0.05, profile_limit=1,
+                                 profiler=lambda: profiler)
+    slow = SlowGamma(0.1)
+    RecordingGamma(slow, recorder).eval('x')
+    entry, = log.entries()
+    assert _profiled(log, entry['id'])['profile'] == 'ok'
+    # re-run elsewhere than the query
+    assert profiler.profiled == [('eval', ('x',))]
+    assert slow.profiled == []
+
+    recorder.stop()
+    assert not recorder._thread.is_alive()
+    RecordingGamma(slow, recorder).eval('y')
+    assert log.entries()[0]['profile'] == 'skipped'
+    # stopping again is harmless
+    recorder.stop()
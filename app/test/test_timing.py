@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+
+from app import settings
+from app.logic import timing
+from app.logic.executor import EvaluationExecutor
+from app.logic.logic import SymPyGamma
+
+
+def test_spans():
+    with timing.span('ignored'):
+        pass
+    assert timing.current() is None
+
+    spans, token = timing.collect()
+    try:
+        with timing.span('parse'):
+            pass
+        with timing.span('evalf'):
+            pass
+        with timing.span('evalf'):
+            pass
+        timing.record({'card_eval': 2.5, 'evalf': 1})
+    finally:
+        timing.stop(token)
+    assert timing.current() is None
+
+    durations = spans.as_dict()
+    assert list(durations) == ['parse', 'evalf', 'card_eval']
+    assert durations['evalf'] >= 1
+    assert durations['card_eval'] == 2.5
+    assert spans.header().startswith('parse;dur=')
+    assert 'card_eval;dur=2.5' in spans.header()
+
+
+def test_eval_spans():
+    spans, token = timing.collect()
+    try:
+        SymPyGamma().eval('x**2')
+    finally:
+        timing.stop(token)
+    for name in ('parse', 'evaluate', 'find_result_set', 'latex', 'simplify'):
+        assert name in spans.durations
+
+
+def test_worker_spans():
+    executor = EvaluationExecutor(workers=1,
+                                  deadlines=settings.EVALUATION_DEADLINES)
+    spans, token = timing.collect()
+    try:
+        executor.eval_card('diff', 'x**2', 'x', {})
+    finally:
+        timing.stop(token)
+        executor.shutdown()
+    assert 'worker_wait' in spans.durations
+    # the card may come from the cache, so card_eval may be missing
+    assert 'card_cache' in spans.durations
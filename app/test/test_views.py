@@ -0,0 +1,252 @@
+from __future__ import absolute_import
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+os.environ.setdefault('GAE_VERSION', 'test')
+
+import django
+from django.template.loader import render_to_string
+from django.test import Client
+
+from app import settings
+
+django.setup()
+
+from app import models, sketches, views
+from app.logic.executor import ComputationAborted
+
+# Settings for every test here: a local query store, and evaluation in the
+# request thread unless a test starts workers
+OVERRIDES = {
+    'QUERY_STORE': 'sqlite',
+    'EVALUATION_WORKERS': 0,
+    'SLOW_QUERY_THRESHOLD': 0,
+    'EAGER_CARDS': False,
+    'CARD_EVENTS': False,
+    'WARMUP_BUDGET': 0,
+    'WARMUP_CORPUS': None,
+}
+
+_saved = {}
+_directory = None
+client = Client(HTTP_HOST='localhost')
+
+
+def setup_module():
+    global _directory
+    _directory = tempfile.mkdtemp()
+    overrides = dict(OVERRIDES, QUERY_STORE_PATH=os.path.join(
+        _directory, 'queries.sqlite3'))
+    for name, value in overrides.items():
+        _saved[name] = getattr(settings, name)
+        setattr(settings, name, value)
+
+
+def teardown_module():
+    # write the queries logged here to the store set up for the tests
+    if views._query_log is not None:
+        views._query_log.close()
+        atexit.unregister(views._query_log.close)
+        views._query_log = None
+    models._query_store = None
+    if views._spawner is not None:
+        views._spawner.stop()
+        views._spawner = None
+    for name, value in _saved.items():
+        setattr(settings, name, value)
+    shutil.rmtree(_directory, ignore_errors=True)
+
+
+def _ndjson(response):
+    content = b''.join(response.streaming_content).decode('utf-8')
+    return [json.loads(line) for line in content.splitlines()]
+
+
+def test_api_input():
+    response = client.get('/api/input', {'i': 'x**2', 'cards': 'diff'})
+    assert response.status_code == 200
+    result = json.loads(response.content)
+    assert result['input'] == 'x**2'
+    assert result['cards']['diff']['output']
+    # a shared cache would hand these to every client
+    assert not any('eval_id' in card for card in result['result'])
+    cache_control = response['Cache-Control']
+    assert 'public' in cache_control
+    assert f'max-age={settings.API_CACHE_MAX_AGE}' in cache_control
+    etag = response['ETag']
+
+    response = client.get('/api/input', {'i': 'x**2', 'cards': 'diff'},
+                          HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response.content == b''
+
+    # other cards, other result
+    response = client.get('/api/input', {'i': 'x**2', 'cards': 'integral'},
+                          HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+    assert client.get('/api/input', {'i': ' '}).status_code == 400
+
+    # failures may be transient: not to be cached or revalidated
+    response = client.get('/api/input', {'i': 'x +'})
+    assert response.status_code == 200
+    assert 'no-store' in response['Cache-Control']
+    assert 'public' not in response['Cache-Control']
+    assert not response.has_header('ETag')
+    assert views._failed({'result': [{'card': 'diff'}], 'cards': {
+        'diff': {'error': 'Computation timed out after 25 seconds.'}}})
+
+
+def test_batch():
+    response = client.post('/api/batch', json.dumps({
+        'inputs': ['x**2', 'x +'],
+        'cards': ['diff'],
+    }), content_type='application/json')
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'application/x-ndjson'
+    results = sorted(_ndjson(response), key=lambda result: result['index'])
+    assert [result['input'] for result in results] == ['x**2', 'x +']
+    assert results[0]['cards']['diff']['output']
+    assert results[1]['result'][-1]['title'] == 'Error'
+
+    for body in ('{', json.dumps({'inputs': 'x'}),
+                 json.dumps({'inputs': ['x'], 'cards': 'diff'})):
+        response = client.post('/api/batch', body,
+                               content_type='application/json')
+        assert response.status_code == 400
+        assert 'error' in json.loads(response.content)
+
+
+def test_stream_result():
+    response = client.get('/input/', {'i': 'x**2', 'stream': '1'})
+    assert response.status_code == 200
+    page = b''.join(response.streaming_content).decode('utf-8')
+    assert page.rstrip().endswith('</html>')
+    assert 'data-card-name="diff"' in page
+    assert 'data-evaluated="true"' in page
+
+
+def test_card_events_setting():
+    # the page only asks for /card_events with the setting on
+    page = client.get('/input/', {'i': 'x**2'}).content.decode('utf-8')
+    assert 'data-card-events' not in page
+
+    settings.CARD_EVENTS = True
+    try:
+        page = client.get('/input/', {'i': 'x**2'}).content.decode('utf-8')
+        assert 'data-card-events="true"' in page
+    finally:
+        settings.CARD_EVENTS = False
+
+
+def test_admin_token():
+    settings.ADMIN_TOKEN = 'secret'
+    try:
+        assert client.get('/admin/memory').status_code == 403
+        # only the header counts, not a token in the URL
+        response = client.get('/admin/memory', {'token': 'secret'})
+        assert response.status_code == 403
+        response = client.get('/admin/memory',
+                              HTTP_X_GAMMA_ADMIN_TOKEN='wrong')
+        assert response.status_code == 403
+        response = client.get('/admin/slow_queries',
+                              HTTP_X_GAMMA_ADMIN_TOKEN='secret')
+        assert response.status_code == 200
+    finally:
+        settings.ADMIN_TOKEN = None
+
+
+def test_error_card_is_final():
+    # as sent by stream_result for a card that failed
+    html = render_to_string('card.html', {'cell': {
+        'card': 'diff', 'title': 'Derivative', 'var': 'x',
+        'error': 'Computation timed out after 25 seconds.',
+    }, 'input': 'x**2'})
+    assert 'data-evaluated="true"' in html
+    assert 'loader' not in html
+    assert 'Computation timed out after 25 seconds.' in html
+
+
+def test_warmup():
+    corpus = os.path.join(_directory, 'corpus.txt')
+    with open(corpus, 'w') as f:
+        f.write('x**2\n')
+    settings.WARMUP_CORPUS = corpus
+    settings.WARMUP_BUDGET = 60
+    popularity = views.popularity
+    views.popularity = sketches.PopularityTracker(merge_interval=0)
+    views.popularity.add('input', 'x**2')
+    views.popularity.add('input', 'factorint(12)')
+    try:
+        # popular inputs are left to the workers
+        report = json.loads(client.get('/_ah/warmup').content)
+        assert report['inputs'] == 1
+        assert 'popular' not in report
+
+        views._warmup_report = None
+        settings.EVALUATION_WORKERS = 1
+        response = client.get('/_ah/warmup')
+        assert response.status_code == 200
+        report = json.loads(response.content)
+        # the corpus warms the spawner the workers are forked from
+        assert report['inputs'] == 1
+        assert report['popular']['inputs'] == 1
+        assert views._executor is not None
+        # the batch pool starts with the first batch
+        assert views._batch_executor is None
+    finally:
+        settings.EVALUATION_WORKERS = 0
+        settings.WARMUP_CORPUS = None
+        settings.WARMUP_BUDGET = 0
+        views.popularity = popularity
+        views._warmup_report = None
+        if views._executor is not None:
+            views._executor.shutdown()
+            views._executor = None
+
+
+def test_cancel():
+    settings.EVALUATION_WORKERS = 1
+    try:
+        gamma = views.get_gamma()
+        outcome = []
+
+        def run():
+            try:
+                gamma.eval_card('factorization', 'factorint(2**256 + 1)',
+                                'x', {}, eval_id='abc')
+            except ComputationAborted as e:
+                outcome.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        for _ in range(50):
+            response = client.post('/cancel', 'abc', content_type='text/plain')
+            assert response.status_code == 200
+            if json.loads(response.content) == {'cancelled': 1}:
+                break
+            time.sleep(0.1)
+        else:
+            assert False, "the card never started"
+        thread.join(10)
+        assert len(outcome) == 1
+
+        response = client.post('/cancel', {'eval_id': 'abc'})
+        assert json.loads(response.content) == {'cancelled': 0}
+
+        # multipart, as the test client sends forms, without an eval_id
+        assert client.post('/cancel', {}).status_code == 400
+        assert client.post('/cancel', ' ',
+                           content_type='text/plain').status_code == 400
+    finally:
+        settings.EVALUATION_WORKERS = 0
+        if views._executor is not None:
+            views._executor.shutdown()
+            views._executor = None
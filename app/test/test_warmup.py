@@ -0,0 +1,35 @@
+from __future__ import absolute_import
+from app.constants import EXAMPLES
+from app.logic.logic import SymPyGamma
+from app.logic.warmup import example_inputs, warmup
+
+
+def test_example_inputs():
+    inputs = example_inputs(EXAMPLES)
+    assert '242/33' in inputs and 'pi' in inputs
+    assert all(isinstance(i, str) for i in inputs)
+
+
+def test_warmup():
+    report = warmup(SymPyGamma(), ['x**2', '1 + 1'])
+    assert report['inputs'] == 2 and report['complete']
+    assert report['cards'] > 0
+    assert report['elapsed'] >= 0
+
+
+class TickingClock(object):
+    """Advances one second every time it is read."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+def test_warmup_budget():
+    report = warmup(SymPyGamma(), ['x', 'y', 'z'], budget=2, cards=False,
+                    clock=TickingClock())
+    assert report['inputs'] == 1
+    assert not report['complete']
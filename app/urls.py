@@ -18,13 +18,25 @@ urlpatterns = [
     url(r'^input/', views.input),
     url(r'^about/$', views.about),
     url(r'^random', views.random_example),
+    url(r'^_ah/warmup$', views.warmup),
 
     url(r'card/(?P<card_name>\w*)$', views.eval_card),
 
     url(r'card_info/(?P<card_name>\w*)$', views.get_card_info),
 
-    url(r'card_full/(?P<card_name>\w*)$', views.get_card_full)
+    url(r'card_full/(?P<card_name>\w*)$', views.get_card_full),
 
+    url(r'^card_events$', views.card_events),
+    url(r'^cancel$', views.cancel),
+
+    url(r'^api/input$', views.api_input),
+    url(r'^api/batch$', views.batch),
+
+    url(r'^metrics$', views.metrics),
+
+    url(r'^admin/slow_queries$', views.slow_queries_list),
+    url(r'^admin/slow_queries/(?P<entry_id>\d+)$', views.slow_query),
+    url(r'^admin/memory$', views.memory_sites),
 
     # Uncomment the admin/doc line below and add 'django.contrib.admindocs'
     # to INSTALLED_APPS to enable admin documentation:
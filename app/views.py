@@ -1,31 +1,172 @@
 from __future__ import absolute_import
 
 import sympy
-from django.http import HttpResponse, Http404
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseForbidden, Http404,
+                         StreamingHttpResponse)
+from django.http.response import HttpResponseBase
 from django.shortcuts import render, redirect
+from django.template import engines
 from django.template.loader import render_to_string
 from django import forms
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_POST
 
 from .constants import LIVE_PROMOTION_MESSAGES, EXAMPLES
 from app.logic.logic import SymPyGamma
+from app.logic.executor import (ComputationAborted, EvaluationExecutor,
+                                Spawner)
+from app.logic.cache import CardCache, MemoryBackend
+from app.logic.batch import evaluate, evaluate_cards, iter_cards, run_batch
+from app.logic.batch import card_events as iter_card_events
+from app.logic.warmup import example_inputs, warmup as run_warmup
+from app.logic.timing import span
+from app.logic.profiling import profile, sample
+from app.logic import memory
 
 from app import settings
 from . import models
+from .metrics import MeteredGamma
+from .metrics import render as render_metrics
+from .querylog import QueryLog
+from .sketches import PopularityTracker, SeenFilter
+from .slowlog import RecordingGamma, SlowQueryLog, SlowQueryRecorder
 
 import os
 import random
 import json
 import six.moves.urllib.request, six.moves.urllib.parse, six.moves.urllib.error
 import six.moves.urllib.request, six.moves.urllib.error, six.moves.urllib.parse
+import atexit
+import contextvars
 import datetime
+import functools
+import hashlib
+import hmac
+import threading
 import traceback
 
 import logging
 
-from google.cloud import datastore
 
-
-datastore_client = models.datastore_client
+_spawner = None
+_executor = None
+_batch_executor = None
+_executor_lock = threading.Lock()
+_spawner_lock = threading.Lock()
+_query_log = None
+
+# Set while a request is profiled (see :func:`profiled`)
+_profiling = contextvars.ContextVar('profiling', default=False)
+
+popularity = PopularityTracker(
+    width=settings.POPULARITY_WIDTH, depth=settings.POPULARITY_DEPTH,
+    k=settings.POPULARITY_TOP_K,
+    merge_interval=settings.POPULARITY_MERGE_INTERVAL,
+    path=settings.POPULARITY_PATH)
+if settings.POPULARITY_PATH:
+    atexit.register(popularity.merge)
+
+if settings.MEMORY_ACCOUNTING and not settings.EVALUATION_WORKERS:
+    memory.start()
+
+
+def start_spawner():
+    """Start the process the evaluation workers of both pools are forked
+    from, if there are workers.
+
+    The spawner inherits the address space and the locks of this process,
+    so app/wsgi.py starts it while only the main thread runs, before any
+    request. Otherwise it starts with the first pool.
+    """
+    global _spawner
+    if not settings.EVALUATION_WORKERS:
+        return None
+    with _spawner_lock:
+        if _spawner is None:
+            _spawner = Spawner(
+                memory_limit=settings.EVALUATION_MEMORY_LIMIT * 2 ** 20,
+                max_tasks=settings.EVALUATION_MAX_TASKS,
+                recycle_rss=settings.EVALUATION_RECYCLE_RSS * 2 ** 20,
+                trace_memory=settings.MEMORY_ACCOUNTING)
+    return _spawner
+
+
+def _start_executor(workers):
+    return EvaluationExecutor(workers, settings.EVALUATION_DEADLINES,
+                              spawner=start_spawner())
+
+
+def _instrument(gamma):
+    if settings.SLOW_QUERY_THRESHOLD:
+        gamma = RecordingGamma(gamma, slow_queries)
+    return MeteredGamma(gamma)
+
+
+def get_gamma():
+    """Return the object that evaluates inputs and cards.
+
+    That is the pool of evaluation workers, or a plain SymPyGamma evaluating
+    in the request thread if ``EVALUATION_WORKERS`` is 0, recording its
+    metrics and slow queries either way. Profiled requests get a plain
+    SymPyGamma without card cache, so the computation happens where the
+    profiler sees it.
+    """
+    global _executor
+    if _profiling.get():
+        return SymPyGamma(cache=CardCache(MemoryBackend(maxsize=0)))
+    if not settings.EVALUATION_WORKERS:
+        return _instrument(SymPyGamma())
+    with _executor_lock:
+        if _executor is None:
+            _executor = _start_executor(settings.EVALUATION_WORKERS)
+    return _instrument(_executor)
+
+
+def get_batch_gamma():
+    """Like :func:`get_gamma`, but for batch requests.
+
+    Batches get their own, separate pool of ``BATCH_EVALUATION_WORKERS``
+    workers so a large batch can't starve interactive requests.
+    """
+    global _batch_executor
+    if not settings.EVALUATION_WORKERS or not settings.BATCH_EVALUATION_WORKERS:
+        return _instrument(SymPyGamma())
+    with _executor_lock:
+        if _batch_executor is None:
+            _batch_executor = _start_executor(
+                settings.BATCH_EVALUATION_WORKERS)
+    return _instrument(_batch_executor)
+
+
+def _profiling_gamma():
+    """Where slow queries are profiled again: the batch workers if there
+    are any, so the re-runs don't take workers from interactive requests."""
+    if settings.EVALUATION_WORKERS and settings.BATCH_EVALUATION_WORKERS:
+        return get_batch_gamma()
+    return get_gamma()
+
+
+slow_queries = SlowQueryRecorder(
+    SlowQueryLog(settings.SLOW_QUERY_DIR, settings.SLOW_QUERY_LOG_SIZE),
+    threshold=settings.SLOW_QUERY_THRESHOLD,
+    profile_limit=settings.SLOW_QUERY_PROFILE_LIMIT,
+    profiler=_profiling_gamma)
+
+
+def _shutdown():
+    """Stop profiling slow queries, then the evaluation workers it uses."""
+    slow_queries.stop()
+    for executor in (_executor, _batch_executor):
+        if executor is not None:
+            executor.shutdown()
+    if _spawner is not None:
+        _spawner.stop()
+
+
+atexit.register(_shutdown)
 
 
 class MobileTextInput(forms.widgets.TextInput):
@@ -42,21 +183,104 @@ class SearchForm(forms.Form):
 
 
 def app_meta(view):
+    @functools.wraps(view)
     def _wrapper(request, *args, **kwargs):
         result = view(request, *args, **kwargs)
-        version = os.environ['GAE_VERSION']
+        # unpacking a streaming response would consume it
+        if isinstance(result, HttpResponseBase):
+            return result
 
         try:
             template, params = result
-            params['app_version'] = version
-            params['sympy_version'] = sympy.__version__
-            params['current_year'] = datetime.datetime.now().year
-            return render(request, template, params)
+            with span('render'):
+                return render(request, template, _meta(params))
         except ValueError:
             return result
     return _wrapper
 
 
+def _check_admin(request):
+    """Raise Http404 if no ``ADMIN_TOKEN`` is configured; return whether
+    the request carries it in its ``X-Gamma-Admin-Token`` header (never in
+    the URL, which ends up in logs and browser history)."""
+    if not settings.ADMIN_TOKEN:
+        raise Http404
+    token = request.META.get('HTTP_X_GAMMA_ADMIN_TOKEN', '')
+    return hmac.compare_digest(token.encode('utf-8'),
+                               settings.ADMIN_TOKEN.encode('utf-8'))
+
+
+def admin_required(view):
+    """Restrict ``view`` to requests carrying ``ADMIN_TOKEN``; without
+    one configured, it doesn't exist."""
+    @functools.wraps(view)
+    def _wrapper(request, *args, **kwargs):
+        if not _check_admin(request):
+            return HttpResponseForbidden()
+        return view(request, *args, **kwargs)
+    return _wrapper
+
+
+def profiled(view):
+    """Let admins profile ``view`` with ``profile=cprofile`` (a pstats
+    summary, or with ``format=prof`` the dump) or ``profile=sample``
+    (collapsed stacks for a flame graph) in the query string.
+
+    The profile is returned instead of the page. Profiled requests compute
+    in the request thread, without deadline, eager cards or streaming:
+    cards are profiled on their own through ``/card/``.
+    """
+    @functools.wraps(view)
+    def _wrapper(request, *args, **kwargs):
+        mode = request.GET.get('profile')
+        if not mode or not settings.ADMIN_TOKEN:
+            return view(request, *args, **kwargs)
+        if not _check_admin(request):
+            return HttpResponseForbidden()
+        if mode not in ('cprofile', 'sample'):
+            return HttpResponseBadRequest(
+                "profile must be 'cprofile' or 'sample'")
+
+        def run():
+            response = view(request, *args, **kwargs)
+            if getattr(response, 'streaming', False):
+                for _ in response:
+                    pass
+
+        token = _profiling.set(True)
+        try:
+            if mode == 'sample':
+                result = sample(run)
+            else:
+                result = profile(run)
+        finally:
+            _profiling.reset(token)
+
+        if mode == 'sample':
+            response = HttpResponse(result['stacks'],
+                                    content_type="text/plain")
+            response['Content-Disposition'] = \
+                f'inline; filename="{view.__name__}.folded"'
+        elif request.GET.get('format') == 'prof':
+            response = HttpResponse(result['profile'],
+                                    content_type="application/octet-stream")
+            response['Content-Disposition'] = \
+                f'attachment; filename="{view.__name__}.prof"'
+        else:
+            response = HttpResponse(result['summary'],
+                                    content_type="text/plain")
+        response['X-Gamma-Profile-Outcome'] = result['outcome']
+        return response
+    return _wrapper
+
+
+def _meta(params):
+    params['app_version'] = os.environ['GAE_VERSION']
+    params['sympy_version'] = sympy.__version__
+    params['current_year'] = datetime.datetime.now().year
+    return params
+
+
 @app_meta
 def index(request):
     form = SearchForm()
@@ -70,15 +294,99 @@ def index(request):
         })
 
 
-def input_exists(input):
-    logging.info(f'Checking if input exists...: {input}')
-    query = datastore_client.query(kind='Query')
-    query = query.add_filter('text', '=', input)
-    result = list(query.fetch(limit=1))
-    logging.info(f'Input result: {result}')
-    return result
+def _eager(request):
+    if _profiling.get():
+        return False
+    eager = request.GET.get('eager')
+    if eager is None:
+        return settings.EAGER_CARDS
+    return eager.lower() not in ('', '0', 'false')
+
+
+def inline_cards(g, input, result):
+    """Evaluate the cards of ``result`` before rendering the page.
+
+    Cards that finish within ``EAGER_CARD_BUDGET`` seconds are rendered with
+    their output; the page loads the others from ``/card/`` as usual.
+    """
+    outputs = evaluate_cards(g, input, result, settings.EAGER_CARD_BUDGET,
+                             settings.EVALUATION_WORKERS or None)
+    for card in result:
+        output = outputs.get(card.get('card'), {}).get('output')
+        if output is not None:
+            card['cell_output'] = output
+
+
+def _streaming(request):
+    if _profiling.get():
+        return False
+    stream = request.GET.get('stream')
+    if stream is None:
+        return settings.STREAM_RESULTS
+    return stream.lower() not in ('', '0', 'false')
+
+
+# Where result.html is split when streaming, between the cards rendered at
+# once and those flushed as they are evaluated
+STREAM_MARKER = '<!-- gamma:cards -->'
+
+
+def stream_result(request, g, input, result, params):
+    """Stream the result page, flushing each card as it is evaluated.
+
+    The page up to the cards, with the cells that need no evaluation (Input,
+    SymPy, ...), is sent at once. Cards follow in the order they finish, and
+    those that miss ``STREAM_CARD_BUDGET`` are sent last as placeholders
+    that load from ``/card/``.
+    """
+    params['streaming'] = STREAM_MARKER
+    with span('render'):
+        page = render_to_string("result.html", _meta(params), request)
+    head, tail = page.split(STREAM_MARKER, 1)
+    fragment = engines['django'].from_string(
+        '{% load extra_tags %}{% show_card cell input %}')
+
+    def content():
+        yield head
+        for card, output in iter_cards(g, input, result,
+                                       settings.STREAM_CARD_BUDGET,
+                                       settings.EVALUATION_WORKERS or None):
+            if output is not None:
+                card = dict(card)
+                if 'output' in output:
+                    card['cell_output'] = output['output']
+                else:
+                    card['error'] = output.get('error')
+            with span('render'):
+                html = fragment.render({'cell': card, 'input': input})
+            yield html
+        yield tail
+
+    return StreamingHttpResponse(content(), content_type="text/html")
+
+
+def get_query_log():
+    global _query_log
+    with _executor_lock:
+        if _query_log is None:
+            seen = SeenFilter(settings.SEEN_FILTER_CAPACITY,
+                              settings.SEEN_FILTER_ERROR_RATE,
+                              settings.SEEN_FILTER_LRU_SIZE)
+            _query_log = QueryLog(maxsize=settings.QUERY_LOG_QUEUE_SIZE,
+                                  batch_size=settings.QUERY_LOG_BATCH_SIZE,
+                                  flush_interval=settings.QUERY_LOG_FLUSH_INTERVAL,
+                                  seen=seen)
+            atexit.register(_query_log.close)
+    return _query_log
 
 
+def log_query(input):
+    """Record the input in the Datastore, off the request path."""
+    popularity.add('input', models.normalize_query(input))
+    get_query_log().add(input)
+
+
+@profiled
 @app_meta
 def input(request):
     logging.info('Got the input from user')
@@ -90,7 +398,7 @@ def input(request):
             if input.strip().lower() in ('random', 'example', 'random example'):
                 return redirect('/random')
 
-            g = SymPyGamma()
+            g = get_gamma()
             r = g.eval(input)
 
             if not r:
@@ -99,26 +407,22 @@ def input(request):
                     "input": input,
                     "output": "Can't handle the input."
                 }]
+            elif _eager(request) and not _streaming(request):
+                inline_cards(g, input, r)
 
-            if not input_exists(input):
-                logging.info('Input does not exists, inserting into datastore..')
-                entity = datastore.Entity(key=datastore_client.key('Query'))
-                entity.update({
-                    "text": input,
-                    "user_id": None,
-                    "date": datetime.datetime.utcnow(),
-                })
-                logging.info(f'Inserting entity: {entity}')
-                put_result = datastore_client.put(entity)
-                logging.info(f'Input insert result: {put_result}')
+            log_query(input)
             # For some reason the |random tag always returns the same result
-            return ("result.html", {
+            params = {
                 "input": input,
                 "result": r,
                 "form": form,
                 "MEDIA_URL": settings.STATIC_URL,
+                "card_events": settings.CARD_EVENTS,
                 "promote_live": random.choice(LIVE_PROMOTION_MESSAGES)
-                })
+                }
+            if _streaming(request):
+                return stream_result(request, g, input, r, params)
+            return ("result.html", params)
 
 
 @app_meta
@@ -130,17 +434,132 @@ def about(request):
 
 
 def random_example(request):
-    examples = []
+    examples = example_inputs(EXAMPLES)
+    return redirect('input/?i=' + six.moves.urllib.parse.quote(random.choice(examples)))
 
-    for category in EXAMPLES:
-        for subcategory in category[1]:
-            for example in subcategory[1]:
-                if isinstance(example, tuple):
-                    examples.append(example[1])
-                else:
-                    examples.append(example)
 
-    return redirect('input/?i=' + six.moves.urllib.parse.quote(random.choice(examples)))
+_warmup_report = None
+# Held while warming up, so concurrent warmup requests run it once without
+# holding up get_gamma()
+_warmup_lock = threading.Lock()
+
+
+def warmup(request):
+    """App Engine warmup request: prime SymPy before serving traffic.
+
+    The corpus (``EXAMPLES``, or one input per line of the file named by
+    ``WARMUP_CORPUS``) is evaluated by the spawner of the evaluation workers
+    (see :func:`start_spawner`) before the workers are started, or in this
+    process without workers. The workers are forked from the spawner, so
+    they, and any workers replacing them later, start with warm caches,
+    unless a request started them first. The popular inputs of the
+    popularity record come from users, so they are only evaluated by the
+    workers, under their deadlines, with what is left of the budget. The
+    batch workers only start with the first batch, so instances that never
+    serve one don't run them. Warmup only runs once per process.
+    """
+    global _warmup_report
+    with _warmup_lock:
+        if _warmup_report is None:
+            if settings.WARMUP_CORPUS:
+                with open(settings.WARMUP_CORPUS) as f:
+                    corpus = [line.strip() for line in f if line.strip()]
+            else:
+                corpus = example_inputs(EXAMPLES)
+            spawner = start_spawner()
+            if spawner is not None:
+                report = spawner.warm(corpus, settings.WARMUP_BUDGET)
+                if report is None:
+                    report = {'inputs': 0, 'cards': 0, 'errors': 1,
+                              'complete': False, 'elapsed': 0}
+            else:
+                report = run_warmup(SymPyGamma(), corpus,
+                                    settings.WARMUP_BUDGET)
+            remaining = settings.WARMUP_BUDGET - report['elapsed']
+            if settings.EVALUATION_WORKERS and remaining > 0:
+                popularity.load()
+                popular = [i for i in popularity.popular('input')
+                           if i not in corpus]
+                if popular:
+                    report['popular'] = run_warmup(get_gamma(), popular,
+                                                   remaining)
+            _warmup_report = report
+    get_gamma()
+    return HttpResponse(json.dumps(_warmup_report),
+                        content_type="application/json")
+
+
+def _api_cards(request):
+    """Parse the ``cards`` parameter of the JSON API.
+
+    ``cards=1`` (or ``true``/``all``) asks for every card, a comma-separated
+    list of card names for those cards only.
+    """
+    cards = request.GET.get('cards', '').strip()
+    if cards.lower() in ('', '0', 'false'):
+        return False
+    if cards.lower() in ('1', 'true', 'all'):
+        return True
+    return sorted(set(name.strip() for name in cards.split(',') if name.strip()))
+
+
+def _api_input_etag(request):
+    # A successful result depends only on the input, the requested cards and
+    # the code, so it can be validated without evaluating anything. Failed
+    # results (timeouts, workers out of memory...) carry no ETag.
+    key = json.dumps([
+        request.GET.get('i', ''),
+        _api_cards(request),
+        sympy.__version__,
+        os.environ.get('GAE_VERSION'),
+    ])
+    return quote_etag(hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def _failed(result):
+    """Whether a card of an :func:`evaluate` result failed."""
+    cards = result['result'] + list(result.get('cards', {}).values())
+    return any('error' in card or 'exception_info' in card for card in cards)
+
+
+def api_input(request):
+    """JSON version of ``/input``: the cards of an input, without the page.
+
+    With ``cards`` the results of the cards are included as well, keyed by
+    card name. Successful responses carry an ETag, so clients can
+    revalidate them with If-None-Match instead of evaluating the input
+    again. Responses with a failed card may not be stored: the failure may
+    be transient.
+
+    Responses may be shared by caches, so they leave out the ``eval_id``
+    of the cards: ``/cancel`` stops the computations of an ``eval_id``.
+    """
+    etag = _api_input_etag(request)
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        return response
+
+    input = request.GET.get('i', '')
+    if not input.strip():
+        return HttpResponseBadRequest(json.dumps({'error': 'No input given.'}),
+                                      content_type="application/json")
+
+    result = evaluate(get_gamma(), input, _api_cards(request))
+    for card in result['result']:
+        card.pop('eval_id', None)
+    result['sympy_version'] = sympy.__version__
+    result['app_version'] = os.environ.get('GAE_VERSION')
+    log_query(input)
+
+    response = HttpResponse(json.dumps(result), content_type="application/json")
+    if _failed(result):
+        patch_cache_control(response, no_store=True)
+    else:
+        patch_cache_control(response, public=True,
+                            max_age=settings.API_CACHE_MAX_AGE)
+        response['ETag'] = etag
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
 
 
 def _process_card(request, card_name):
@@ -152,21 +571,25 @@ def _process_card(request, card_name):
     variable = six.moves.urllib.parse.unquote(variable)
     expression = six.moves.urllib.parse.unquote(expression)
 
-    g = SymPyGamma()
+    g = get_gamma()
 
     parameters = {}
     for key, val in request.GET.items():
         parameters[key] = ''.join(val)
+    eval_id = parameters.pop('eval_id', None)
+    popularity.add('card', card_name + ':' + models.normalize_query(expression))
 
-    return g, variable, expression, parameters
+    return g, variable, expression, parameters, eval_id
 
 
+@profiled
 def eval_card(request, card_name):
-    g, variable, expression, parameters = _process_card(request, card_name)
+    g, variable, expression, parameters, eval_id = _process_card(request, card_name)
 
     try:
-        result = g.eval_card(card_name, expression, variable, parameters)
-    except ValueError as e:
+        result = g.eval_card(card_name, expression, variable, parameters,
+                             eval_id=eval_id)
+    except (ValueError, ComputationAborted) as e:
         logging.exception(f"Exception:\n{e}\n")
         return HttpResponse(json.dumps({
             'error': str(e)
@@ -183,11 +606,12 @@ def eval_card(request, card_name):
 
 
 def get_card_info(request, card_name):
-    g, variable, expression, _ = _process_card(request, card_name)
+    g, variable, expression, _, eval_id = _process_card(request, card_name)
 
     try:
-        result = g.get_card_info(card_name, expression, variable)
-    except ValueError as e:
+        result = g.get_card_info(card_name, expression, variable,
+                                 eval_id=eval_id)
+    except (ValueError, ComputationAborted) as e:
         logging.exception(f"Exception:\n{e}\n")
         return HttpResponse(json.dumps({
             'error': str(e)
@@ -203,12 +627,82 @@ def get_card_info(request, card_name):
     return HttpResponse(json.dumps(result), content_type="application/json")
 
 
+def card_events(request):
+    """Server-Sent Events stream of the results of several cards.
+
+    Takes the ``expression``, ``variable`` and ``eval_id`` of the card
+    endpoints plus one ``card`` parameter per card, and evaluates the cards
+    concurrently, sending an event as each finishes (see
+    :func:`app.logic.batch.card_events`). Cards that miss the budget are
+    cancelled, as are those not yet finished if the client disconnects.
+    Result pages only use it with ``CARD_EVENTS`` on.
+    """
+    variable = request.GET.get('variable')
+    expression = request.GET.get('expression')
+    names = request.GET.getlist('card')
+    if not variable or not expression or not names:
+        raise Http404
+
+    variable = six.moves.urllib.parse.unquote(variable)
+    expression = six.moves.urllib.parse.unquote(expression)
+    eval_id = request.GET.get('eval_id')
+    cards = [{'card': name, 'var': variable, 'eval_id': eval_id}
+             for name in names]
+    events = iter_card_events(get_gamma(), expression, cards,
+                              settings.STREAM_CARD_BUDGET,
+                              settings.CARD_EVENTS_HEARTBEAT,
+                              settings.EVALUATION_WORKERS or None)
+
+    def content():
+        for event in events:
+            yield f"event: {event.pop('event')}\ndata: {json.dumps(event)}\n\n"
+
+    response = StreamingHttpResponse(content(),
+                                     content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    # keep proxies from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@csrf_exempt
+@require_POST
+def cancel(request):
+    """Stop the computations still running for an evaluation.
+
+    ``card.js`` sends the ``eval_id`` of the page with ``sendBeacon`` when the
+    page is left, so the workers go back to live requests. Only this
+    instance's workers are affected.
+    """
+    if request.content_type in ('application/x-www-form-urlencoded',
+                                'multipart/form-data'):
+        # the body has been read into POST
+        eval_id = request.POST.get('eval_id', '')
+    else:
+        eval_id = request.body.decode('utf-8', 'replace')
+    eval_id = eval_id.strip()
+    if not eval_id:
+        return HttpResponseBadRequest(
+            json.dumps({'error': 'No eval_id given.'}),
+            content_type="application/json")
+    g = get_gamma()
+    cancelled = 0
+    # only the pool of workers can stop computations
+    if hasattr(g, 'cancel'):
+        cancelled = g.cancel(eval_id)
+    return HttpResponse(json.dumps({'cancelled': cancelled}),
+                        content_type="application/json")
+
+
 def get_card_full(request, card_name):
-    g, variable, expression, parameters = _process_card(request, card_name)
+    g, variable, expression, parameters, eval_id = _process_card(request, card_name)
 
+    card_info = None
     try:
-        card_info = g.get_card_info(card_name, expression, variable)
-        result = g.eval_card(card_name, expression, variable, parameters)
+        card_info = g.get_card_info(card_name, expression, variable,
+                                    eval_id=eval_id)
+        result = g.eval_card(card_name, expression, variable, parameters,
+                             eval_id=eval_id)
         card_info['card'] = card_name
         card_info['cell_output'] = result['output']
 
@@ -216,8 +710,10 @@ def get_card_full(request, card_name):
             'cell': card_info,
             'input': expression
         })
-    except ValueError as e:
-        card_info = g.get_card_info(card_name, expression, variable)
+    except (ValueError, ComputationAborted) as e:
+        if card_info is None:
+            # getting the card's info failed too, e.g. it was cancelled
+            card_info = {'title': card_name, 'input': expression}
         return HttpResponse(render_to_string('card.html', {
             'cell': {
                 'title': card_info['title'],
@@ -247,6 +743,106 @@ def get_card_full(request, card_name):
     return response
 
 
+@csrf_exempt
+@require_POST
+def batch(request):
+    """Evaluate a JSON list of inputs, streaming results as NDJSON.
+
+    The body is ``{"inputs": [...], "cards": ...}`` where ``cards`` is
+    ``true`` for every card, a list of card names, or ``false`` (the
+    default). One JSON object is written per input, in completion order,
+    with the ``index`` of its input.
+    """
+    try:
+        payload = json.loads(request.body.decode('utf-8'))
+        inputs = payload['inputs']
+        cards = payload.get('cards', False)
+        if not (isinstance(inputs, list) and
+                all(isinstance(i, str) for i in inputs)):
+            raise ValueError("inputs must be a list of strings")
+        if not (isinstance(cards, bool) or (isinstance(cards, list) and
+                all(isinstance(c, str) for c in cards))):
+            raise ValueError("cards must be a boolean or a list of card names")
+        if len(inputs) > settings.BATCH_MAX_INPUTS:
+            raise ValueError(f"at most {settings.BATCH_MAX_INPUTS} inputs "
+                             f"are allowed per batch")
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError) as e:
+        return HttpResponseBadRequest(json.dumps({'error': str(e)}),
+                                      content_type="application/json")
+
+    g = get_batch_gamma()
+    concurrency = settings.BATCH_EVALUATION_WORKERS or 1
+    lines = (json.dumps(result) + '\n'
+             for result in run_batch(g, inputs, cards, concurrency))
+    return StreamingHttpResponse(lines, content_type="application/x-ndjson")
+
+
+def metrics(request):
+    """Metrics of every process serving the app, for Prometheus."""
+    return HttpResponse(render_metrics(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@admin_required
+def slow_queries_list(request):
+    """The recorded slow queries, newest first, without their profiles."""
+    entries = [{key: value for key, value in entry.items()
+                if key != 'profile_summary'}
+               for entry in slow_queries.log.entries()]
+    return HttpResponse(json.dumps(entries), content_type="application/json")
+
+
+@admin_required
+def slow_query(request, entry_id):
+    """One slow query with its profile summary, or with ``format=prof``
+    its profile, to load with :mod:`pstats` or snakeviz."""
+    entry_id = int(entry_id)
+    entry = slow_queries.log.get(entry_id)
+    if entry is None:
+        raise Http404
+    if request.GET.get('format') == 'prof':
+        path = slow_queries.log.profile_path(entry_id)
+        if path is None:
+            raise Http404
+        try:
+            with open(path, 'rb') as f:
+                dump = f.read()
+        except OSError:
+            # overwritten meanwhile
+            raise Http404
+        response = HttpResponse(dump, content_type="application/octet-stream")
+        response['Content-Disposition'] = \
+            f'attachment; filename="slow-query-{entry_id}.prof"'
+        return response
+    return HttpResponse(json.dumps(entry), content_type="application/json")
+
+
+@admin_required
+def memory_sites(request):
+    """Where the memory held after evaluating input ``i``, or its card
+    ``card`` with ``variable`` (``x`` by default), was allocated.
+
+    ``group`` is ``lineno`` (the default), ``filename`` or ``traceback``.
+    See :func:`app.logic.memory.top_sites`.
+    """
+    expression = request.GET.get('i')
+    group = request.GET.get('group', 'lineno')
+    if not expression or group not in ('lineno', 'filename', 'traceback'):
+        return HttpResponseBadRequest(
+            "i is required, and group must be lineno, filename or traceback")
+    card_name = request.GET.get('card')
+    if card_name:
+        method = 'eval_card'
+        args = (card_name, expression, request.GET.get('variable', 'x'), {})
+    else:
+        method, args = 'eval', (expression,)
+    try:
+        result = get_gamma().memory_sites(method, args, {}, group=group)
+    except ComputationAborted as e:
+        result = {'outcome': str(e)}
+    return HttpResponse(json.dumps(result), content_type="application/json")
+
+
 @app_meta
 def view_404(request, exception):
     return "404.html", {}
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "app.settings")
 
 application = get_wsgi_application()
+
+# fork the process the evaluation workers come from while this is the only
+# thread (see app.views.start_spawner)
+from app import views  # noqa: E402
+
+views.start_spawner()
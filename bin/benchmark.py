@@ -0,0 +1,260 @@
+"""
+Benchmarks the evaluation pipeline on every example input.
+
+Runs each input of ``EXAMPLES`` (or of ``--input``) through the stages of an
+``/input`` request and its cards, timing them separately: parsing and
+evaluation (the two halves of ``eval_input``), ``find_result_set`` (with the
+conversion of the input it picks), ``latexify`` (of function calls, as in
+``prepare_cards``) and ``mathjax_latex`` of the input, and each card's
+``eval`` and ``format_output``. The card cache is bypassed, and SymPy's
+cache is cleared before every run unless ``--warm`` is given, so the
+timings are those of a first request. Each input is run ``--repeat`` times
+and the median kept.
+
+A card that takes longer than ``--timeout`` seconds is stopped and recorded
+as timed out. ``--json`` saves the results, which ``--compare`` checks a
+later run against, failing (exit status 1) if a stage got slower by more
+than ``--tolerance`` or a card started timing out or failing.
+
+Usage: python bin/benchmark.py [--input EXPR ...] [--repeat N] [--warm]
+                               [--timeout SECONDS] [--json FILE]
+                               [--compare FILE [--tolerance PERCENT]]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import os
+import signal
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sympy  # noqa: E402
+from sympy.core.cache import clear_cache  # noqa: E402
+from sympy.parsing.sympy_parser import eval_expr  # noqa: E402
+
+from app.constants import EXAMPLES  # noqa: E402
+from app.logic.logic import (  # noqa: E402
+    SymPyGamma, base_namespace, mathjax_latex)
+from app.logic.resultsets import get_card  # noqa: E402
+from app.logic.utils import Eval, arguments, latexify  # noqa: E402
+from app.logic.warmup import example_inputs, import_card_modules  # noqa: E402
+
+STAGES = ['parse', 'evaluate', 'find_result_set', 'latexify', 'mathjax_latex']
+CARD_STAGES = ['eval', 'format_output']
+
+# Seconds between alarms once a card is over its timeout: Eval.eval
+# catches everything, so a single alarm can be swallowed
+ALARM_INTERVAL = 0.1
+
+# Stages that take less than this (in milliseconds) aren't compared, their
+# timings are mostly noise
+COMPARE_MINIMUM = 1
+
+
+class BenchmarkTimeout(BaseException):
+    # not an Exception, so SymPy's own ``except Exception`` can't swallow it
+    pass
+
+
+def _alarm(signum, frame):
+    raise BenchmarkTimeout()
+
+
+def timed(timings, stage, func, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    timings.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+    return value
+
+
+def run_card(timings, card_name, evaluator, components, evaluated, timeout):
+    """Time one card like ``eval_card`` evaluates it, minus the cache."""
+    card = get_card(card_name)
+    variable = components['variable']
+    evaluator.set(str(variable), variable)
+    signal.setitimer(signal.ITIMER_REAL, timeout, ALARM_INTERVAL)
+    try:
+        result = timed(timings, 'eval', card.eval, evaluator, components, {})
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    if timings['eval'][-1] >= timeout * 1000:
+        raise BenchmarkTimeout()
+    timed(timings, 'format_output', card.format_output, result, mathjax_latex)
+
+
+def run_input(gamma, expression, timings, card_timings, card_errors,
+              timeout):
+    """Run ``expression`` through the pipeline once, adding to timings."""
+    namespace, parsed = timed(timings, 'parse', gamma.parse_input, expression)
+    evaluator = Eval(namespace)
+
+    def evaluate():
+        evaluated = eval_expr(parsed, namespace, namespace)
+        namespace['input_evaluated'] = evaluated
+        return evaluated, arguments(parsed, evaluator)
+
+    evaluated, args = timed(timings, 'evaluate', evaluate)
+    components, cards, evaluated, is_function = timed(
+        timings, 'find_result_set', gamma.get_cards, args, evaluator,
+        evaluated)
+    # like prepare_cards, only function calls are rendered by latexify
+    if is_function:
+        timed(timings, 'latexify', latexify, parsed, evaluator)
+    timed(timings, 'mathjax_latex', mathjax_latex, evaluated)
+
+    for card_name in cards:
+        if card_name in card_errors or not get_card(card_name):
+            continue
+        try:
+            run_card(card_timings.setdefault(card_name, {}), card_name,
+                     evaluator, dict(components), evaluated, timeout)
+        except BenchmarkTimeout:
+            card_errors[card_name] = 'timeout'
+        except Exception as e:
+            card_errors[card_name] = '{}: {}'.format(type(e).__name__, e)
+
+
+def benchmark(expression, repeat, warm, timeout):
+    gamma = SymPyGamma()
+    timings, card_timings, card_errors = {}, {}, {}
+    try:
+        for _ in range(repeat):
+            if not warm:
+                clear_cache()
+            run_input(gamma, expression, timings, card_timings, card_errors,
+                      timeout)
+    except Exception as e:
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    result = {
+        'stages': {stage: statistics.median(times)
+                   for stage, times in timings.items()},
+        'cards': {},
+    }
+    for card_name, stages in card_timings.items():
+        if card_name in card_errors:
+            result['cards'][card_name] = {'error': card_errors[card_name]}
+        else:
+            result['cards'][card_name] = {
+                stage: statistics.median(times)
+                for stage, times in stages.items()}
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Return ``(input, stage, before, after)`` for every stage that got
+    slower than ``baseline`` allows, and every card that started failing
+    (with ``after`` its error)."""
+    regressions = []
+
+    def check(expression, stage, before, after):
+        if after < COMPARE_MINIMUM or before is None:
+            return
+        if after > before * (1 + tolerance / 100):
+            regressions.append((expression, stage, before, after))
+
+    for expression, result in sorted(results['inputs'].items()):
+        previous = baseline['inputs'].get(expression)
+        if previous is None or 'error' in previous:
+            continue
+        if 'error' in result:
+            regressions.append((expression, None, None, result['error']))
+            continue
+        for stage, after in result['stages'].items():
+            check(expression, stage, previous['stages'].get(stage), after)
+        for card_name, card in sorted(result['cards'].items()):
+            before = previous['cards'].get(card_name)
+            if before is None or 'error' in before:
+                continue
+            if 'error' in card:
+                regressions.append((expression, card_name, None,
+                                    card['error']))
+                continue
+            for stage, after in card.items():
+                check(expression, card_name + '.' + stage, before.get(stage),
+                      after)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--input', action='append',
+                        help="input to benchmark (repeatable, default: "
+                        "every example)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--warm', action='store_true',
+                        help="keep SymPy's cache between runs")
+    parser.add_argument('--timeout', type=float, default=10,
+                        help="seconds a card may take")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="results written by an earlier run")
+    parser.add_argument('--tolerance', type=float, default=25,
+                        help="allowed slowdown per stage, in percent")
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGALRM, _alarm)
+    import_card_modules()
+    # built once per process, as by a worker before its first request; left
+    # to the first parse, it would make that input look ~28ms slower
+    base_namespace()
+    inputs = args.input or example_inputs(EXAMPLES)
+    results = {
+        'sympy': sympy.__version__,
+        'repeat': args.repeat,
+        'warm': args.warm,
+        'inputs': {},
+    }
+    totals = dict.fromkeys(STAGES + CARD_STAGES, 0)
+
+    print("%-30s %9s %9s %9s %9s %9s %9s" % (
+        "input", "parse", "evaluate", "results", "latexify", "mathjax",
+        "cards"))
+    for expression in inputs:
+        result = benchmark(expression, args.repeat, args.warm, args.timeout)
+        results['inputs'][expression] = result
+        if 'error' in result:
+            print("%-30s %s" % (expression[:30], result['error']))
+            continue
+        for stage, elapsed in result['stages'].items():
+            totals[stage] += elapsed
+        cards = 0
+        for card in result['cards'].values():
+            for stage in CARD_STAGES:
+                cards += card.get(stage, 0)
+                totals[stage] += card.get(stage, 0)
+        print("%-30s %9s %9s %9s %9s %9s %9.1f" % tuple(
+            [expression[:30]] + ["%.1f" % result['stages'][stage]
+                                 if stage in result['stages'] else "-"
+                                 for stage in STAGES] + [cards]))
+        for card_name, card in sorted(result['cards'].items()):
+            if 'error' in card:
+                print("    %-26s %s" % (card_name, card['error'][:80]))
+    results['totals'] = totals
+    print("total (ms): " + ', '.join(
+        "%s %.1f" % (stage, totals[stage]) for stage in STAGES + CARD_STAGES))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    failed = False
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for expression, stage, before, after in compare(results, baseline,
+                                                        args.tolerance):
+            failed = True
+            if before is None:
+                print("failing: %s %s (%s)" % (expression, stage or '', after))
+            else:
+                print("slower: %s %s (%.1fms -> %.1fms)" % (
+                    expression, stage, before, after))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmarks building the evaluation namespace.
+
+Compares executing ``PREEXEC`` for every evaluation (what ``eval_input`` used
+to do) against layering a ``Namespace`` over the shared base namespace, and
+times ``eval_input`` on a few cheap queries.
+
+Usage: python bin/benchmark_namespace.py [--number N]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.logic.logic import PREEXEC, SymPyGamma, base_namespace  # noqa: E402
+from app.logic.utils import Namespace  # noqa: E402
+
+CHEAP_QUERIES = ['x', '242/33', 'sin(2x)']
+
+
+def fresh_namespace():
+    namespace = {}
+    exec(PREEXEC, {}, namespace)
+    return namespace
+
+
+def layered_namespace():
+    return Namespace(base_namespace())
+
+
+def best_of(func, number, repeat=5):
+    """Best time per call in microseconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=200,
+                        help='calls per timing run')
+    args = parser.parse_args()
+
+    # build the base once so it is not counted against the overlay
+    base_namespace()
+
+    fresh = best_of(fresh_namespace, args.number)
+    layered = best_of(layered_namespace, args.number)
+    print("%-32s %12s" % ("stage", "usec/call"))
+    print("%-32s %12.1f" % ("exec(PREEXEC) per evaluation", fresh))
+    print("%-32s %12.1f" % ("Namespace(base_namespace())", layered))
+    print("%-32s %12.1f" % ("saving per evaluation", fresh - layered))
+
+    g = SymPyGamma()
+    for query in CHEAP_QUERIES:
+        elapsed = best_of(lambda: g.eval_input(query), max(args.number // 10, 1))
+        print("%-32s %12.1f" % ("eval_input(%r)" % query, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Measures the import time of the app, module by module.
+
+Imports the given modules in a fresh interpreter with ``-X importtime`` and
+reports the slowest modules by cumulative import time, taking the median of
+several runs. Cold starts on App Engine pay this cost before the first
+request is served.
+
+``--budget`` fails (exit status 1) if the total import time exceeds the
+budget. ``--json`` saves the report, which ``--compare`` checks a later run
+against, failing if a module got slower by more than ``--tolerance``.
+
+Usage: python bin/importtime.py [--module main] [--top N] [--repeat N]
+                                [--budget MS] [--json FILE]
+                                [--compare FILE [--tolerance PERCENT]]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What the first request of a new instance imports: the WSGI entry point,
+# then the URLconf and views
+DEFAULT_MODULES = ['main', 'app.urls']
+
+# Modules that take less than this (in milliseconds) aren't compared, their
+# timings are mostly noise
+COMPARE_MINIMUM = 5
+
+
+def parse_importtime(output):
+    """Parse ``-X importtime`` output into ``{module: (self, cumulative)}``
+    in microseconds, and the total import time."""
+    modules = {}
+    total = 0
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # nested imports are indented below the import that triggered them
+        if not name[1:].startswith(' '):
+            total += int(cumulative_us)
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules, total
+
+
+def measure(modules):
+    code = '; '.join('import ' + module for module in modules)
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        sys.exit(process.stderr)
+    return parse_importtime(process.stderr)
+
+
+def report(modules, repeat):
+    runs = [measure(modules) for _ in range(repeat)]
+    names = set.intersection(*(set(timings) for timings, _ in runs))
+    return {
+        'total': statistics.median(total for _, total in runs) / 1000,
+        'modules': {
+            name: {
+                'self': statistics.median(t[name][0] for t, _ in runs) / 1000,
+                'cumulative': statistics.median(
+                    t[name][1] for t, _ in runs) / 1000,
+            } for name in names
+        },
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Return the modules that got slower than ``baseline`` allows."""
+    regressions = []
+    for name, timing in sorted(result['modules'].items()):
+        before = baseline['modules'].get(name)
+        after = timing['cumulative']
+        if after < COMPARE_MINIMUM:
+            continue
+        if before is None:
+            regressions.append((name, None, after))
+        elif after > before['cumulative'] * (1 + tolerance / 100):
+            regressions.append((name, before['cumulative'], after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--module', action='append',
+                        help="module to import (repeatable, default: %s)"
+                        % ', '.join(DEFAULT_MODULES))
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--budget', type=float,
+                        help="maximum total import time in milliseconds")
+    parser.add_argument('--json', help="write the report to this file")
+    parser.add_argument('--compare', help="report written by an earlier run")
+    parser.add_argument('--tolerance', type=float, default=20,
+                        help="allowed slowdown per module, in percent")
+    args = parser.parse_args()
+
+    result = report(args.module or DEFAULT_MODULES, args.repeat)
+    slowest = sorted(result['modules'].items(),
+                     key=lambda item: -item[1]['cumulative'])[:args.top]
+    print('{:>10} {:>10}  module'.format('self ms', 'cumul. ms'))
+    for name, timing in slowest:
+        print('{:10.1f} {:10.1f}  {}'.format(timing['self'],
+                                             timing['cumulative'], name))
+    print('total: {:.1f}ms'.format(result['total']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=1, sort_keys=True)
+
+    failed = False
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for name, before, after in compare(result, baseline, args.tolerance):
+            failed = True
+            if before is None:
+                print('new import: {} ({:.1f}ms)'.format(name, after))
+            else:
+                print('slower: {} ({:.1f}ms -> {:.1f}ms)'.format(
+                    name, before, after))
+    if args.budget is not None and result['total'] > args.budget:
+        failed = True
+        print('over budget: {:.1f}ms > {:.1f}ms'.format(result['total'],
+                                                       args.budget))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
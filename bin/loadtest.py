@@ -0,0 +1,417 @@
+"""
+Replays a query log against the app and reports its latencies.
+
+Each query of the log is loaded like a browser loads its page: ``/input``,
+then the cards the page left to the client the way ``Card.evaluateAll``
+does: in one ``/card_events`` stream if the page has several cards and is
+marked ``data-card-events`` (the ``CARD_EVENTS`` setting), otherwise with
+one ``/card/`` request each. ``--cards events`` or ``--cards card`` force
+either. ``--concurrency`` pages are loaded at once.
+
+By default the app runs in this process, called through
+``app.wsgi.application``, with the query log written to a temporary SQLite
+database instead of the Datastore. ``--url`` loads the pages from a running
+server instead.
+
+The log is JSON Lines: each line is a string, or an object with the query
+under ``input``, ``query``, ``text`` or ``expression``; other lines are
+skipped. The report gives the throughput, and per endpoint and per card the
+latency percentiles, a histogram and the error and timeout rates. A card
+counts as timed out if it gets a ``timeout`` event or its evaluation hit
+its deadline; over HTTP, a request counts as timed out after
+``--timeout`` seconds.
+
+Usage: python bin/loadtest.py LOG [--concurrency N] [--limit N]
+                              [--cards {page,events,card}] [--url URL]
+                              [--timeout SECONDS] [--json FILE]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import collections
+import io
+import json
+import math
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import wsgiref.util
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUERY_KEYS = ['input', 'query', 'text', 'expression']
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+HISTOGRAM_WIDTH = 40
+
+
+def read_queries(path):
+    queries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict):
+                entry = next((entry[key] for key in QUERY_KEYS
+                              if isinstance(entry.get(key), str)), None)
+            if isinstance(entry, str) and entry.strip():
+                queries.append(entry)
+    return queries
+
+
+class CardParser(HTMLParser):
+    """Collects the cards of a result page that still need evaluating."""
+
+    def __init__(self):
+        super(CardParser, self).__init__()
+        self.cards = []
+        # whether the page evaluates its cards over /card_events
+        self.card_events = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if attrs.get('data-card-events') == 'true':
+            self.card_events = True
+        if 'data-card-name' in attrs and 'data-evaluated' not in attrs:
+            self.cards.append({
+                'card': attrs['data-card-name'],
+                'variable': attrs.get('data-variable'),
+                'expression': attrs.get('data-expr'),
+                'eval_id': attrs.get('data-eval-id'),
+            })
+
+
+class Response(object):
+
+    def __init__(self, status, lines):
+        self.status = status
+        # the body, line by line as it arrives
+        self.lines = lines
+
+
+class WSGIClient(object):
+    """Calls a WSGI application directly."""
+
+    def __init__(self, application):
+        self.application = application
+
+    def get(self, path, params):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': urllib.parse.urlencode(params, doseq=True),
+            'wsgi.input': io.BytesIO(),
+        }
+        wsgiref.util.setup_testing_defaults(environ)
+        status = []
+
+        def start_response(line, headers, exc_info=None):
+            status.append(int(line.split()[0]))
+
+        body = self.application(environ, start_response)
+
+        def lines():
+            pending = b''
+            try:
+                for chunk in body:
+                    pending += chunk
+                    *complete, pending = pending.split(b'\n')
+                    for line in complete:
+                        yield line.decode('utf-8')
+                if pending:
+                    yield pending.decode('utf-8')
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+
+        return Response(status[0], lines())
+
+
+class HTTPClient(object):
+    """Sends requests to a running server."""
+
+    def __init__(self, url, timeout):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, path, params):
+        url = self.url + path + '?' + urllib.parse.urlencode(params,
+                                                             doseq=True)
+        try:
+            response = urllib.request.urlopen(url, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            return Response(e.code, iter([]))
+
+        def lines():
+            with response:
+                for line in response:
+                    yield line.decode('utf-8').rstrip('\r\n')
+
+        return Response(response.status, lines())
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.timeouts = 0
+
+    @property
+    def count(self):
+        return len(self.latencies) + self.errors + self.timeouts
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        # nearest rank
+        return latencies[max(math.ceil(len(latencies) * p / 100) - 1, 0)]
+
+    def histogram(self):
+        counts = [0] * (len(BUCKETS) + 1)
+        for latency in self.latencies:
+            counts[sum(1 for bound in BUCKETS if latency > bound)] += 1
+        return counts
+
+    def report(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'error_rate': self.errors / self.count if self.count else 0,
+            'timeout_rate': self.timeouts / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': max(self.latencies) if self.latencies else None,
+            'histogram': dict(zip([str(bound) for bound in BUCKETS] + ['inf'],
+                                  self.histogram())),
+        }
+
+
+class LoadTest(object):
+
+    def __init__(self, client, cards='page'):
+        self.client = client
+        self.cards = cards
+        self.endpoints = collections.defaultdict(Stats)
+        self.card_stats = collections.defaultdict(Stats)
+        self._lock = threading.Lock()
+
+    def record(self, stats, elapsed=None, error=False, timeout=False):
+        with self._lock:
+            if timeout:
+                stats.timeouts += 1
+            elif error:
+                stats.errors += 1
+            else:
+                stats.latencies.append(elapsed * 1000)
+
+    def record_card(self, name, elapsed, result):
+        error = result.get('error')
+        self.record(self.card_stats[name], elapsed, error=error is not None,
+                    timeout=error is not None and 'timed out' in error)
+
+    def request(self, endpoint, path, params):
+        """Make a request, returning its response and start time, or None
+        if it failed."""
+        start = time.monotonic()
+        try:
+            response = self.client.get(path, params)
+            if response.status >= 400:
+                self.record(self.endpoints[endpoint], error=True)
+                return None, start
+            return response, start
+        except socket.timeout:
+            self.record(self.endpoints[endpoint], timeout=True)
+        except Exception:
+            self.record(self.endpoints[endpoint], error=True)
+        return None, start
+
+    def load(self, query):
+        """Load the page of ``query`` and its cards."""
+        response, start = self.request('input', '/input/', {'i': query})
+        if response is None:
+            return
+        parser = CardParser()
+        try:
+            for line in response.lines:
+                parser.feed(line + '\n')
+        except socket.timeout:
+            self.record(self.endpoints['input'], timeout=True)
+            return
+        self.record(self.endpoints['input'], time.monotonic() - start)
+
+        events = (parser.card_events if self.cards == 'page'
+                  else self.cards == 'events')
+        if events and len(parser.cards) > 1:
+            self.card_events(parser.cards)
+        else:
+            for card in parser.cards:
+                self.card(card)
+
+    def card(self, card):
+        params = {'variable': card['variable'],
+                  'expression': card['expression']}
+        if card['eval_id']:
+            params['eval_id'] = card['eval_id']
+        response, start = self.request('card', '/card/' + card['card'], params)
+        if response is None:
+            self.record(self.card_stats[card['card']], error=True)
+            return
+        try:
+            result = json.loads('\n'.join(response.lines))
+        except socket.timeout:
+            self.record(self.endpoints['card'], timeout=True)
+            self.record(self.card_stats[card['card']], timeout=True)
+            return
+        elapsed = time.monotonic() - start
+        self.record(self.endpoints['card'], elapsed)
+        self.record_card(card['card'], elapsed, result)
+
+    def card_events(self, cards):
+        first = cards[0]
+        params = {'variable': first['variable'],
+                  'expression': first['expression'],
+                  'card': [card['card'] for card in cards]}
+        if first['eval_id']:
+            params['eval_id'] = first['eval_id']
+        response, start = self.request('card_events', '/card_events', params)
+        if response is None:
+            for card in cards:
+                self.record(self.card_stats[card['card']], error=True)
+            return
+        pending = set(card['card'] for card in cards)
+        event = None
+        try:
+            for line in response.lines:
+                if line.startswith('event: '):
+                    event = line[len('event: '):]
+                elif line.startswith('data: ') and event == 'card':
+                    data = json.loads(line[len('data: '):])
+                    pending.discard(data['card'])
+                    self.record_card(data['card'], time.monotonic() - start,
+                                     data['result'])
+                elif line.startswith('data: ') and event == 'timeout':
+                    data = json.loads(line[len('data: '):])
+                    pending.discard(data['card'])
+                    self.record(self.card_stats[data['card']], timeout=True)
+        except socket.timeout:
+            self.record(self.endpoints['card_events'], timeout=True)
+        else:
+            self.record(self.endpoints['card_events'],
+                        time.monotonic() - start)
+        for name in pending:
+            self.record(self.card_stats[name], timeout=True)
+
+    def run(self, queries, concurrency):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(self.load, queries))
+        elapsed = time.monotonic() - start
+        return {
+            'queries': len(queries),
+            'concurrency': concurrency,
+            'elapsed': elapsed,
+            'throughput': len(queries) / elapsed if elapsed else None,
+            'endpoints': {name: stats.report()
+                          for name, stats in sorted(self.endpoints.items())},
+            'cards': {name: stats.report()
+                      for name, stats in sorted(self.card_stats.items())},
+        }
+
+
+def print_stats(name, report, histogram=False):
+    def ms(value):
+        return '-' if value is None else '%.0f' % value
+
+    print("%-28s %6d %8s %8s %8s %6.1f%% %6.1f%%" % (
+        name, report['count'], ms(report['p50']), ms(report['p95']),
+        ms(report['p99']), report['error_rate'] * 100,
+        report['timeout_rate'] * 100))
+    if histogram:
+        counts = list(report['histogram'].items())
+        most = max([count for _, count in counts] + [1])
+        for bound, count in counts:
+            if count:
+                print("    <= %-7s %6d %s" % (bound, count, '#' * int(
+                    round(count / most * HISTOGRAM_WIDTH))))
+
+
+def in_process_client(store_path):
+    # the query log goes to SQLite rather than the Datastore
+    os.environ['GAMMA_QUERY_STORE'] = 'sqlite'
+    os.environ['GAMMA_QUERY_STORE_PATH'] = store_path
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+    # set by App Engine, the pages show it
+    os.environ.setdefault('GAE_VERSION', 'loadtest')
+    from app.wsgi import application
+    return WSGIClient(application)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('log', help="query log, one JSON query per line")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="pages loaded at once")
+    parser.add_argument('--limit', type=int, help="replay the first N queries")
+    parser.add_argument('--cards', choices=['page', 'events', 'card'],
+                        default='page',
+                        help="load cards from /card_events or /card/, or "
+                        "as the page says (default)")
+    parser.add_argument('--url', help="server to load the pages from "
+                        "(default: the app in this process)")
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="seconds a request to --url may take")
+    parser.add_argument('--json', help="write the report to this file")
+    args = parser.parse_args()
+
+    queries = read_queries(args.log)[:args.limit]
+    if not queries:
+        sys.exit("no queries in " + args.log)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.url:
+            client = HTTPClient(args.url, args.timeout)
+        else:
+            client = in_process_client(os.path.join(directory,
+                                                    'queries.sqlite3'))
+        report = LoadTest(client, args.cards).run(queries, args.concurrency)
+        if not args.url:
+            from app import views
+            views.get_query_log().close()
+
+    print("%d queries in %.1fs (%.2f/s) at concurrency %d" % (
+        report['queries'], report['elapsed'], report['throughput'],
+        report['concurrency']))
+    print("%-28s %6s %8s %8s %8s %7s %7s" % (
+        "endpoint / card", "count", "p50 ms", "p95 ms", "p99 ms", "errors",
+        "timeouts"))
+    for name, stats in report['endpoints'].items():
+        print_stats(name, stats, histogram=True)
+    for name, stats in report['cards'].items():
+        print_stats('  ' + name, stats)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
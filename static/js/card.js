@@ -1,5 +1,5 @@
 var Card = (function() {
-    function Card(card_name, variable, expr, parameters) {
+    function Card(card_name, variable, expr, parameters, eval_id) {
         this.card_name = card_name;
         this._fullscreen = false;
 
@@ -10,6 +10,9 @@ var Card = (function() {
         this.expr = expr;
         this.parameters = parameters;
         this.parameterValues = {};
+        // id of the server-side evaluation of expr, lets the server skip
+        // parsing the expression again
+        this.eval_id = eval_id;
 
         this._evaluateCallbacks = [];
         this.onEvaluate($.proxy(this.initApproximation, this));
@@ -36,6 +39,9 @@ var Card = (function() {
                 variable: this.variable,
                 expression: this.expr
             };
+            if (this.eval_id) {
+                parms.eval_id = this.eval_id;
+            }
             $.extend(parms, this.parameterValues);
             var deferred = $.getJSON(url, parms, finished);
             deferred.error(error);
@@ -71,6 +77,15 @@ var Card = (function() {
         }, this));
     };
 
+    Card.prototype.evaluateProgress = function(elapsed) {
+        this.output.children('.loader')
+            .attr('title', 'Computing... ' + elapsed + 's');
+    };
+
+    Card.prototype.isEvaluated = function() {
+        return this.output.data('evaluated') === true;
+    };
+
     Card.prototype.onEvaluate = function(callback) {
         this._evaluateCallbacks.push(callback);
     }
@@ -308,7 +323,8 @@ var Card = (function() {
         // handle nested arrays
         var expr = encodeURIComponent(gammaToString(output.data('expr')));
         var parameters = output.data('parameters');
-        var card = new Card(card_name, variable, expr, parameters);
+        var eval_id = output.data('eval-id');
+        var card = new Card(card_name, variable, expr, parameters, eval_id);
         card.setElement(el);
         el.data('card', card);
 
@@ -326,6 +342,86 @@ var Card = (function() {
         return card;
     };
 
+    // Evaluate cards, with `events` those of the same expression over a
+    // single Server-Sent Events connection (see the CARD_EVENTS setting).
+    // Returns a deferred per card. Cards the stream doesn't deliver (too
+    // slow, connection lost) are evaluated one by one.
+    Card.evaluateAll = function(cards, events) {
+        if (!events || typeof window.EventSource === "undefined" ||
+            cards.length < 2) {
+            return $.map(cards, function(card) {
+                return card.evaluate();
+            });
+        }
+
+        var first = cards[0];
+        var streamed = {};
+        var deferreds = [];
+        $.each(cards, function(i, card) {
+            if (card.variable === first.variable && card.expr === first.expr &&
+                card.eval_id === first.eval_id &&
+                typeof streamed[card.card_name] === "undefined") {
+                streamed[card.card_name] = {
+                    card: card,
+                    deferred: new $.Deferred()
+                };
+                deferreds.push(streamed[card.card_name].deferred);
+            }
+            else {
+                deferreds.push(card.evaluate());
+            }
+        });
+
+        var parms = {
+            variable: first.variable,
+            expression: first.expr,
+            card: Object.keys(streamed)
+        };
+        if (first.eval_id) {
+            parms.eval_id = first.eval_id;
+        }
+        var source = new EventSource('/card_events?' + $.param(parms, true));
+
+        var take = function(name) {
+            var entry = streamed[name];
+            delete streamed[name];
+            return entry;
+        };
+        var fallback = function(name) {
+            var entry = take(name);
+            if (entry) {
+                entry.card.evaluate().always(entry.deferred.resolve);
+            }
+        };
+        source.addEventListener('card', function(e) {
+            var data = JSON.parse(e.data);
+            var entry = take(data.card);
+            if (entry) {
+                entry.card.evaluateFinished(data.result);
+                entry.deferred.resolve();
+            }
+        });
+        source.addEventListener('progress', function(e) {
+            var data = JSON.parse(e.data);
+            if (streamed[data.card]) {
+                streamed[data.card].card.evaluateProgress(data.elapsed);
+            }
+        });
+        source.addEventListener('timeout', function(e) {
+            fallback(JSON.parse(e.data).card);
+        });
+        var close = function() {
+            source.close();
+            $.each(Object.keys(streamed), function(i, name) {
+                fallback(name);
+            });
+        };
+        source.addEventListener('done', close);
+        source.onerror = close;
+
+        return deferreds;
+    };
+
     Card.loadFullCard = function(card_name, variable, expr, parameterValues) {
         var url = '/card_full/' + card_name;
         var parms = {
@@ -103,26 +103,45 @@ function setupMobileKeyboard() {
 
 function evaluateCards() {
     var deferred = new $.Deferred();
-    var requests = [];
+    var cards = [];
 
     $('.result_card').each(function() {
         var card = Card.fromCardEl($(this));
         card.initSpecificFunctionality();
 
-        // deferred if can evaluate, false otherwise
-        var result = card.evaluate();
-        if (!(result.state() == "rejected")) {
-            requests.push(result);
+        // cards the server already evaluated only need their callbacks run
+        if (card.isEvaluated()) {
+            card.evaluateFinished();
+            return;
+        }
+
+        if (typeof card.card_name !== "undefined") {
+            cards.push(card);
         }
     });
 
-    $.when.apply($, requests).then(function() {
+    var events = $('.result').data('card-events') === true;
+    $.when.apply($, Card.evaluateAll(cards, events)).then(function() {
         deferred.resolve();
     });
 
     return deferred;
 }
 
+// Cards still loading when the page is left (new query, tab closed) would
+// keep computing on the server; tell it to stop them
+function setupCancellation() {
+    $(window).on('pagehide', function() {
+        var loading = $('.cell_output[data-eval-id]').filter(function() {
+            return $(this).children('.loader:visible').length > 0;
+        });
+        var eval_id = loading.first().data('eval-id');
+        if (eval_id && navigator.sendBeacon) {
+            navigator.sendBeacon('/cancel', String(eval_id));
+        }
+    });
+}
+
 function setupDidYouMean() {
     $('.did_you_mean var').each(function() {
         $(this).wrap($("<a />").attr('href', '/input/?i=' + $(this).text()));
@@ -157,7 +176,8 @@ function setupVariableChooser() {
                             .append($('<div/>').addClass('loader'));
                         card.element.after(placeholder);
                         deferreds.push(
-                            Card.loadFullCard(card.card_name, variable, card.expr, {})
+                            Card.loadFullCard(card.card_name, variable, card.expr,
+                                             card.eval_id ? {eval_id: card.eval_id} : {})
                                 .done(function(result) {
                                     var newCardEl = $(result);
                                     newCardEl
@@ -189,6 +209,8 @@ function setupVariableChooser() {
 }
 
 $(document).ready(function() {
+    setupCancellation();
+
     evaluateCards().done(function() {
         setupPlots();
 